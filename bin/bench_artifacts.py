@@ -0,0 +1,94 @@
+import argparse
+import http.server
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from library.api import utils  # noqa: E402
+
+# README:
+# python bin/bench_artifacts.py --runs 50 --size-mb 5 --handshake-ms 30
+#
+# Serves a fake GitHub artifacts API on localhost and times
+# `GitHubArtifactManager.sync()` with and without the pooled HTTP client.
+# Local TCP connects are nearly free, so `--handshake-ms` adds a delay to
+# every new connection to stand in for the TLS handshake to api.github.com.
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        time.sleep(self.server.handshake)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.endswith('/artifacts'):
+            host = 'http://%s:%d' % self.server.server_address
+            records = {'artifacts': [{
+                'name': 'linux-64',
+                'size_in_bytes': len(self.server.payload),
+                'archive_download_url': '%s/zip/linux-64' % (host,),
+            }]}
+            self.send_body(json.dumps(records).encode('utf-8'), 'application/json')
+        elif self.path.startswith('/zip/'):
+            self.send_response(302)
+            self.send_header('location', '/blob/linux-64')
+            self.send_header('content-length', '0')
+            self.end_headers()
+        else:
+            self.send_body(self.server.payload, 'application/zip')
+
+
+def bench(base_url, runs, http_pool):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        for run_id in range(runs):
+            root = pathlib.Path(tmpdir) / str(run_id)
+            root.mkdir()
+            mgr = utils.GitHubArtifactManager('token', 'qiime2/q2-foo', str(run_id), 'linux-64', root,
+                                              http_pool=http_pool)
+            mgr.base_url = base_url
+            for fp in mgr.sync():
+                fp.unlink()
+        return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--size-mb', type=float, default=5)
+    parser.add_argument('--handshake-ms', type=float, default=30)
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    server.payload = os.urandom(int(args.size_mb * 1024 * 1024))
+    server.handshake = args.handshake_ms / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://%s:%d' % server.server_address
+
+    total_mb = args.runs * args.size_mb
+    for label, http_pool in (('urllib', None), ('pooled', utils.HTTPConnectionPool())):
+        server.connections = 0
+        elapsed = bench(base_url, args.runs, http_pool)
+        print('%-8s %7.2fs  %8.1f syncs/s  %8.1f MB/s  %4d connections' % (
+            label, elapsed, args.runs / elapsed, total_mb / elapsed, server.connections))
+
+    server.shutdown()
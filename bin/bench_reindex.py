@@ -0,0 +1,82 @@
+import argparse
+import io
+import json
+import os
+import pathlib
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from library.api import channels  # noqa: E402
+
+# README:
+# python bin/bench_reindex.py --packages 4000 --payload-kb 256
+#
+# Builds a synthetic channel of `.tar.bz2` packages and times a full index of
+# it (i.e. nothing cached yet), and then of the same channel left untouched.
+# If conda-build is importable, its `update_index(threads=1)` --- what
+# `reindex_conda_channel` used to run --- is timed as well.
+
+
+def make_channel(channel, n_packages, payload_kb):
+    payload = os.urandom(payload_kb * 1024)
+    for i in range(n_packages):
+        subdir = ('linux-64', 'osx-64')[i % 2]
+        name, version, build = 'q2-pkg%d' % (i // 2,), '2021.8.0', 'py38_0'
+        fp = channel / subdir / ('%s-%s-%s.tar.bz2' % (name, version, build))
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        members = {
+            'info/index.json': json.dumps({'name': name, 'version': version, 'build': build,
+                                           'build_number': 0, 'subdir': subdir, 'depends': []}).encode(),
+            'info/about.json': b'{}',
+            'lib/payload.bin': payload,
+        }
+        with tarfile.open(fp, 'w:bz2') as tar_fh:
+            for member_name, data in members.items():
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                tar_fh.addfile(info, io.BytesIO(data))
+
+
+def reset(channel):
+    (channel / channels.STATE_FN).unlink(missing_ok=True)
+    for subdir in channels.SUBDIRS:
+        (channel / subdir / 'repodata.json').unlink(missing_ok=True)
+
+
+def timed(label, fn, n_packages, baseline=None):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    speedup = '' if baseline is None else '  (%.1fx)' % (baseline / elapsed,)
+    print('%-22s %8.2fs  %8.1f pkgs/s%s' % (label, elapsed, n_packages / elapsed, speedup))
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=4000)
+    parser.add_argument('--payload-kb', type=int, default=256)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        channel = pathlib.Path(tmpdir) / 'tested'
+        print('building %d packages...' % (args.packages,))
+        make_channel(channel, args.packages, args.payload_kb)
+
+        serial = timed('full index', channels.ChannelIndex(channel).index, args.packages)
+        timed('untouched channel', channels.ChannelIndex(channel).index, args.packages)
+
+        try:
+            import conda_build.api
+        except ImportError:
+            print('conda-build not installed, skipping update_index')
+        else:
+            reset(channel)
+            config = conda_build.api.Config(verbose=False)
+            timed('conda_build threads=1',
+                  lambda: conda_build.api.update_index(str(channel), config=config, threads=1),
+                  args.packages, serial)
@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import time
+
+# replace (rather than prepend to) this script's directory on the path, or
+# `bin/secrets.py` shadows the stdlib module django imports
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings.celery-production')
+
+import django  # noqa: E402
+
+django.setup()
+
+from kombu.serialization import dumps, loads  # noqa: E402
+
+from library.api import tasks  # noqa: E402
+
+# README:
+# DATABASE_URL=sqlite:// python bin/bench_serializers.py --packages 200 --iterations 5000
+#
+# Times `library-json` against `library-msgpack` on the messages a build
+# pipeline actually sends: a package build chain hop, a distro build chain
+# hop, and an integration ctx carrying `--packages` package versions per
+# distro. Reports payload size and the encode + decode round trip.
+
+
+def payloads(n_packages):
+    package_cfg = tasks.PackageBuildCfg(
+        github_token='ghs_' + 'x' * 36, run_id='1518529467', artifact_name='linux-64', package_name='q2-types',
+        version='2021.11.0.dev0+14.g1a2b3c4', repository='qiime2/q2-types', build_target='dev',
+        package_token='6d2c4a0e-2bb8-4a38-9d25-f2f1d2a1a1e5', epoch_name='2021.11')
+    package_ctx = tasks.PackageBuildCtx(pk='0b9e1bd4-5b2c-4d0e-8a4f-1d6bbf2a6c7e', received_at=time.time())
+
+    package_versions = {'q2-plugin-%d' % (i,): '2021.11.0.dev0+%d.g1a2b3c4' % (i,) for i in range(n_packages)}
+    distro_cfg = tasks.DistroBuildCfg(
+        github_token='ghs_' + 'x' * 36, run_id='1518529467', artifact_name='core-linux', package_name='core',
+        version='2021.11.19.17.02.45', epoch_name='2021.11', owner='qiime2', repo='package-integration',
+        gate='staged', from_channel='/data/qiime2/2021.11/tested', package_versions=package_versions, pr_number=42)
+    distro_ctx = tasks.DistroBuildCtx(pk='0b9e1bd4-5b2c-4d0e-8a4f-1d6bbf2a6c7e', not_all_architectures_present=False,
+                                      pkg_fns=['linux-64/%s-%s-py38_0.tar.bz2' % item
+                                               for item in package_versions.items()])
+
+    prs_ctx = tasks.HandlePRsCtx(
+        epoch_name='2021.11', github_token='ghs_' + 'x' * 36,
+        package_versions={distro: dict(package_versions) for distro in ('core', 'tiny', 'plugins')},
+        package_build_pks=[str(i) * 32 for i in range(n_packages)],
+        distro_build_pks={'core': '1' * 32, 'tiny': '2' * 32, 'plugins': '3' * 32}, version='2021.11.19.17.02.45')
+
+    # celery protocol 2 bodies: (args, kwargs, embed)
+    return {
+        'package build hop': ((package_ctx, package_cfg), {}, {}),
+        'distro build hop': ((distro_ctx, distro_cfg), {}, {}),
+        'integration ctx': ((prs_ctx,), {}, {}),
+    }
+
+
+def bench(serializer, body, iterations):
+    _, _, data = dumps(body, serializer=serializer)
+    content_type = {'library-json': 'application/x-library-json',
+                    'library-msgpack': 'application/x-library-msgpack'}[serializer]
+    encoding = 'utf-8' if serializer == 'library-json' else 'binary'
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _, _, data = dumps(body, serializer=serializer)
+        loads(data, content_type, encoding, accept={content_type})
+    elapsed = time.perf_counter() - start
+
+    return len(data), elapsed / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=5000)
+    args = parser.parse_args()
+
+    for name, body in payloads(args.packages).items():
+        results = {serializer: bench(serializer, body, args.iterations)
+                   for serializer in ('library-json', 'library-msgpack')}
+        _, json_secs = results['library-json']
+        for serializer, (size, secs) in results.items():
+            print('%-18s %-16s %8d bytes  %8.1f us/round trip  (%.2fx)' % (
+                name, serializer, size, secs * 1e6, json_secs / secs))
+
+
+if __name__ == '__main__':
+    main()
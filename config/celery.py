@@ -7,10 +7,37 @@
 # ----------------------------------------------------------------------------
 
 import dataclasses
+import functools
 import json
 
 from celery import Celery
 from kombu.serialization import register
+import msgpack
+
+
+@functools.lru_cache(maxsize=None)
+def task_types():
+    # imported lazily (and only once), since the task module imports celery
+    from library.api.tasks import (
+        BulkPackageBuildCtx,
+        CfgRef,
+        DistroBuildCfg,
+        DistroBuildCtx,
+        HandlePRsCtx,
+        PackageBuildCfg,
+        PackageBuildCtx,
+    )
+    # throwaway dict to map str name to actual class. we could also `eval`
+    # but for smaller sets of custom classes, i think this is a bit cleaner
+    return {
+        'BulkPackageBuildCtx': BulkPackageBuildCtx,
+        'CfgRef': CfgRef,
+        'DistroBuildCfg': DistroBuildCfg,
+        'DistroBuildCtx': DistroBuildCtx,
+        'HandlePRsCtx': HandlePRsCtx,
+        'PackageBuildCfg': PackageBuildCfg,
+        'PackageBuildCtx': PackageBuildCtx,
+    }
 
 
 class LibraryJSONEncoder(json.JSONEncoder):
@@ -19,7 +46,8 @@ class LibraryJSONEncoder(json.JSONEncoder):
             return {
                 # save the class name for later!
                 '__type__': type(obj).__name__,
-                **dataclasses.asdict(obj),
+                # one level at a time, so nested dataclasses keep theirs too
+                **{f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)},
             }
         return super().default(obj)
 
@@ -27,22 +55,7 @@ class LibraryJSONEncoder(json.JSONEncoder):
 def decoder(obj):
     # this is one of our custom dataclasses, let's rehydrate it!
     if type_ := obj.pop('__type__', None):
-        from library.api.tasks import (
-            DistroBuildCfg,
-            DistroBuildCtx,
-            HandlePRsCtx,
-            PackageBuildCfg,
-            PackageBuildCtx,
-        )
-        # throwaway dict to map str name to actual class. we could also `eval`
-        # but for smaller sets of custom classes, i think this is a bit cleaner
-        return {
-            'DistroBuildCfg': DistroBuildCfg,
-            'DistroBuildCtx': DistroBuildCtx,
-            'HandlePRsCtx': HandlePRsCtx,
-            'PackageBuildCfg': PackageBuildCfg,
-            'PackageBuildCtx': PackageBuildCtx,
-        }[type_](**obj)
+        return task_types()[type_](**obj)
     return obj
 
 
@@ -54,6 +67,47 @@ def loads(obj):
     return json.loads(obj, object_hook=decoder)
 
 
+# msgpack extension type codes for the task dataclasses. Append only: a code
+# must never be reused or renumbered while messages using it may be queued.
+MSGPACK_TYPE_CODES = {
+    'DistroBuildCfg': 1,
+    'DistroBuildCtx': 2,
+    'HandlePRsCtx': 3,
+    'PackageBuildCfg': 4,
+    'PackageBuildCtx': 5,
+    'CfgRef': 6,
+    'BulkPackageBuildCtx': 7,
+}
+MSGPACK_TYPE_NAMES = {code: name for name, code in MSGPACK_TYPE_CODES.items()}
+# bump when a dataclass changes in a way old workers can't decode
+MSGPACK_SCHEMA_VERSION = 1
+
+
+def msgpack_default(obj):
+    if dataclasses.is_dataclass(obj):
+        # fields are stored by name, so adding a field with a default doesn't
+        # need a new schema version
+        fields = {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)}
+        data = msgpack.packb([MSGPACK_SCHEMA_VERSION, fields], default=msgpack_default, use_bin_type=True)
+        return msgpack.ExtType(MSGPACK_TYPE_CODES[type(obj).__name__], data)
+    raise TypeError('Cannot serialize %r' % (obj,))
+
+
+def msgpack_ext_hook(code, data):
+    version, fields = msgpack.unpackb(data, ext_hook=msgpack_ext_hook, raw=False, strict_map_key=False)
+    if version != MSGPACK_SCHEMA_VERSION:
+        raise ValueError('Unsupported library-msgpack schema version: %r' % (version,))
+    return task_types()[MSGPACK_TYPE_NAMES[code]](**fields)
+
+
+def msgpack_dumps(obj):
+    return msgpack.packb(obj, default=msgpack_default, use_bin_type=True)
+
+
+def msgpack_loads(obj):
+    return msgpack.unpackb(obj, ext_hook=msgpack_ext_hook, raw=False, strict_map_key=False)
+
+
 app = Celery('library-tasks')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
@@ -61,3 +115,5 @@ app.autodiscover_tasks()
 
 register('library-json', dumps, loads, content_type='application/x-library-json',
          content_encoding='utf-8')
+register('library-msgpack', msgpack_dumps, msgpack_loads, content_type='application/x-library-msgpack',
+         content_encoding='binary')
@@ -48,6 +48,19 @@ from .shared import (
     GATE_TESTED,
     GATE_STAGED,
     GATE_PASSED,
+    REINDEX_LOCK_TIMEOUT,
+    INTAKE_DEDUP_WINDOW,
+    DEBUG_RESULT_BACKEND,
+    PIPELINE_CONFIG_EXPIRES,
+    RESULT_CLEANUP_PAUSE,
+    RESULT_CLEANUP_BATCH,
+    INTEGRATION_DEBOUNCE_WINDOW,
+    ADVISORY_LOCK_TIMEOUT,
+    INTEGRATION_REPO_MIRROR_PATH,
+    INTEGRATION_REPO_BACKEND,
+    CONDA_BLOB_STORE_PATH,
+    CONDA_INDEX_CACHE_PATH,
+    ARTIFACT_DOWNLOAD_PATH,
 )
 
 
@@ -95,6 +108,19 @@ __all__ = [
     'GATE_TESTED',
     'GATE_STAGED',
     'GATE_PASSED',
+    'ARTIFACT_DOWNLOAD_PATH',
+    'CONDA_INDEX_CACHE_PATH',
+    'CONDA_BLOB_STORE_PATH',
+    'INTEGRATION_REPO_BACKEND',
+    'INTEGRATION_REPO_MIRROR_PATH',
+    'ADVISORY_LOCK_TIMEOUT',
+    'INTEGRATION_DEBOUNCE_WINDOW',
+    'RESULT_CLEANUP_BATCH',
+    'RESULT_CLEANUP_PAUSE',
+    'PIPELINE_CONFIG_EXPIRES',
+    'DEBUG_RESULT_BACKEND',
+    'INTAKE_DEDUP_WINDOW',
+    'REINDEX_LOCK_TIMEOUT',
 ]
 
 DEBUG = False
@@ -47,6 +47,12 @@ from .shared import (
     GATE_TESTED,
     GATE_STAGED,
     GATE_PASSED,
+    REINDEX_LOCK_TIMEOUT,
+    PIPELINE_CONFIG_EXPIRES,
+    RESULT_CLEANUP_PAUSE,
+    RESULT_CLEANUP_BATCH,
+    ADVISORY_LOCK_TIMEOUT,
+    INTEGRATION_REPO_BACKEND,
 
     generate_beat_schedule,
 )
@@ -96,6 +102,19 @@ __all__ = [
     'GATE_TESTED',
     'GATE_STAGED',
     'GATE_PASSED',
+    'ARTIFACT_DOWNLOAD_PATH',
+    'CONDA_INDEX_CACHE_PATH',
+    'CONDA_BLOB_STORE_PATH',
+    'INTEGRATION_REPO_BACKEND',
+    'INTEGRATION_REPO_MIRROR_PATH',
+    'ADVISORY_LOCK_TIMEOUT',
+    'INTEGRATION_DEBOUNCE_WINDOW',
+    'RESULT_CLEANUP_BATCH',
+    'RESULT_CLEANUP_PAUSE',
+    'PIPELINE_CONFIG_EXPIRES',
+    'DEBUG_RESULT_BACKEND',
+    'INTAKE_DEDUP_WINDOW',
+    'REINDEX_LOCK_TIMEOUT',
 ]
 
 MIDDLEWARE.extend([
@@ -106,6 +125,8 @@ INSTALLED_APPS = ['whitenoise.runserver_nostatic', *INSTALLED_APPS, 'debug_toolb
 CELERY_RESULT_EXPIRES = 60 * 10
 # For development purposes it's a lot nicer to have short cycle times (30 sec)
 TASK_TIMES = {
+    '05_SEC': 1,
+    '30_SEC': 5,
     '03_MIN': 30,
     '05_MIN': 30,
     '10_MIN': 30,
@@ -116,3 +137,10 @@ TASK_TIMES = {
 }
 CELERY_BEAT_SCHEDULE = generate_beat_schedule(TASK_TIMES)
 BASE_CONDA_PATH = pathlib.Path('data/qiime2')
+CONDA_BLOB_STORE_PATH = BASE_CONDA_PATH / '.blobs'
+CONDA_INDEX_CACHE_PATH = pathlib.Path('data/.cache/conda-index.sqlite3')
+ARTIFACT_DOWNLOAD_PATH = pathlib.Path('data/artifacts')
+INTEGRATION_REPO_MIRROR_PATH = pathlib.Path('data/.cache/package-integration.git')
+INTEGRATION_DEBOUNCE_WINDOW = 30
+DEBUG_RESULT_BACKEND = 'file://data/.cache/debug-results'
+INTAKE_DEDUP_WINDOW = 30
@@ -101,9 +101,23 @@ RABBITMQ_URL = env('RABBITMQ_URL', default='amqp://guest@mq')
 CELERY_BROKER_URL = env('RABBITMQ_URL', default='amqp://guest@mq')
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_RESULT_EXPIRES = 60 * 60 * 24  # once per day
+# `db.celery_backend_cleanup` deletes this many results at a time, pausing
+# for RESULT_CLEANUP_PAUSE seconds in between
+RESULT_CLEANUP_BATCH = 1000
+RESULT_CLEANUP_PAUSE = 0.5
+# stored pipeline cfgs outlive every retry of the chains that use them
+PIPELINE_CONFIG_EXPIRES = 60 * 60 * 24 * 7
+# repeats of an integration request within this many seconds are answered
+# with the pipeline the first one launched
+INTAKE_DEDUP_WINDOW = env.int('INTAKE_DEDUP_WINDOW', default=60 * 15)
+# `index.debug` results go here instead, when set (e.g. `file://...`), so the
+# `/_debug` round-trip never writes to the database
+DEBUG_RESULT_BACKEND = env('DEBUG_RESULT_BACKEND', default='')
+# results stay json, so they remain readable in the admin
 CELERY_RESULT_SERIALIZER = 'library-json'
-CELERY_TASK_SERIALIZER = 'library-json'
-CELERY_ACCEPT_CONTENT = ['library-json']
+CELERY_TASK_SERIALIZER = 'library-msgpack'
+# keep accepting json so messages queued before a deploy still decode
+CELERY_ACCEPT_CONTENT = ['library-msgpack', 'library-json']
 CELERY_TASK_ROUTES = {
     'index.*': {'queue': 'default'},
     'db.*': {'queue': 'db'},
@@ -114,9 +128,25 @@ CELERY_TASK_ROUTES = {
     'pipeline.*': {'queue': 'pipeline'},
 }
 BASE_CONDA_PATH = pathlib.Path('/data/qiime2')
+# every package file in every channel is a hard link into here, so this must
+# be on the same mount as BASE_CONDA_PATH --- which nginx serves, so
+# `channels.BlobStore` keeps the directory itself private to the worker
+CONDA_BLOB_STORE_PATH = BASE_CONDA_PATH / '.blobs'
+# package metadata extracted while indexing, kept across worker restarts
+# (kept out of /data, which is the public web root in production)
+CONDA_INDEX_CACHE_PATH = pathlib.Path('/var/lib/library/conda-index.sqlite3')
+# seconds a reindex task waits on a run already in progress for its channel,
+# before handing the worker back and retrying later
+REINDEX_LOCK_TIMEOUT = 5
+# partially downloaded artifacts live here between task retries
+ARTIFACT_DOWNLOAD_PATH = pathlib.Path('/tmp/library/artifacts')
 GITHUB_TOKEN = env('GITHUB_TOKEN', default='')
+# seconds to hold an epoch's integration PR open to more ready package builds
+INTEGRATION_DEBOUNCE_WINDOW = env.int('INTEGRATION_DEBOUNCE_WINDOW', default=60 * 5)
 # Don't forget to update local.py when changing here
 TASK_TIMES = {
+    '05_SEC': 5,
+    '30_SEC': 30,
     '03_MIN': 60 * 3,
     '05_MIN': 60 * 5,
     '10_MIN': 60 * 10,
@@ -134,6 +164,10 @@ def generate_beat_schedule(TASK_TIMES):
             'task': 'db.celery_backend_cleanup',
             'schedule': TASK_TIMES['4A_CRON'],
         },
+        'periodic.collect_package_blobs': {
+            'task': 'packages.collect_package_blobs',
+            'schedule': TASK_TIMES['4A_CRON'],
+        },
         'periodic.handle_prs': {
             'task': 'pipeline.handle_prs',
             'schedule': TASK_TIMES['HRLY_CRON'],
@@ -152,6 +186,12 @@ INTEGRATION_REPO = {
     'branch': 'main',
     'token': 'foo',
 }
+# seconds to wait on the advisory locks guarding integration repo files
+ADVISORY_LOCK_TIMEOUT = 60
+# `api` reads and writes the integration repo through the GitHub API, `mirror`
+# works against a bare clone kept at INTEGRATION_REPO_MIRROR_PATH instead
+INTEGRATION_REPO_BACKEND = env('INTEGRATION_REPO_BACKEND', default='api')
+INTEGRATION_REPO_MIRROR_PATH = pathlib.Path('/var/lib/library/package-integration.git')
 GATE_TESTED = 'tested'
 GATE_STAGED = 'staged'
 GATE_PASSED = 'passed'
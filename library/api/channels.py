@@ -0,0 +1,731 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import bz2
+import collections
+import contextlib
+import dataclasses
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import sqlite3
+import tarfile
+import threading
+import time
+import zipfile
+
+import orjson
+from packaging import version
+import zstandard
+
+
+# conda clients expect a `noarch` subdir in every channel, even an empty one
+SUBDIRS = ('linux-64', 'osx-64', 'noarch')
+SUBDIR_PATTERN = re.compile(r'^(noarch|[a-z]+-[a-z0-9_]+)$')
+PACKAGE_EXTENSIONS = ('.tar.bz2', '.conda')
+STATE_FN = '.index-state.json'
+# derivatives that conda-build used to write alongside `repodata.json` --- if
+# these are left behind they go stale
+STALE_FNS = ('repodata_from_packages.json', 'repodata_from_packages.json.bz2', 'index.html')
+# ... and at the top of the channel
+STALE_CHANNEL_FNS = ('channeldata.json', 'index.html')
+# written next to every `repodata.json`, and always kept in sync with it
+VARIANT_FNS = ('repodata.json.bz2', 'repodata.json.zst', 'current_repodata.json')
+ZSTD_LEVEL = 16
+# linux's FICLONE ioctl, i.e. `cp --reflink`
+FICLONE = 0x40049409
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class ReindexTimeoutException(Exception):
+    pass
+
+
+class PromotionException(Exception):
+    pass
+
+
+def write_atomic(fp, data):
+    fp = pathlib.Path(fp)
+    tmp_fp = fp.with_name('.%s.tmp' % (fp.name,))
+    try:
+        with tmp_fp.open('wb') as fh:
+            fh.write(data)
+        os.replace(tmp_fp, fp)
+    finally:
+        tmp_fp.unlink(missing_ok=True)
+
+
+def read_package_metadata(fp):
+    """Pull `info/index.json` and `info/about.json` out of a conda package."""
+    fp = pathlib.Path(fp)
+    wanted = {'info/index.json': 'index', 'info/about.json': 'about'}
+    metadata = {'index': None, 'about': {}}
+
+    def read_members(tar_fh):
+        found = 0
+        for member in tar_fh:
+            if member.name in wanted:
+                metadata[wanted[member.name]] = json.load(tar_fh.extractfile(member))
+                found += 1
+                # conda-build writes `info/` first, so we can usually stop
+                # long before decompressing the actual payload
+                if found == len(wanted):
+                    break
+
+    if fp.name.endswith('.tar.bz2'):
+        with tarfile.open(fp, 'r|bz2') as tar_fh:
+            read_members(tar_fh)
+    elif fp.name.endswith('.conda'):
+        with zipfile.ZipFile(fp) as zip_fh:
+            info_fn = 'info-%s.tar.zst' % (fp.name[:-len('.conda')],)
+            with zip_fh.open(info_fn) as zst_fh, \
+                    zstandard.ZstdDecompressor().stream_reader(zst_fh) as raw_fh, \
+                    tarfile.open(fileobj=raw_fh, mode='r|') as tar_fh:
+                read_members(tar_fh)
+    else:
+        raise ValueError('Not a conda package: %s' % (fp,))
+
+    if metadata['index'] is None:
+        raise ValueError('Package is missing info/index.json: %s' % (fp,))
+
+    return metadata
+
+
+def hash_package(fp):
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    size = 0
+    with open(fp, 'rb') as fh:
+        while chunk := fh.read(READ_CHUNK_SIZE):
+            md5.update(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+    return {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(), 'size': size}
+
+
+def package_record(fp, cache=None):
+    if cache is not None:
+        return cache.package_record(fp)
+
+    metadata = read_package_metadata(fp)
+    return {**metadata['index'], **hash_package(fp)}
+
+
+def reflink(src, dst):
+    with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+        fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+
+
+def promote_package(src, dst):
+    """Place the package at `src` into another channel at `dst`.
+
+    Packages are immutable once uploaded, so a hard link is all a promotion
+    needs. When that isn't possible (e.g. across filesystems) fall back to a
+    reflink, and failing that a plain copy. The new file is verified before
+    it is atomically renamed into place, and the method used is returned.
+    """
+    src, dst = pathlib.Path(src), pathlib.Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = dst.with_name('.%s.part' % (dst.name,))
+    tmp_fp.unlink(missing_ok=True)
+
+    try:
+        try:
+            os.link(src, tmp_fp)
+            method = 'hardlink'
+        except OSError:
+            try:
+                reflink(src, tmp_fp)
+                method = 'reflink'
+            except OSError:
+                shutil.copy(src, tmp_fp)
+                method = 'copy'
+
+        if method == 'hardlink':
+            verified = os.path.samefile(src, tmp_fp)
+        else:
+            verified = hash_package(src) == hash_package(tmp_fp)
+        if not verified:
+            raise PromotionException('Promoted package does not match %s (%s)' % (src, method))
+
+        os.replace(tmp_fp, dst)
+    finally:
+        tmp_fp.unlink(missing_ok=True)
+
+    return method
+
+
+def split_package_fn(fn):
+    """`q2-types-2021.8.0-py38_0.tar.bz2` -> `('q2-types', '2021.8.0', 'py38_0')`"""
+    for ext in PACKAGE_EXTENSIONS:
+        if fn.endswith(ext):
+            parts = fn[:-len(ext)].rsplit('-', 2)
+            if len(parts) == 3:
+                return tuple(parts)
+    return None
+
+
+class ChannelCatalog:
+    """Look up a channel's package filenames by name, version and subdir.
+
+    Built from a single listing of each subdir, after which every lookup is
+    a dict access instead of another walk over the whole channel.
+    """
+
+    def __init__(self, channel):
+        self.channel = pathlib.Path(channel)
+        self.entries = collections.defaultdict(list)
+
+        for entry in os.scandir(self.channel):
+            if not entry.is_dir() or not SUBDIR_PATTERN.match(entry.name):
+                continue
+            for pkg_entry in os.scandir(entry.path):
+                if pkg_entry.name.startswith('.') or (parts := split_package_fn(pkg_entry.name)) is None:
+                    continue
+                name, ver, _ = parts
+                self.entries[(name, ver, entry.name)].append(pkg_entry.name)
+
+        self.subdirs = collections.defaultdict(set)
+        for name, ver, subdir in self.entries:
+            self.subdirs[(name, ver)].add(subdir)
+
+    def get(self, name, ver, subdir):
+        return sorted(self.entries.get((name, ver, subdir), []))
+
+    def find(self, name, ver):
+        """Every file for this package version, relative to the channel."""
+        return ['%s/%s' % (subdir, fn)
+                for subdir in sorted(self.subdirs.get((name, ver), ()))
+                for fn in self.get(name, ver, subdir)]
+
+
+class BlobStore:
+    """Content-addressed storage for package files, keyed by sha256.
+
+    Every package in every channel is a hard link onto a single blob in the
+    store, so each distinct package is kept on disk exactly once no matter how
+    many gates, distros or epochs it appears in. The link count doubles as a
+    reference count: a blob with no links left besides its own is garbage.
+    The store must live on the same filesystem as the channels.
+    """
+
+    def __init__(self, root, cache=None):
+        self.root = pathlib.Path(root)
+        self.cache = cache
+
+        # the store sits inside the served tree (it has to share a mount with
+        # the channels), so keep nginx from listing or fetching blobs through
+        # it --- the links in the channels stay readable on their own
+        self.root.mkdir(parents=True, exist_ok=True)
+        os.chmod(self.root, 0o700)
+
+    def blob_path(self, sha256):
+        return self.root / sha256[:2] / sha256
+
+    def sha256(self, fp):
+        record = package_record(fp, self.cache) if self.cache is not None else hash_package(fp)
+        return record['sha256']
+
+    def references(self, sha256):
+        return self.blob_path(sha256).stat().st_nlink - 1
+
+    def linked_blob(self, fp):
+        """The blob `fp` is already a link to, if the cache can say so without reading it."""
+        stat = fp.stat()
+        if self.cache is None or stat.st_nlink < 2:
+            return None
+        if (record := self.cache.get_by_inode(stat)) is None:
+            return None
+
+        blob = self.blob_path(record['sha256'])
+        try:
+            return blob if os.path.samefile(fp, blob) else None
+        except FileNotFoundError:
+            return None
+
+    def ingest(self, fp):
+        """Move a package into the store, leaving a link in its place."""
+        fp = pathlib.Path(fp)
+        # promoted packages are links to their blob already, so there is
+        # nothing to read, hash or move
+        if (blob := self.linked_blob(fp)) is not None:
+            return blob
+
+        blob = self.blob_path(self.sha256(fp))
+        blob.parent.mkdir(parents=True, exist_ok=True)
+
+        while True:
+            try:
+                os.link(fp, blob)
+                # every channel shares this inode, make sure nobody edits it
+                os.chmod(blob, 0o444)
+                return blob
+            except FileExistsError:
+                pass
+
+            if os.path.samefile(fp, blob):
+                return blob
+
+            # the same content is already stored, swap our copy for a link
+            tmp_fp = fp.with_name('.%s.part' % (fp.name,))
+            tmp_fp.unlink(missing_ok=True)
+            try:
+                os.link(blob, tmp_fp)
+            except FileNotFoundError:
+                # collected out from under us, so store this copy instead
+                continue
+            os.replace(tmp_fp, fp)
+            return blob
+
+    def materialize(self, sha256, dst):
+        return promote_package(self.blob_path(sha256), dst)
+
+    def collect_garbage(self, grace=60 * 60):
+        """Delete unreferenced blobs, returns the count and bytes freed.
+
+        A blob's ctime moves whenever a link to it is added or removed, so the
+        grace period is measured from when it was last dereferenced.
+        """
+        count, freed = 0, 0
+        now = time.time()
+        for blob in self.root.glob('*/*'):
+            stat = blob.stat()
+            if stat.st_nlink == 1 and now - stat.st_ctime > grace:
+                # a link made after our stat keeps the inode alive, so the
+                # worst a race can do here is lose the deduplication
+                blob.unlink()
+                count += 1
+                freed += stat.st_size
+        return count, freed
+
+
+class MetadataCache:
+    """A durable cache of package metadata, backed by sqlite.
+
+    Packages are looked up by (path, size, mtime) first, which costs a single
+    `stat`, then by inode, which catches a package hard linked into a new
+    path. Failing that the package is hashed, and looked up by sha256, which
+    catches the same package copied or linked into another channel --- only
+    packages that have never been seen before are actually decompressed.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS packages ('
+        '    sha256 TEXT PRIMARY KEY, md5 TEXT NOT NULL, size INTEGER NOT NULL,'
+        '    index_json TEXT NOT NULL, about_json TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS paths ('
+        '    path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,'
+        '    sha256 TEXT NOT NULL REFERENCES packages (sha256))',
+        # hard links share an inode (and its size and mtime), so a package
+        # linked into a new path can be recognised without reading it
+        'CREATE TABLE IF NOT EXISTS inodes ('
+        '    dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,'
+        '    sha256 TEXT NOT NULL REFERENCES packages (sha256), PRIMARY KEY (dev, ino))',
+    )
+
+    def __init__(self, fp):
+        self.fp = pathlib.Path(fp)
+        self.local = threading.local()
+
+    def connection(self):
+        # sqlite connections can't be shared across threads, or a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.fp.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.fp), timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def get_by_path(self, fp, stat):
+        row = self.connection().execute(
+            'SELECT p.sha256, p.md5, p.size, p.index_json FROM paths AS f'
+            '    JOIN packages AS p ON p.sha256 = f.sha256'
+            '    WHERE f.path = ? AND f.size = ? AND f.mtime_ns = ?',
+            (str(fp), stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        return self.to_record(row)
+
+    def get_by_inode(self, stat):
+        row = self.connection().execute(
+            'SELECT p.sha256, p.md5, p.size, p.index_json FROM inodes AS i'
+            '    JOIN packages AS p ON p.sha256 = i.sha256'
+            '    WHERE i.dev = ? AND i.ino = ? AND i.size = ? AND i.mtime_ns = ?',
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        return self.to_record(row)
+
+    def get_by_hash(self, sha256):
+        row = self.connection().execute(
+            'SELECT sha256, md5, size, index_json FROM packages WHERE sha256 = ?',
+            (sha256,),
+        ).fetchone()
+        return self.to_record(row)
+
+    def get_about(self, sha256):
+        row = self.connection().execute(
+            'SELECT about_json FROM packages WHERE sha256 = ?', (sha256,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def to_record(self, row):
+        if row is None:
+            return None
+        sha256, md5, size, index_json = row
+        return {**json.loads(index_json), 'md5': md5, 'sha256': sha256, 'size': size}
+
+    def put_package(self, hashes, metadata):
+        self.connection().execute(
+            'INSERT OR REPLACE INTO packages (sha256, md5, size, index_json, about_json)'
+            '    VALUES (?, ?, ?, ?, ?)',
+            (hashes['sha256'], hashes['md5'], hashes['size'],
+             json.dumps(metadata['index']), json.dumps(metadata['about'])),
+        )
+
+    def put_path(self, fp, stat, sha256):
+        self.connection().execute(
+            'INSERT OR REPLACE INTO paths (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)',
+            (str(fp), stat.st_size, stat.st_mtime_ns, sha256),
+        )
+
+    def put_inode(self, stat, sha256):
+        self.connection().execute(
+            'INSERT OR REPLACE INTO inodes (dev, ino, size, mtime_ns, sha256) VALUES (?, ?, ?, ?, ?)',
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, sha256),
+        )
+
+    def package_record(self, fp):
+        fp = pathlib.Path(fp).absolute()
+        stat = fp.stat()
+        if (record := self.get_by_path(fp, stat)) is not None:
+            return record
+
+        # e.g. just promoted from another channel
+        if stat.st_nlink > 1 and (record := self.get_by_inode(stat)) is not None:
+            self.put_path(fp, stat, record['sha256'])
+            return record
+
+        hashes = hash_package(fp)
+        if (record := self.get_by_hash(hashes['sha256'])) is None:
+            metadata = read_package_metadata(fp)
+            self.put_package(hashes, metadata)
+            record = {**metadata['index'], **hashes}
+        self.put_path(fp, stat, hashes['sha256'])
+        self.put_inode(stat, hashes['sha256'])
+
+        return record
+
+
+def build_repodata(subdir, records):
+    repodata = {
+        'info': {'subdir': subdir},
+        'packages': {},
+        'packages.conda': {},
+        'removed': [],
+        'repodata_version': 1,
+    }
+    for fn, record in records.items():
+        key = 'packages.conda' if fn.endswith('.conda') else 'packages'
+        repodata[key][fn] = record
+    return repodata
+
+
+def dump_repodata(repodata):
+    return orjson.dumps(repodata, option=orjson.OPT_SORT_KEYS)
+
+
+def parse_version(ver_str):
+    try:
+        return version.Version(ver_str)
+    except version.InvalidVersion:
+        return None
+
+
+def build_current_repodata(repodata):
+    """Trim repodata down to the newest version of each package.
+
+    conda tries `current_repodata.json` first, and falls back to the full
+    `repodata.json` when it can't solve against it. Every build of the newest
+    version is kept, and packages with a version that can't be ordered are
+    kept in full, just to be safe.
+    """
+    latest = {}
+    unordered = set()
+    for key in ('packages', 'packages.conda'):
+        for record in repodata[key].values():
+            if (ver := parse_version(record['version'])) is None:
+                unordered.add(record['name'])
+            elif record['name'] not in latest or latest[record['name']] < ver:
+                latest[record['name']] = ver
+
+    current = {**repodata, 'packages': {}, 'packages.conda': {}}
+    for key in ('packages', 'packages.conda'):
+        for fn, record in repodata[key].items():
+            name = record['name']
+            if name in unordered or parse_version(record['version']) == latest[name]:
+                current[key][fn] = record
+    return current
+
+
+def write_repodata_variants(subdir_fp, repodata, data):
+    write_atomic(subdir_fp / 'repodata.json.bz2', bz2.compress(data))
+    write_atomic(subdir_fp / 'repodata.json.zst', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data))
+    write_atomic(subdir_fp / 'current_repodata.json', dump_repodata(build_current_repodata(repodata)))
+
+
+@dataclasses.dataclass
+class SubdirPlan:
+    subdir: str
+    fp: pathlib.Path
+    mtime_ns: int
+    files: dict
+    records: dict
+    missing: list
+
+
+class ChannelIndex:
+    """Incrementally maintain `repodata.json` for every subdir of a channel.
+
+    The stat info for every package that went into a subdir's repodata is kept
+    in `<channel>/.index-state.json`. A subdir whose directory mtime hasn't
+    moved since it was last indexed is skipped without listing it, and within
+    a changed subdir only new or modified packages are opened. `repodata.json`
+    is only rewritten when its contents actually change.
+    """
+
+    # like git's "racy" index entries: when a directory was modified this
+    # recently a further change could land within the same mtime tick, so
+    # don't trust the mtime to notice it next time around
+    racy_ns = 1_000_000_000
+
+    def __init__(self, channel, cache=None):
+        self.channel = pathlib.Path(channel)
+        self.state_fp = self.channel / STATE_FN
+        self.cache = cache
+
+    def subdirs(self):
+        subdirs = set(SUBDIRS)
+        for entry in os.scandir(self.channel):
+            if entry.is_dir() and SUBDIR_PATTERN.match(entry.name):
+                subdirs.add(entry.name)
+        return sorted(subdirs)
+
+    def load_state(self):
+        try:
+            with self.state_fp.open() as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        write_atomic(self.state_fp, json.dumps(state, sort_keys=True).encode('utf-8'))
+
+    def index(self):
+        """Returns the subdirs whose `repodata.json` was (re)written."""
+        self.channel.mkdir(parents=True, exist_ok=True)
+        state = self.load_state()
+        old_state = json.dumps(state, sort_keys=True)
+
+        plans = []
+        for subdir in self.subdirs():
+            if (plan := self.plan_subdir(subdir, state.setdefault(subdir, {}))) is not None:
+                plans.append(plan)
+
+        changed = []
+        for plan in plans:
+            plan.records.update((fn, package_record(plan.fp / fn, self.cache)) for fn in plan.missing)
+            if self.finish_subdir(plan, state[plan.subdir]):
+                changed.append(plan.subdir)
+
+        if changed:
+            for fn in STALE_CHANNEL_FNS:
+                (self.channel / fn).unlink(missing_ok=True)
+
+        if json.dumps(state, sort_keys=True) != old_state:
+            self.save_state(state)
+
+        return changed
+
+    def scan_subdir(self, subdir_fp):
+        files = {}
+        for entry in os.scandir(subdir_fp):
+            if entry.name.startswith('.') or not entry.name.endswith(PACKAGE_EXTENSIONS):
+                continue
+            if entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+        return files
+
+    def load_records(self, subdir_fp):
+        try:
+            with (subdir_fp / 'repodata.json').open() as fh:
+                repodata = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return {**repodata.get('packages', {}), **repodata.get('packages.conda', {})}
+
+    def plan_subdir(self, subdir, subdir_state):
+        subdir_fp = self.channel / subdir
+        subdir_fp.mkdir(exist_ok=True)
+
+        mtime_ns = subdir_fp.stat().st_mtime_ns
+        if subdir_state.get('mtime_ns') == mtime_ns and (subdir_fp / 'repodata.json').exists():
+            return None
+
+        files = self.scan_subdir(subdir_fp)
+        known_files = subdir_state.get('files', {})
+        known_records = self.load_records(subdir_fp)
+
+        records, missing = {}, []
+        for fn, stat in files.items():
+            if known_files.get(fn) == stat and fn in known_records:
+                records[fn] = known_records[fn]
+            else:
+                missing.append(fn)
+
+        return SubdirPlan(subdir=subdir, fp=subdir_fp, mtime_ns=mtime_ns, files=files,
+                          records=records, missing=missing)
+
+    def finish_subdir(self, plan, subdir_state):
+        # anything landing in the subdir while we were busy scanning it means
+        # our listing is already out of date, so force a rescan next time
+        settled = plan.fp.stat().st_mtime_ns == plan.mtime_ns
+        changed = self.write_repodata(plan.fp, build_repodata(plan.subdir, plan.records))
+        mtime_ns = plan.mtime_ns
+        if not settled:
+            mtime_ns = None
+        elif changed:
+            # writing repodata.json bumps the mtime itself
+            mtime_ns = plan.fp.stat().st_mtime_ns
+
+        subdir_state['files'] = plan.files
+        subdir_state['mtime_ns'] = self.trusted_mtime(mtime_ns)
+
+        return changed
+
+    def trusted_mtime(self, mtime_ns):
+        if mtime_ns is None or time.time_ns() - mtime_ns < self.racy_ns:
+            return None
+        return mtime_ns
+
+    def write_repodata(self, subdir_fp, repodata):
+        repodata_fp = subdir_fp / 'repodata.json'
+        data = dump_repodata(repodata)
+        try:
+            unchanged = repodata_fp.read_bytes() == data
+        except FileNotFoundError:
+            unchanged = False
+        if unchanged and all((subdir_fp / fn).exists() for fn in VARIANT_FNS):
+            return False
+
+        # `repodata.json` goes last: if anything fails part way through, it
+        # won't match next time around, and every variant will be redone
+        write_repodata_variants(subdir_fp, repodata, data)
+        write_atomic(repodata_fp, data)
+        for fn in STALE_FNS:
+            (subdir_fp / fn).unlink(missing_ok=True)
+        return True
+
+
+@dataclasses.dataclass
+class ReindexResult:
+    ticket: int
+    ran: bool
+    merged: int = 0
+    changed: list = dataclasses.field(default_factory=list)
+
+
+class ReindexCoordinator:
+    """Collapse and serialize reindex requests for a single channel.
+
+    Every request takes a ticket from a counter in `<channel>/.reindex.json`,
+    and runs are serialized by an exclusive lock on `<channel>/.reindex.lock`.
+    A run covers every ticket issued before it started, so a request that was
+    waiting on the lock while such a run finished has nothing left to do.
+    Both files are `flock`ed, which is enough since every channel lives on
+    the local disk of the `packages` worker.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, channel):
+        self.channel = pathlib.Path(channel)
+        self.lock_fp = self.channel / '.reindex.lock'
+        self.state_fp = self.channel / '.reindex.json'
+
+    @contextlib.contextmanager
+    def locked(self, fp, timeout=None):
+        self.channel.mkdir(parents=True, exist_ok=True)
+        fd = os.open(fp, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise ReindexTimeoutException('Timed out waiting on %s' % (fp,))
+                    time.sleep(self.poll_interval)
+            yield fd
+        finally:
+            # closing the descriptor drops the lock
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def state(self):
+        with self.locked(self.state_fp) as fd:
+            raw = os.read(fd, os.fstat(fd).st_size)
+            state = json.loads(raw) if raw else {'requested': 0, 'completed': 0}
+            yield state
+            data = json.dumps(state).encode('utf-8')
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, data)
+
+    def request(self):
+        with self.state() as state:
+            state['requested'] += 1
+            return state['requested']
+
+    def completed(self):
+        with self.state() as state:
+            return state['completed']
+
+    def wait(self, ticket, timeout=None):
+        """Block until a run covering `ticket` has finished."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.completed() < ticket:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise ReindexTimeoutException('Timed out waiting on ticket %d for %s' % (ticket, self.channel))
+            time.sleep(self.poll_interval)
+
+    def run(self, ticket, index, timeout=None):
+        with self.locked(self.lock_fp, timeout):
+            with self.state() as state:
+                if state['completed'] >= ticket:
+                    return ReindexResult(ticket=ticket, ran=False)
+                target = state['requested']
+
+            # if this raises, nothing is marked complete, and every request
+            # still waiting will take its own turn
+            changed = index()
+
+            with self.state() as state:
+                merged = target - state['completed'] - 1
+                state['completed'] = target
+
+        return ReindexResult(ticket=ticket, ran=True, merged=merged, changed=changed)
+
+    def reindex(self, index, timeout=None):
+        return self.run(self.request(), index, timeout)
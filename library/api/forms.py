@@ -7,12 +7,16 @@
 # ----------------------------------------------------------------------------
 
 from django import forms, conf
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
 
 from .tasks import DistroBuildCfg
 from ..packages.models import Package, Epoch
 
 
+# a whole CI matrix's worth, with room to spare
+MAX_BULK_BUILDS = 200
+
+
 class PackageIntegrationForm(forms.Form):
     token = forms.UUIDField(required=True)
     run_id = forms.CharField(required=True)
@@ -28,23 +32,76 @@ class PackageIntegrationForm(forms.Form):
             build_target = self.cleaned_data['build_target']
             build_target = build_target if build_target != '' else 'dev'
 
-            config = {
-                'version': self.cleaned_data['version'],
-                'run_id': self.cleaned_data['run_id'],
-                'package_name': self.cleaned_data['package_name'],
-                'repository': self.cleaned_data['repository'],
-                'artifact_name': self.cleaned_data['artifact_name'],
-                'github_token': conf.settings.GITHUB_TOKEN,
-                'build_target': build_target,
-                'epoch_names': Epoch.objects.by_build_target(build_target).values_list('name', flat=True),
-                'package_token': str(self.cleaned_data['token']),
-            }
+            config = package_build_config(
+                self.cleaned_data, build_target,
+                Epoch.objects.by_build_target(build_target).values_list('name', flat=True))
         except Package.DoesNotExist:
             config = None
 
         return config
 
 
+def package_build_config(cleaned_data, build_target, epoch_names):
+    return {
+        'version': cleaned_data['version'],
+        'run_id': cleaned_data['run_id'],
+        'package_name': cleaned_data['package_name'],
+        'repository': cleaned_data['repository'],
+        'artifact_name': cleaned_data['artifact_name'],
+        'github_token': conf.settings.GITHUB_TOKEN,
+        'build_target': build_target,
+        'epoch_names': epoch_names,
+        'package_token': str(cleaned_data['token']),
+    }
+
+
+class BulkPackageIntegrationForm(forms.Form):
+    # a JSON list of `PackageIntegrationForm`'s fields, one per artifact
+    builds = forms.JSONField(required=True)
+
+    def clean_builds(self):
+        builds = self.cleaned_data['builds']
+        if not isinstance(builds, list) or len(builds) == 0:
+            raise ValidationError('expected a list of package builds')
+        if len(builds) > MAX_BULK_BUILDS:
+            raise ValidationError('at most %d package builds per request' % (MAX_BULK_BUILDS,))
+
+        cleaned, errors = [], []
+        for i, build in enumerate(builds):
+            form = PackageIntegrationForm(build if isinstance(build, dict) else {})
+            if form.is_valid():
+                cleaned.append(form.cleaned_data)
+            for field, messages in form.errors.items():
+                errors.append('%d.%s: %s' % (i, field, ' '.join(messages)))
+
+        if errors:
+            raise ValidationError(errors)
+
+        return cleaned
+
+    def is_known(self):
+        """A config per build, or `None` where the token is unknown.
+
+        One query for all of the packages and one for all of the epochs,
+        however many builds there are.
+        """
+        builds = self.cleaned_data['builds']
+        for build in builds:
+            build['build_target'] = build['build_target'] if build['build_target'] != '' else 'dev'
+
+        known_tokens = set(Package.objects.filter(
+            token__in={build['token'] for build in builds}).values_list('token', flat=True))
+
+        build_targets = {build['build_target'] for build in builds}
+        epochs = list(Epoch.objects.by_build_targets(build_targets).values_list('name', 'is_dev'))
+        epoch_names = {build_target: [name for name, is_dev in epochs if is_dev == (build_target.lower() == 'dev')]
+                       for build_target in build_targets}
+
+        return [package_build_config(build, build['build_target'], epoch_names[build['build_target']])
+                if build['token'] in known_tokens else None
+                for build in builds]
+
+
 class DistroIntegrationForm(forms.Form):
     token = forms.CharField(required=True)
     version = forms.CharField(required=True)
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.9 on 2021-11-24 16:20
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineConfig',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('cfg_type', models.CharField(max_length=50, verbose_name='Config Type')),
+                ('data', models.JSONField()),
+            ],
+            options={
+                'verbose_name': 'Pipeline Config',
+            },
+        ),
+    ]
@@ -0,0 +1,121 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import dataclasses
+import datetime
+import hashlib
+import uuid
+
+from django.db import models
+from django.utils import timezone
+
+from library.utils.models import AuditModel
+
+
+def intake_key(*fields):
+    """Hash a webhook's identifying fields, e.g. `(token, run_id, artifact_name, version)`."""
+    return hashlib.blake2b('\0'.join(str(field) for field in fields).encode('utf-8'), digest_size=32).hexdigest()
+
+
+# ### CUSTOM QUERYSETS
+
+class PipelineConfigQuerySet(models.QuerySet):
+    def _record(self, cfg):
+        data = dataclasses.asdict(cfg)
+        # never written down, it travels in each task's `CfgRef` instead
+        data.pop('github_token')
+        return self.model(cfg_type=type(cfg).__name__, data=data)
+
+    def store(self, cfg):
+        record = self._record(cfg)
+        record.save(force_insert=True)
+        return str(record.pk)
+
+    def store_many(self, cfgs):
+        # a single insert, however many cfgs
+        return [str(record.pk) for record in self.bulk_create([self._record(cfg) for cfg in cfgs])]
+
+    def load(self, pk):
+        from config.celery import task_types
+
+        record = self.get(pk=pk)
+        return task_types()[record.cfg_type](github_token='', **record.data)
+
+
+class IntakeRequestQuerySet(models.QuerySet):
+    def _claimable(self, window):
+        # a pipeline launched more than a window ago is fair game for a rerun
+        expired = timezone.now() - datetime.timedelta(seconds=window)
+        return models.Q(claimed_at__isnull=True) | models.Q(claimed_at__lt=expired)
+
+    def claim(self, key, window):
+        """Claim `key` for a new pipeline, unless it was claimed in the last `window` seconds.
+
+        Returns `(record, claimed)`. An unclaimed request is a duplicate, and
+        is counted as a hit: `record.pipeline_id` is the in-flight pipeline
+        (empty while that one is still being launched).
+        """
+        now = timezone.now()
+        record, created = self.get_or_create(key=key, defaults={'claimed_at': now, 'misses': 1})
+        if created:
+            return record, True
+
+        claimed = self.filter(self._claimable(window), pk=record.pk).update(
+            claimed_at=now, pipeline_id='', misses=models.F('misses') + 1)
+        if not claimed:
+            self.filter(pk=record.pk).update(hits=models.F('hits') + 1)
+
+        record.refresh_from_db()
+        return record, bool(claimed)
+
+    def launched(self, records, pipeline_id):
+        self.filter(pk__in=[record.pk for record in records]).update(pipeline_id=pipeline_id)
+
+    def release(self, records):
+        # the launch fell over, so let the next retry through
+        self.filter(pk__in=[record.pk for record in records]).update(claimed_at=None)
+
+
+# ### BASE MODELS
+
+class PipelineConfig(AuditModel):
+    # a pipeline's frozen cfg, stored once so that the tasks in its chain can
+    # pass around a `CfgRef` instead of the whole thing
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    cfg_type = models.CharField(max_length=50, verbose_name='Config Type')
+    data = models.JSONField()
+
+    # Custom Manager
+    objects = PipelineConfigQuerySet.as_manager()
+
+    def __str__(self):
+        return 'PipelineConfig<%s, pk=%s>' % (self.cfg_type, self.pk)
+
+    class Meta:
+        verbose_name = 'Pipeline Config'
+
+
+class IntakeRequest(AuditModel):
+    # one per distinct integration request, so that reruns and retries of the
+    # same upload don't each launch a pipeline
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    key = models.CharField(max_length=64, unique=True, verbose_name='Request Key')
+    claimed_at = models.DateTimeField(null=True, blank=True, verbose_name='Claimed At')
+    pipeline_id = models.CharField(max_length=255, blank=True, default='', verbose_name='Pipeline ID')
+    # duplicates turned away, and pipelines launched
+    hits = models.PositiveIntegerField(default=0)
+    misses = models.PositiveIntegerField(default=0)
+
+    # Custom Manager
+    objects = IntakeRequestQuerySet.as_manager()
+
+    def __str__(self):
+        return 'IntakeRequest<pipeline_id=%s, hits=%d, misses=%d>' % (self.pipeline_id, self.hits, self.misses)
+
+    class Meta:
+        verbose_name = 'Intake Request'
@@ -6,7 +6,9 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import collections
 from dataclasses import dataclass, field
+import time
 from typing import List, Dict, Optional
 
 from celery import chain, group, shared_task
@@ -14,6 +16,7 @@ from celery.utils.log import get_task_logger
 from django import conf
 
 from . import db, git, packages
+from ..models import PipelineConfig
 from library.packages.models import Epoch
 
 
@@ -29,7 +32,10 @@ logger = get_task_logger(__name__)
 # 4. All tasks that interact directly with the database must run in `db` queue.
 # 5. All tasks that interact with packages.qiime2.org must run in the `packages` queue.
 # 6. If a task generates a lot of noisy results that aren't important, make sure to
-#    add it to `db.clean_up_reindex_tasks`.
+#    add it to `db.EPHEMERAL_RESULT_TASK_NAMES`.
+# 7. Only the last task in a chain should store a result: give every other link
+#    `base=utils.PipelineLinkTask` (or `.set(ignore_result=True)` on the
+#    signature, when the task ends some other chain).
 
 @dataclass(frozen=True)
 class BuildCfg:
@@ -80,10 +86,25 @@ class DistroBuildCfg(BuildCfg):
         object.__setattr__(self, 'pr_url', pr_url)
 
 
+@dataclass(frozen=True)
+class CfgRef:
+    # stands in for a cfg stored in `PipelineConfig`, so that every link in a
+    # chain doesn't carry (and record) a full copy of it --- tasks taking a
+    # cfg accept either, see `utils.resolves_cfg`. The token is never written
+    # down, so it rides along in the message instead.
+    pk: str
+    github_token: str = ''
+
+
 @dataclass
 class PackageBuildCtx:
     pk: Optional[str] = None
     not_all_architectures_present: bool = True
+    # unix time the webhook was handled, to measure how long indexing takes
+    received_at: Optional[float] = None
+    # the chain's stored cfgs (without their token) by `CfgRef.pk`, as loaded
+    # by its first `db` link, so that no other queue reads the database
+    cfgs: Dict[str, BuildCfg] = field(default_factory=dict)
 
 
 @dataclass
@@ -91,6 +112,22 @@ class DistroBuildCtx:
     pk: Optional[str] = None
     not_all_architectures_present: bool = True
     pkg_fns: List[str] = field(default_factory=list)
+    received_at: Optional[float] = None
+    cfgs: Dict[str, BuildCfg] = field(default_factory=dict)
+
+
+@dataclass
+class BulkPackageBuildCtx:
+    # one entry per artifact, lined up with the pipeline's list of cfgs
+    pks: List[str] = field(default_factory=list)
+    all_architectures_present: List[bool] = field(default_factory=list)
+    # artifacts that never showed up or couldn't be fetched, which the rest of
+    # the pipeline leaves out rather than failing everyone else's packages
+    skipped: List[bool] = field(default_factory=list)
+    # artifacts already extracted into the channel, so a retry skips them
+    fetched: List[bool] = field(default_factory=list)
+    received_at: Optional[float] = None
+    cfgs: Dict[str, BuildCfg] = field(default_factory=dict)
 
 
 @dataclass
@@ -111,22 +148,38 @@ class HandlePRsCtx:
         return len(self.distro_build_pks) and self.pr_url
 
 
-@shared_task(name='pipeline.handle_prs')
+def integration_chain(epoch_name):
+    ctx = HandlePRsCtx(epoch_name=epoch_name, github_token=conf.settings.GITHUB_TOKEN)
+    return chain(
+        db.find_packages_ready_for_integration.s(ctx),
+        git.open_pull_request.s(),
+        db.update_distro_build_records_integration_pr_url.s(),
+    )
+
+
+@shared_task(name='pipeline.integrate_epoch', ignore_result=True)
+def integrate_epoch(epoch_id):
+    # scheduled by `db.verify_all_architectures_present`, once per debounce
+    # window. Release the trigger before looking for builds, so anything that
+    # becomes ready from here on schedules the next run.
+    epoch = Epoch.objects.get(pk=epoch_id)
+    Epoch.objects.filter(pk=epoch_id).update(integration_scheduled_at=None)
+    return integration_chain(epoch.name).apply_async()
+
+
+@shared_task(name='pipeline.handle_prs', ignore_result=True)
 def handle_prs():
+    # a safety net for `pipeline.integrate_epoch`, so leave alone any epoch
+    # that already has a run on the way
+    window = conf.settings.INTEGRATION_DEBOUNCE_WINDOW
     chains = []
     for build_target in ['dev', 'release']:
-        for epoch in Epoch.objects.by_build_target(build_target):
-            ctx = HandlePRsCtx(epoch_name=epoch.name, github_token=conf.settings.GITHUB_TOKEN)
-            chain_link = chain(
-                db.find_packages_ready_for_integration.s(ctx),
-                git.open_pull_request.s(),
-                db.update_distro_build_records_integration_pr_url.s(),
-            )
-            chains.append(chain_link)
+        for epoch in Epoch.objects.by_build_target(build_target).without_pending_integration(window):
+            chains.append(integration_chain(epoch.name))
     return group(*chains).apply_async()
 
 
-@shared_task(name='pipeline.reindex_conda_channels')
+@shared_task(name='pipeline.reindex_conda_channels', ignore_result=True)
 def reindex_conda_channels():
     tasks = []
     for build_target in ['dev', 'release']:
@@ -154,57 +207,101 @@ def handle_new_package_build(initial_data):
     chains = []
     epoch_names = initial_data.pop('epoch_names')
     for epoch_name in epoch_names:
-        ctx = PackageBuildCtx()
+        ctx = PackageBuildCtx(received_at=time.time())
         cfg = PackageBuildCfg(epoch_name=epoch_name, **initial_data)
+        cfg_ref = CfgRef(PipelineConfig.objects.store(cfg), cfg.github_token)
+
+        chain_link = chain(
+            # explicitly pass ctx into the first subtask in the chain
+            db.create_package_build_record_and_update_package.s(ctx, cfg_ref),
+            # ctx is implicitly applied as first arg for every other subtask in the chain
+            packages.wait_for_artifact.s(cfg_ref),
+            packages.fetch_package_from_github.s(cfg_ref),
+            packages.reindex_conda_channel.s(
+                cfg.to_channel, '%s-%s' % (cfg.epoch_name, conf.settings.GATE_TESTED),
+            ).set(ignore_result=True),
+            db.mark_uploaded_package.s(cfg_ref),
+            db.verify_all_architectures_present.s(cfg_ref),
+            git.update_conda_build_config.s(cfg_ref),
+        )
+        chains.append(chain_link)
+
+    return group(*chains).apply_async()
+
+
+@shared_task(name='pipeline.handle_new_bulk_builds')
+def handle_new_package_builds(initial_data_list):
+    # one chain per epoch covering every artifact in the request, so that they
+    # share each run's artifact listing, the channel reindex and a single
+    # conda_build_config commit
+    epoch_cfgs = collections.defaultdict(list)
+    for initial_data in initial_data_list:
+        initial_data = dict(initial_data)
+        for epoch_name in initial_data.pop('epoch_names'):
+            epoch_cfgs[epoch_name].append(PackageBuildCfg(epoch_name=epoch_name, **initial_data))
+
+    pks = iter(PipelineConfig.objects.store_many([cfg for cfgs in epoch_cfgs.values() for cfg in cfgs]))
+
+    chains = []
+    for epoch_name, cfgs in epoch_cfgs.items():
+        ctx = BulkPackageBuildCtx(received_at=time.time())
+        cfg_refs = [CfgRef(next(pks), cfg.github_token) for cfg in cfgs]
 
         chain_link = chain(
             # explicitly pass ctx into the first subtask in the chain
-            db.create_package_build_record_and_update_package.s(ctx, cfg),
+            db.create_package_build_records.s(ctx, cfg_refs),
             # ctx is implicitly applied as first arg for every other subtask in the chain
-            packages.fetch_package_from_github.s(cfg),
-            packages.reindex_conda_channel.s(cfg.to_channel, '%s-%s' % (cfg.epoch_name, conf.settings.GATE_TESTED)),
-            db.mark_uploaded_package.s(cfg),
-            db.verify_all_architectures_present.s(cfg),
-            git.update_conda_build_config.s(cfg),
+            packages.wait_for_artifacts.s(cfg_refs),
+            packages.fetch_packages_from_github.s(cfg_refs),
+            packages.reindex_conda_channel.s(
+                cfgs[0].to_channel, '%s-%s' % (epoch_name, conf.settings.GATE_TESTED),
+            ).set(ignore_result=True),
+            db.mark_uploaded_packages.s(cfg_refs),
+            db.verify_all_package_architectures_present.s(cfg_refs),
+            git.update_conda_build_configs.s(cfg_refs),
         )
         chains.append(chain_link)
 
-    return group(*chains).apply_async(countdown=conf.settings.TASK_TIMES['10_MIN'])
+    return group(*chains).apply_async()
 
 
 @shared_task(name='pipeline.handle_new_distro_build')
 def handle_new_distro_build(cfg: DistroBuildCfg):
-    ctx = DistroBuildCtx()
+    ctx = DistroBuildCtx(received_at=time.time())
+    cfg_ref = CfgRef(PipelineConfig.objects.store(cfg), cfg.github_token)
     tasks = chain(
         # explicitly pass ctx into the first subtask in the chain
-        db.get_or_create_and_update_distro_build_record.s(ctx, cfg),
+        db.get_or_create_and_update_distro_build_record.s(ctx, cfg_ref),
         # ctx is implicitly applied as first arg for every other subtask in the chain
-        packages.fetch_package_from_github.s(cfg),
-        db.mark_distro_gate.s(cfg),
-        db.verify_all_architectures_present.s(cfg),
-        packages.find_packages_to_copy.s(cfg),
-        packages.copy_conda_packages.s(cfg),
-        packages.reindex_conda_channel.s(cfg.to_channel, '%s-%s-%s' %
-                                         (cfg.epoch_name, cfg.distro_name, conf.settings.GATE_STAGED)),
-        git.merge_integration_pr.s(cfg),
+        packages.wait_for_artifact.s(cfg_ref),
+        packages.fetch_package_from_github.s(cfg_ref),
+        db.mark_distro_gate.s(cfg_ref),
+        db.verify_all_architectures_present.s(cfg_ref),
+        packages.find_packages_to_copy.s(cfg_ref),
+        packages.copy_conda_packages.s(cfg_ref),
+        packages.reindex_conda_channel.s(
+            cfg.to_channel, '%s-%s-%s' % (cfg.epoch_name, cfg.distro_name, conf.settings.GATE_STAGED),
+        ).set(ignore_result=True),
+        git.merge_integration_pr.s(cfg_ref),
     )
 
-    return tasks.apply_async(countdown=conf.settings.TASK_TIMES['10_MIN'])
+    return tasks.apply_async()
 
 
 @shared_task(name='pipeline.handle_passed_distro_build')
 def handle_passed_distro_build(cfg: DistroBuildCfg):
-    ctx = DistroBuildCtx()
+    ctx = DistroBuildCtx(received_at=time.time())
+    cfg_ref = CfgRef(PipelineConfig.objects.store(cfg), cfg.github_token)
     tasks = chain(
         # explicitly pass ctx into the first subtask in the chain
-        db.get_or_create_and_update_distro_build_record.s(ctx, cfg),
+        db.get_or_create_and_update_distro_build_record.s(ctx, cfg_ref),
         # ctx is implicitly applied as first arg for every other subtask in the chain
-        db.mark_distro_gate.s(cfg),
-        db.verify_all_architectures_present.s(cfg),
-        packages.find_packages_to_copy.s(cfg),
-        packages.copy_conda_packages.s(cfg),
+        db.mark_distro_gate.s(cfg_ref),
+        db.verify_all_architectures_present.s(cfg_ref),
+        packages.find_packages_to_copy.s(cfg_ref),
+        packages.copy_conda_packages.s(cfg_ref),
         packages.reindex_conda_channel.s(cfg.to_channel, '%s-%s-%s' %
                                          (cfg.epoch_name, cfg.distro_name, conf.settings.GATE_PASSED)),
     )
 
-    return tasks.apply_async(countdown=conf.settings.TASK_TIMES['10_MIN'])
+    return tasks.apply_async()
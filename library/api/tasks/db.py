@@ -6,32 +6,68 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import collections
 import datetime
-from typing import Union
+import time
+from typing import List, Union
+import uuid
 
-from celery import shared_task
+from celery import shared_task, signature
+from celery.utils.log import get_task_logger
 from django_celery_results.models import TaskResult
 from django.db import transaction
+from django.db.models import Q
 from django import conf
 from django.utils import timezone
 
 from .. import utils
-from library.packages.models import Package, PackageBuild, Distro, DistroBuild, Epoch
+from ..models import IntakeRequest, PipelineConfig
+from library.packages.models import Package, PackageBuild, Distro, DistroBuild, Epoch, ThroughDistroBuildPackageBuild
+
+
+logger = get_task_logger(__name__)
+
+
+# periodic and polling tasks whose results pile up without telling anyone
+# anything, so they are cleared out once they expire
+EPHEMERAL_RESULT_TASK_NAMES = [
+    'db.celery_backend_cleanup',
+    'packages.collect_package_blobs',
+    'packages.reindex_conda_channel',
+    'packages.wait_for_artifact',
+    'pipeline.handle_prs',
+    'pipeline.reindex_conda_channels',
+]
 
 
 @shared_task(name='db.celery_backend_cleanup')
 def celery_backend_cleanup():
-    with transaction.atomic():
-        TaskResult.objects.filter(
-            date_done__lt=timezone.now() - datetime.timedelta(seconds=conf.settings.CELERY_RESULT_EXPIRES),
-            task_name__in=[
-                'packages.reindex_conda_server',
-                'packages.celery_backend_cleanup',
-            ],
-        ).delete()
+    expired = TaskResult.objects.filter(
+        date_done__lt=timezone.now() - datetime.timedelta(seconds=conf.settings.CELERY_RESULT_EXPIRES),
+        task_name__in=EPHEMERAL_RESULT_TASK_NAMES,
+    )
+
+    # many short deletes rather than one huge one, so that no single
+    # transaction holds its locks (or its WAL) for long
+    deleted = 0
+    while pks := list(expired.order_by('date_done').values_list('pk', flat=True)[:conf.settings.RESULT_CLEANUP_BATCH]):
+        with transaction.atomic():
+            batch_deleted, _ = TaskResult.objects.filter(pk__in=pks).delete()
+        deleted += batch_deleted
+        logger.info('deleted %d expired task results so far', deleted)
+        time.sleep(conf.settings.RESULT_CLEANUP_PAUSE)
+
+    # long after any chain that could still be retrying has given up
+    config_expired = timezone.now() - datetime.timedelta(seconds=conf.settings.PIPELINE_CONFIG_EXPIRES)
+    PipelineConfig.objects.filter(created_at__lt=config_expired).delete()
+    IntakeRequest.objects.filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=config_expired),
+                                 created_at__lt=config_expired).delete()
 
+    return deleted
 
-@shared_task(name='db.create_package_build_record_and_update_package')
+
+@shared_task(name='db.create_package_build_record_and_update_package', base=utils.PipelineLinkTask)
+@utils.resolves_cfg(load=True)
 def create_package_build_record_and_update_package(ctx: 'PackageBuildCtx',  # noqa: F821
                                                    cfg: 'PackageBuildCfg'):  # noqa: F821
     package_record = Package.objects.get(token=cfg.package_token)
@@ -54,7 +90,72 @@ def create_package_build_record_and_update_package(ctx: 'PackageBuildCtx',  # no
     return ctx
 
 
-@shared_task(name='db.mark_uploaded_package')
+@shared_task(name='db.create_package_build_records', base=utils.PipelineLinkTask)
+@utils.resolves_cfg(load=True)
+def create_package_build_records(ctx: 'BulkPackageBuildCtx', cfgs: List['PackageBuildCfg']):  # noqa: F821
+    # every cfg in a bulk pipeline is for the same epoch
+    epoch_record = Epoch.objects.get(name=cfgs[0].epoch_name)
+    package_records = {str(package.token): package
+                       for package in Package.objects.filter(token__in={cfg.package_token for cfg in cfgs})}
+
+    for cfg in cfgs:
+        package_record = package_records[cfg.package_token]
+        package_record.name = cfg.package_name
+        package_record.repository = cfg.repository
+    Package.objects.bulk_update(package_records.values(), ['name', 'repository'])
+
+    ctx.skipped = [False] * len(cfgs)
+    ctx.fetched = [False] * len(cfgs)
+    ctx.pks = []
+    for cfg in cfgs:
+        package_build_record, _ = PackageBuild.objects.get_or_create(
+            package=package_records[cfg.package_token],
+            github_run_id=cfg.run_id,
+            version=cfg.version,
+            epoch=epoch_record,
+            build_target=cfg.build_target,
+        )
+        ctx.pks.append(str(package_build_record.pk))
+
+    return ctx
+
+
+@shared_task(name='db.mark_uploaded_packages', base=utils.PipelineLinkTask)
+@utils.resolves_cfg
+def mark_uploaded_packages(ctx: 'BulkPackageBuildCtx', cfgs: List['PackageBuildCfg']):  # noqa: F821
+    uploaded = collections.defaultdict(set)
+    for pk, cfg, skipped in zip(ctx.pks, cfgs, ctx.skipped):
+        if skipped:
+            continue
+        if cfg.artifact_name not in ('linux-64', 'osx-64'):
+            raise Exception('unknown build type')
+        uploaded[cfg.artifact_name.replace('-', '_')].add(pk)
+
+    # one update per architecture, touching only that flag, so a build's other
+    # architecture arriving concurrently isn't written over
+    with transaction.atomic():
+        for attr, pks in uploaded.items():
+            PackageBuild.objects.filter(pk__in=pks).update(**{attr: True})
+
+    return ctx
+
+
+@shared_task(name='db.verify_all_package_architectures_present', base=utils.PipelineLinkTask)
+@utils.resolves_cfg
+def verify_all_package_architectures_present(ctx: 'BulkPackageBuildCtx',  # noqa: F821
+                                             cfgs: List['PackageBuildCfg']):  # noqa: F821
+    build_records = PackageBuild.objects.in_bulk(ctx.pks)
+    ctx.all_architectures_present = [build_records[uuid.UUID(pk)].verify_gate(cfg.gate)
+                                     for pk, cfg in zip(ctx.pks, cfgs)]
+
+    if any(ctx.all_architectures_present):
+        schedule_integration(next(iter(build_records.values())).epoch_id)
+
+    return ctx
+
+
+@shared_task(name='db.mark_uploaded_package', base=utils.PipelineLinkTask)
+@utils.resolves_cfg
 def mark_uploaded_package(ctx: 'PackageBuildCtx', cfg: 'PackageBuildCfg'):  # noqa: F821
     package_build_record = PackageBuild.objects.get(pk=ctx.pk)
 
@@ -68,7 +169,8 @@ def mark_uploaded_package(ctx: 'PackageBuildCtx', cfg: 'PackageBuildCfg'):  # no
     return ctx
 
 
-@shared_task(name='db.mark_distro_gate')
+@shared_task(name='db.mark_distro_gate', base=utils.PipelineLinkTask)
+@utils.resolves_cfg
 def mark_distro_gate(ctx: 'DistroBuildCtx', cfg: 'DistroBuildCfg'):  # noqa: F821
     distro_build_record = DistroBuild.objects.get(pk=ctx.pk)
     distro_build_record.mark_gate(cfg.gate, cfg.artifact_name)
@@ -77,7 +179,8 @@ def mark_distro_gate(ctx: 'DistroBuildCtx', cfg: 'DistroBuildCfg'):  # noqa: F82
     return ctx
 
 
-@shared_task(name='db.verify_all_architectures_present')
+@shared_task(name='db.verify_all_architectures_present', base=utils.PipelineLinkTask)
+@utils.resolves_cfg
 def verify_all_architectures_present(ctx: Union['PackageBuildCtx',  # noqa: F821
                                                 'DistroBuildCtx'],  # noqa: F821
                                      cfg: Union['PackageBuildCfg',  # noqa: F821
@@ -92,36 +195,52 @@ def verify_all_architectures_present(ctx: Union['PackageBuildCtx',  # noqa: F821
         # I know, double-negative is weird here...
         ctx.not_all_architectures_present = False
 
+        if model is PackageBuild:
+            schedule_integration(build_record.epoch_id)
+
     return ctx
 
 
-@shared_task(name='db.find_packages_ready_for_integration')
+def schedule_integration(epoch_id):
+    # builds that become ready within one window share a single integration run
+    eta = Epoch.objects.schedule_integration(epoch_id, conf.settings.INTEGRATION_DEBOUNCE_WINDOW)
+    if eta is not None:
+        # by name, because the pipeline module imports this one
+        signature('pipeline.integrate_epoch', args=(str(epoch_id),)).apply_async(eta=eta)
+
+
+@shared_task(name='db.find_packages_ready_for_integration', base=utils.PipelineLinkTask)
 def find_packages_ready_for_integration(ctx: 'HandlePRsCtx'):  # noqa: F821
-    package_builds = dict()
+    package_builds = collections.defaultdict(list)
+    distro_ids = dict()
     distro_build_pks = dict()
 
     epoch = Epoch.objects.get(name=ctx.epoch_name)
 
-    for distro in Distro.objects.all():
-        package_build_records = PackageBuild.objects.ready_for_integration(ctx.epoch_name, distro)
-        package_build_records = list(package_build_records)
-        if len(package_build_records) > 0:
-            ctx.version = datetime.datetime.utcnow().strftime('%Y.%m.%d.%H.%M.%S')
-            distro_build_record, _ = DistroBuild.objects.get_or_create(
-                distro=distro,
-                epoch=epoch,
-                pr_url='',
-                version=ctx.version,
-            )
-            distro_build_record.save()
-            pbrs = [r['id'] for r in package_build_records]
-            distro_build_record.package_builds.set(pbrs)
-
-            package_builds[distro.name] = package_build_records
-            distro_build_pks[distro.name] = str(distro_build_record.pk)
+    for record in PackageBuild.objects.ready_for_integration_by_distro(ctx.epoch_name):
+        package_builds[record['distro_name']].append(record)
+        distro_ids[record['distro_name']] = record['distro_id']
+
+    if package_builds:
+        # one version for every distro build opened by this run
+        ctx.version = datetime.datetime.utcnow().strftime('%Y.%m.%d.%H.%M.%S')
+        distro_build_records = {
+            distro_name: DistroBuild(distro_id=distro_id, epoch=epoch, pr_url='', version=ctx.version)
+            for distro_name, distro_id in distro_ids.items()
+        }
+        with transaction.atomic():
+            DistroBuild.objects.bulk_create(distro_build_records.values())
+            ThroughDistroBuildPackageBuild.objects.bulk_create([
+                ThroughDistroBuildPackageBuild(distro_build=distro_build_records[distro_name],
+                                               package_build_id=record['id'])
+                for distro_name, records in package_builds.items()
+                for record in records
+            ])
+
+        distro_build_pks = {distro_name: str(record.pk) for distro_name, record in distro_build_records.items()}
 
     package_versions, package_build_pks = utils.find_packages_ready_for_integration(
-        package_builds)
+        dict(package_builds))
 
     ctx.package_versions = package_versions
     ctx.package_build_pks = list(package_build_pks)
@@ -147,7 +266,8 @@ def update_distro_build_records_integration_pr_url(ctx: 'HandlePRsCtx'):  # noqa
     return ctx
 
 
-@shared_task(name='db.update_distro_build_record')
+@shared_task(name='db.update_distro_build_record', base=utils.PipelineLinkTask)
+@utils.resolves_cfg(load=True)
 def get_or_create_and_update_distro_build_record(ctx: 'DistroBuildCtx', cfg: 'DistroBuildCfg'):  # noqa: F821
     # NOTE: it is possible for a PR to be created manually, which means
     # there aren't any specifically associated PackageBuild records, or
@@ -6,6 +6,7 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+from typing import List
 import uuid
 
 from celery import shared_task
@@ -16,23 +17,43 @@ from .. import utils
 
 @shared_task(name='git.update_conda_build_config',
              autoretry_for=[utils.AdvisoryLockNotReadyException],
-             max_retries=12, retry_backoff=conf.settings.TASK_TIMES['03_MIN'],
+             max_retries=12, retry_backoff=conf.settings.TASK_TIMES['30_SEC'],
              retry_backoff_max=conf.settings.TASK_TIMES['02_HR'])
+@utils.resolves_cfg
 def update_conda_build_config(ctx: 'PackageBuildCtx', cfg: 'PackageBuildCfg'):  # noqa: F821
     if ctx.not_all_architectures_present:
         return ctx
 
     # distro doesn't matter here, so skip it by setting to `None`
     package_versions = {None: {cfg.package_name: cfg.version}}
-    mgr = utils.IntegrationGitRepoManager(cfg.github_token)
+    mgr = utils.get_integration_repo_manager(cfg.github_token)
     mgr.update_conda_build_config('main', cfg.epoch_name, cfg.gate, package_versions)
 
     return ctx
 
 
-@shared_task(name='git.open_pull_request',
+@shared_task(name='git.update_conda_build_configs',
+             autoretry_for=[utils.AdvisoryLockNotReadyException],
+             max_retries=12, retry_backoff=conf.settings.TASK_TIMES['30_SEC'],
+             retry_backoff_max=conf.settings.TASK_TIMES['02_HR'])
+@utils.resolves_cfg
+def update_conda_build_configs(ctx: 'BulkPackageBuildCtx', cfgs: List['PackageBuildCfg']):  # noqa: F821
+    package_versions = {cfg.package_name: cfg.version
+                        for cfg, ready, skipped in zip(cfgs, ctx.all_architectures_present, ctx.skipped)
+                        if ready and not skipped}
+    if not package_versions:
+        return ctx
+
+    # every ready package goes into one commit, distro doesn't matter here
+    mgr = utils.get_integration_repo_manager(cfgs[0].github_token)
+    mgr.update_conda_build_config('main', cfgs[0].epoch_name, cfgs[0].gate, {None: package_versions})
+
+    return ctx
+
+
+@shared_task(name='git.open_pull_request', base=utils.PipelineLinkTask,
              autoretry_for=[utils.AdvisoryLockNotReadyException],
-             max_retries=12, retry_backoff=conf.settings.TASK_TIMES['03_MIN'],
+             max_retries=12, retry_backoff=conf.settings.TASK_TIMES['30_SEC'],
              retry_backoff_max=conf.settings.TASK_TIMES['02_HR'])
 def open_pull_request(ctx: 'HandlePRsCtx'):  # noqa: F821
     if not ctx.ready_to_open_pr():
@@ -40,7 +61,7 @@ def open_pull_request(ctx: 'HandlePRsCtx'):  # noqa: F821
 
     branch = str(uuid.uuid4())
     # staged
-    mgr = utils.IntegrationGitRepoManager(ctx.github_token)
+    mgr = utils.get_integration_repo_manager(ctx.github_token)
     mgr.update_integration(branch, ctx.epoch_name, conf.settings.GATE_STAGED, ctx.package_versions, ctx.version)
 
     pr_url = mgr.open_pr(branch, '%s %s' % (ctx.epoch_name, conf.settings.GATE_STAGED))
@@ -51,8 +72,9 @@ def open_pull_request(ctx: 'HandlePRsCtx'):  # noqa: F821
 
 @shared_task(name='git.merge_integration_pr',
              autoretry_for=[utils.AdvisoryLockNotReadyException],
-             max_retries=12, retry_backoff=conf.settings.TASK_TIMES['03_MIN'],
+             max_retries=12, retry_backoff=conf.settings.TASK_TIMES['30_SEC'],
              retry_backoff_max=conf.settings.TASK_TIMES['02_HR'])
+@utils.resolves_cfg
 def merge_integration_pr(ctx: 'DistroBuildCtx', cfg: 'DistroBuildCfg'):  # noqa: F821
     if ctx.not_all_architectures_present:
         return ctx
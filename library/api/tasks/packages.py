@@ -6,79 +6,236 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import collections
 import pathlib
-import shutil
 import tempfile
-from typing import Union
+import time
+from typing import List, Union
 import urllib.error
 
 from celery import shared_task
-import conda_build.api
+from celery.utils.log import get_task_logger
 from django import conf
 
-from .. import utils
+from .. import channels, utils
 
 
-@shared_task(name='packages.fetch_package_from_github',
+logger = get_task_logger(__name__)
+
+
+@shared_task(name='packages.wait_for_artifact', base=utils.PipelineLinkTask,
              autoretry_for=[urllib.error.HTTPError, urllib.error.URLError, utils.GitHubNotReadyException],
+             max_retries=30, retry_backoff=conf.settings.TASK_TIMES['05_SEC'],
+             retry_backoff_max=conf.settings.TASK_TIMES['03_MIN'], retry_jitter=True)
+@utils.resolves_cfg
+def wait_for_artifact(ctx: Union['PackageBuildCtx', 'DistroBuildCtx'], cfg: 'BuildCfg'):  # noqa: F821
+    # the webhook usually beats the artifact upload by a little while, so poll
+    # the listing on a short schedule rather than sitting out a fixed delay
+    mgr = utils.GitHubArtifactManager(cfg.github_token, cfg.repository, cfg.run_id, cfg.artifact_name,
+                                      conf.settings.ARTIFACT_DOWNLOAD_PATH, http_pool=utils.get_http_pool())
+    mgr.probe()
+
+    return ctx
+
+
+@shared_task(name='packages.fetch_package_from_github', base=utils.PipelineLinkTask,
+             autoretry_for=[urllib.error.HTTPError, urllib.error.URLError, utils.GitHubNotReadyException,
+                            utils.ArtifactDigestException],
              max_retries=12, retry_backoff=conf.settings.TASK_TIMES['03_MIN'],
              retry_backoff_max=conf.settings.TASK_TIMES['90_MIN'])
+@utils.resolves_cfg
 def fetch_package_from_github(ctx: Union['PackageBuildCtx', 'DistroBuildCtx'], cfg: 'BuildCfg'):  # noqa: F821
     with tempfile.TemporaryDirectory() as tmpdir:
         tmp_pathlib = pathlib.Path(tmpdir)
 
-        mgr = utils.GitHubArtifactManager(cfg.github_token, cfg.repository, cfg.run_id, cfg.artifact_name, tmp_pathlib)
-        tmp_filepaths = mgr.sync()
-
-        for filepath in tmp_filepaths:
-            utils.unzip(filepath)
+        mgr = utils.GitHubArtifactManager(cfg.github_token, cfg.repository, cfg.run_id, cfg.artifact_name, tmp_pathlib,
+                                          http_pool=utils.get_http_pool(),
+                                          partial_pathlib=conf.settings.ARTIFACT_DOWNLOAD_PATH)
+        # partial downloads survive in ARTIFACT_DOWNLOAD_PATH, so a retry only
+        # fetches the bytes that are still missing
+        tmp_filepaths = mgr.sync(resume=True)
 
         pkgs_fp = pathlib.Path(cfg.to_channel)
         utils.bootstrap_pkgs_dir(pkgs_fp)
 
-        filematcher = '**/*%s*.tar.bz2' % (cfg.package_name,)
-        for from_path in tmp_pathlib.glob(filematcher):
-            to_path = pkgs_fp / from_path.parent.name / from_path.name
-            shutil.copy(from_path, to_path)
+        store = blob_store()
+        for filepath in tmp_filepaths:
+            for pkg_fp in utils.extract_conda_packages(filepath, cfg.package_name, pkgs_fp):
+                store.ingest(pkg_fp)
+
+    return ctx
+
+
+def artifact_managers_by_run(cfgs, tmpdir, partial_pathlib=None):
+    """Group `(index, cfg, manager)` by the workflow run each cfg was built in, so each run is listed just once."""
+    runs = collections.defaultdict(list)
+    for i, cfg in enumerate(cfgs):
+        mgr = utils.GitHubArtifactManager(cfg.github_token, cfg.repository, cfg.run_id, cfg.artifact_name, tmpdir,
+                                          http_pool=utils.get_http_pool(), partial_pathlib=partial_pathlib)
+        runs[(cfg.repository, cfg.run_id)].append((i, cfg, mgr))
+    return runs.values()
+
+
+def skip_artifacts(task, ctx, failures):
+    # like `not_all_architectures_present` in a single-package pipeline: the
+    # rest of the chain leaves these out, and carries on with everything else
+    for (i, cfg), exc in failures.items():
+        logger.warning('%s: leaving %s from run %s of %s out of the pipeline: %r',
+                       task.name, cfg.artifact_name, cfg.run_id, cfg.repository, exc)
+        ctx.skipped[i] = True
+
+
+def out_of_retries(task):
+    return task.request.retries >= task.max_retries
+
+
+@shared_task(name='packages.wait_for_artifacts', base=utils.PipelineLinkTask,
+             autoretry_for=[urllib.error.HTTPError, urllib.error.URLError, utils.GitHubNotReadyException],
+             max_retries=30, retry_backoff=conf.settings.TASK_TIMES['05_SEC'],
+             retry_backoff_max=conf.settings.TASK_TIMES['03_MIN'], retry_jitter=True)
+@utils.resolves_cfg
+def wait_for_artifacts(ctx: 'BulkPackageBuildCtx', cfgs: List['PackageBuildCfg']):  # noqa: F821
+    missing, broken = {}, {}
+    for run in artifact_managers_by_run(cfgs, conf.settings.ARTIFACT_DOWNLOAD_PATH):
+        try:
+            records = run[0][2].fetch_artifact_records()
+        except (urllib.error.HTTPError, urllib.error.URLError) as e:
+            missing.update({(i, cfg): e for i, cfg, _ in run})
+            continue
+
+        for i, cfg, mgr in run:
+            try:
+                if any(record.get('expired') for record in mgr.filter_and_validate_artifact_records(records)):
+                    raise Exception('Artifact expired')
+            except utils.GitHubNotReadyException as e:
+                missing[(i, cfg)] = e
+            except Exception as e:
+                # too large or expired, waiting won't help with either
+                broken[(i, cfg)] = e
+
+    skip_artifacts(wait_for_artifacts, ctx, broken)
+    if missing:
+        if not out_of_retries(wait_for_artifacts):
+            raise next(iter(missing.values()))
+        skip_artifacts(wait_for_artifacts, ctx, missing)
+
+    return ctx
+
+
+@shared_task(name='packages.fetch_packages_from_github', base=utils.PipelineLinkTask,
+             autoretry_for=[urllib.error.HTTPError, urllib.error.URLError, utils.GitHubNotReadyException],
+             max_retries=12, retry_backoff=conf.settings.TASK_TIMES['03_MIN'],
+             retry_backoff_max=conf.settings.TASK_TIMES['90_MIN'])
+@utils.resolves_cfg
+def fetch_packages_from_github(ctx: 'BulkPackageBuildCtx', cfgs: List['PackageBuildCfg']):  # noqa: F821
+    store = blob_store()
+    failures = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp_pathlib = pathlib.Path(tmpdir)
+
+        pending = [(i, cfg) for i, cfg in enumerate(cfgs) if not (ctx.skipped[i] or ctx.fetched[i])]
+        for run in artifact_managers_by_run([cfg for _, cfg in pending], tmp_pathlib,
+                                            conf.settings.ARTIFACT_DOWNLOAD_PATH):
+            try:
+                records = run[0][2].fetch_artifact_records()
+            except (urllib.error.HTTPError, urllib.error.URLError) as e:
+                failures.update({(pending[j][0], cfg): e for j, cfg, _ in run})
+                continue
+
+            # every package built into the same artifact is extracted from a
+            # single download of it
+            artifacts = collections.defaultdict(list)
+            for j, cfg, mgr in run:
+                artifacts[cfg.artifact_name].append((pending[j][0], cfg, mgr))
+
+            for artifact in artifacts.values():
+                mgr = artifact[0][2]
+                try:
+                    filepaths = mgr.download_artifacts(mgr.filter_and_validate_artifact_records(records),
+                                                       resume=True)
+                except (urllib.error.HTTPError, urllib.error.URLError, utils.GitHubNotReadyException,
+                        utils.ArtifactDigestException) as e:
+                    # the rest of the request isn't held up by this one
+                    failures.update({(i, cfg): e for i, cfg, _ in artifact})
+                    continue
+
+                for filepath in filepaths:
+                    for _, cfg, _ in artifact:
+                        pkgs_fp = pathlib.Path(cfg.to_channel)
+                        utils.bootstrap_pkgs_dir(pkgs_fp)
+                        for pkg_fp in utils.extract_conda_packages(filepath, cfg.package_name, pkgs_fp):
+                            store.ingest(pkg_fp)
+                    # the next run's artifact of the same name lands here too
+                    filepath.unlink()
+                for i, _, _ in artifact:
+                    ctx.fetched[i] = True
+
+    if failures:
+        task = fetch_packages_from_github
+        if not out_of_retries(task):
+            # only what's still missing is tried again
+            raise task.retry(args=(ctx, *task.request.args[1:]), exc=next(iter(failures.values())))
+        skip_artifacts(task, ctx, failures)
 
     return ctx
 
 
-@shared_task(name='packages.reindex_conda_channel')
+@shared_task(name='packages.reindex_conda_channel',
+             autoretry_for=[channels.ReindexTimeoutException],
+             max_retries=30, retry_backoff=conf.settings.TASK_TIMES['05_SEC'],
+             retry_backoff_max=conf.settings.TASK_TIMES['03_MIN'], retry_jitter=True)
 def reindex_conda_channel(ctx, channel, channel_name):
     # NOTE: ctx unused here, but we need an arg for it for task chaining
     utils.bootstrap_pkgs_dir(channel)
 
-    conda_config = conda_build.api.Config(verbose=False)
-    conda_build.api.update_index(
-        channel,
-        config=conda_config,
-        threads=1,
-        channel_name=channel_name,
-    )
+    cache = channels.MetadataCache(conf.settings.CONDA_INDEX_CACHE_PATH)
+    reindex(channel, channel_name, cache)
+
+    if (received_at := getattr(ctx, 'received_at', None)) is not None:
+        logger.info('%s: indexed %.1fs after the build was received', channel_name, time.time() - received_at)
 
     return ctx
 
 
-@shared_task(name='packages.find_packages_to_copy')
+def reindex(channel, channel_name, cache):
+    index = channels.ChannelIndex(channel, cache)
+    # returns once a run covering this request has completed, whether that
+    # was this one or one that was already in flight. Should that one still
+    # be going after a few seconds, give the worker back and let the task's
+    # retry come back for it, rather than sleeping on the lock in here.
+    result = channels.ReindexCoordinator(channel).reindex(index.index, timeout=conf.settings.REINDEX_LOCK_TIMEOUT)
+    if result.ran:
+        logger.info('Reindexed %s (changed: %r), merged %d pending requests' %
+                    (channel_name, result.changed, result.merged))
+    else:
+        logger.info('Reindex of %s already covered by a concurrent run' % (channel_name,))
+
+    return result
+
+
+@shared_task(name='packages.find_packages_to_copy', base=utils.PipelineLinkTask)
+@utils.resolves_cfg
 def find_packages_to_copy(ctx: 'DistroBuildCtx', cfg: 'DistroBuildCfg'):  # noqa: F821
     if ctx.not_all_architectures_present:
         return ctx
 
+    catalog = channels.ChannelCatalog(cfg.from_channel)
     fns = []
     for pkg, ver in cfg.package_versions.items():
-        base_dir = pathlib.Path(cfg.from_channel)
-        fn_pair = [str(fn.relative_to(base_dir)) for fn in base_dir.glob('**/%s-%s-*.tar.bz2' % (pkg, ver))]
-        if len(fn_pair) != 2:  # 2 bc one osx, one linux
-            raise Exception('Incorrect number of file matches: %r' % (fn_pair,))
-        fns.extend(fn_pair)
+        fn_matches = catalog.find(pkg, ver)
+        # exactly one osx and one linux tarball, plus any `.conda` siblings
+        arches = sorted(pathlib.PurePosixPath(fn).parent.name for fn in fn_matches if fn.endswith('.tar.bz2'))
+        if arches != ['linux-64', 'osx-64']:
+            raise Exception('Incorrect number of file matches: %r' % (fn_matches,))
+        fns.extend(fn_matches)
 
     ctx.pkg_fns = fns
 
     return ctx
 
 
-@shared_task(name='packages.copy_conda_packages')
+@shared_task(name='packages.copy_conda_packages', base=utils.PipelineLinkTask)
+@utils.resolves_cfg
 def copy_conda_packages(ctx: 'DistroBuildCtx', cfg: 'DistroBuildCfg'):  # noqa: F821
     if ctx.not_all_architectures_present:
         return ctx
@@ -86,9 +243,35 @@ def copy_conda_packages(ctx: 'DistroBuildCtx', cfg: 'DistroBuildCfg'):  # noqa:
     from_path = pathlib.Path(cfg.from_channel)
     to_path = pathlib.Path(cfg.to_channel)
 
+    store = blob_store()
+    methods = collections.Counter()
     for fn in ctx.pkg_fns:
         to_dest = to_path / fn
         if not to_dest.exists():
-            shutil.copy(from_path / fn, to_dest)
+            methods[channels.promote_package(from_path / fn, to_dest)] += 1
+            # a no-op when the promotion linked straight onto the blob
+            store.ingest(to_dest)
+    logger.info('Promoted packages into %s: %r' % (cfg.to_channel, dict(methods)))
 
     return ctx
+
+
+@shared_task(name='packages.collect_package_blobs')
+def collect_package_blobs():
+    store = blob_store()
+
+    # anything uploaded before the blob store existed gets folded in here
+    ingested = 0
+    for ext in channels.PACKAGE_EXTENSIONS:
+        for fp in conf.settings.BASE_CONDA_PATH.rglob('*%s' % (ext,)):
+            if not fp.name.startswith('.') and fp.stat().st_nlink == 1:
+                store.ingest(fp)
+                ingested += 1
+
+    count, freed = store.collect_garbage()
+    logger.info('Ingested %d packages, collected %d blobs (%d bytes)' % (ingested, count, freed))
+
+
+def blob_store():
+    cache = channels.MetadataCache(conf.settings.CONDA_INDEX_CACHE_PATH)
+    return channels.BlobStore(conf.settings.CONDA_BLOB_STORE_PATH, cache)
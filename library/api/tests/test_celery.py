@@ -0,0 +1,79 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import tempfile
+
+from celery.backends.filesystem import FilesystemBackend
+from django import test
+from django_celery_results.models import TaskResult
+from kombu.serialization import dumps, loads
+import msgpack
+
+from config import celery
+from library.api import tasks
+from library.index.tasks import debug
+
+
+class SerializerTests(test.SimpleTestCase):
+    def body(self):
+        cfg = tasks.DistroBuildCfg(
+            github_token='token', run_id='1', artifact_name='core-linux', package_name='core',
+            version='2021.11.19.17.02.45', epoch_name='2021.11', owner='qiime2', repo='package-integration',
+            gate='staged', from_channel='/data/qiime2/2021.11/tested',
+            package_versions={'q2-plugin-%d' % (i,): '2021.11.0.dev%d' % (i,) for i in range(500)}, pr_number=42)
+        ctx = tasks.DistroBuildCtx(pk='abc', pkg_fns=['linux-64/q2-foo-2021.11.0-py38_0.tar.bz2'], received_at=1.5,
+                                   cfgs={'pqr': cfg})
+        prs_ctx = tasks.HandlePRsCtx(epoch_name='2021.11', package_versions={'core': {'q2-foo': '2021.11.0'}})
+        bulk_ctx = tasks.BulkPackageBuildCtx(pks=['ghi', 'ghi'], all_architectures_present=[True, False])
+        return [[ctx, cfg], {'prs': prs_ctx}, {'chain': [{'args': [tasks.PackageBuildCtx(pk='def')]}]},
+                [bulk_ctx, [tasks.CfgRef('jkl', 'token'), tasks.CfgRef('mno', 'token')]]]
+
+    def round_trip(self, serializer):
+        content_type, encoding, data = dumps(self.body(), serializer=serializer)
+        return loads(data, content_type, encoding, accept={content_type})
+
+    def test_round_trips(self):
+        for serializer in ('library-json', 'library-msgpack'):
+            with self.subTest(serializer=serializer):
+                body = self.round_trip(serializer)
+
+                self.assertEqual(body, self.body())
+                self.assertEqual(body[0][1].to_channel, '/data/qiime2/2021.11/staged/core')
+
+    def test_msgpack_is_smaller(self):
+        _, _, json_data = dumps(self.body(), serializer='library-json')
+        _, _, msgpack_data = dumps(self.body(), serializer='library-msgpack')
+
+        self.assertLess(len(msgpack_data), len(json_data))
+
+    def test_every_task_type_has_a_code(self):
+        self.assertEqual(set(celery.MSGPACK_TYPE_CODES), set(celery.task_types()))
+        self.assertEqual(len(set(celery.MSGPACK_TYPE_CODES.values())), len(celery.MSGPACK_TYPE_CODES))
+
+    def test_unknown_schema_version(self):
+        fields = msgpack.packb([celery.MSGPACK_SCHEMA_VERSION + 1, {'pk': 'abc'}])
+        data = msgpack.packb(msgpack.ExtType(celery.MSGPACK_TYPE_CODES['PackageBuildCtx'], fields))
+
+        with self.assertRaisesRegex(ValueError, 'schema version'):
+            celery.msgpack_loads(data)
+
+
+class DebugResultBackendTests(test.TestCase):
+    def test_round_trip_skips_the_database(self):
+        with tempfile.TemporaryDirectory() as path, \
+                test.override_settings(DEBUG_RESULT_BACKEND='file://%s' % (path,)):
+            self.assertIsInstance(debug.backend, FilesystemBackend)
+            debug.backend.mark_as_done('debug-task', {'ping': 'pong'})
+
+            self.assertEqual(debug.AsyncResult('debug-task').get(timeout=1), {'ping': 'pong'})
+
+        self.assertFalse(TaskResult.objects.exists())
+
+    def test_defaults_to_the_app_backend(self):
+        with test.override_settings(DEBUG_RESULT_BACKEND=''):
+            self.assertIs(debug.backend, debug.app.backend)
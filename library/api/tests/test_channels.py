@@ -0,0 +1,346 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import bz2
+import io
+import json
+import pathlib
+import stat
+import tarfile
+import tempfile
+import threading
+from unittest import mock
+
+from django import test
+import zstandard
+
+from library.api import channels
+
+
+def make_package(channel, subdir, name, version, build='py38_0'):
+    fp = pathlib.Path(channel) / subdir / ('%s-%s-%s.tar.bz2' % (name, version, build))
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    members = {
+        'info/index.json': {'name': name, 'version': version, 'build': build, 'build_number': 0,
+                            'subdir': subdir, 'depends': []},
+        'info/about.json': {'summary': 'the %s package' % (name,)},
+    }
+    with tarfile.open(fp, 'w:bz2') as tar_fh:
+        for member_name, content in members.items():
+            data = json.dumps(content).encode('utf-8')
+            info = tarfile.TarInfo(member_name)
+            info.size = len(data)
+            tar_fh.addfile(info, io.BytesIO(data))
+    return fp
+
+
+class ChannelIndexTests(test.SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.channel = pathlib.Path(tmpdir.name) / 'tested'
+
+    def index(self, racy_ns=channels.ChannelIndex.racy_ns):
+        idx = channels.ChannelIndex(self.channel)
+        idx.racy_ns = racy_ns
+        return idx.index()
+
+    def repodata(self, subdir):
+        with (self.channel / subdir / 'repodata.json').open() as fh:
+            return json.load(fh)
+
+    def test_index_new_channel(self):
+        make_package(self.channel, 'linux-64', 'q2-foo', '2021.8.0')
+        make_package(self.channel, 'osx-64', 'q2-foo', '2021.8.0')
+
+        changed = self.index()
+
+        self.assertEqual(changed, ['linux-64', 'noarch', 'osx-64'])
+        record = self.repodata('linux-64')['packages']['q2-foo-2021.8.0-py38_0.tar.bz2']
+        self.assertEqual(record['name'], 'q2-foo')
+        self.assertEqual(record['version'], '2021.8.0')
+        self.assertIn('sha256', record)
+        self.assertEqual(self.repodata('noarch')['packages'], {})
+
+    def test_index_writes_variants(self):
+        make_package(self.channel, 'linux-64', 'q2-foo', '2021.4.0')
+        make_package(self.channel, 'linux-64', 'q2-foo', '2021.8.0', 'py38_0')
+        make_package(self.channel, 'linux-64', 'q2-foo', '2021.8.0', 'py39_0')
+        make_package(self.channel, 'linux-64', 'q2-bar', '2021.8.0.dev0')
+
+        self.index()
+
+        subdir_fp = self.channel / 'linux-64'
+        data = (subdir_fp / 'repodata.json').read_bytes()
+        self.assertEqual(bz2.decompress((subdir_fp / 'repodata.json.bz2').read_bytes()), data)
+        self.assertEqual(zstandard.ZstdDecompressor().decompress(
+            (subdir_fp / 'repodata.json.zst').read_bytes()), data)
+        with (subdir_fp / 'current_repodata.json').open() as fh:
+            current = json.load(fh)
+        self.assertEqual(sorted(current['packages']), [
+            'q2-bar-2021.8.0.dev0-py38_0.tar.bz2',
+            'q2-foo-2021.8.0-py38_0.tar.bz2',
+            'q2-foo-2021.8.0-py39_0.tar.bz2',
+        ])
+
+    def test_index_removes_conda_build_leftovers(self):
+        make_package(self.channel, 'linux-64', 'q2-foo', '2021.8.0')
+        leftovers = [self.channel / 'channeldata.json', self.channel / 'index.html',
+                     self.channel / 'linux-64' / 'index.html',
+                     self.channel / 'linux-64' / 'repodata_from_packages.json']
+        for fp in leftovers:
+            fp.write_text('{}')
+
+        self.index()
+
+        self.assertEqual([fp for fp in leftovers if fp.exists()], [])
+
+    def test_reindex_untouched_channel_is_a_noop(self):
+        make_package(self.channel, 'linux-64', 'q2-foo', '2021.8.0')
+        # everything in a unit test is "racy", trust the mtimes regardless
+        self.index(racy_ns=0)
+
+        with mock.patch.object(channels, 'package_record') as package_record, \
+                mock.patch.object(channels.ChannelIndex, 'scan_subdir') as scan_subdir:
+            changed = self.index(racy_ns=0)
+
+        self.assertEqual(changed, [])
+        package_record.assert_not_called()
+        scan_subdir.assert_not_called()
+
+    def test_reindex_only_reads_new_packages(self):
+        make_package(self.channel, 'linux-64', 'q2-foo', '2021.8.0')
+        self.index()
+        repodata_fp = self.channel / 'osx-64' / 'repodata.json'
+        osx_mtime = repodata_fp.stat().st_mtime_ns
+
+        new_fp = make_package(self.channel, 'linux-64', 'q2-bar', '2021.8.0')
+        with mock.patch.object(channels, 'package_record', wraps=channels.package_record) as package_record:
+            changed = self.index()
+
+        self.assertEqual(changed, ['linux-64'])
+        package_record.assert_called_once_with(new_fp, None)
+        self.assertEqual(len(self.repodata('linux-64')['packages']), 2)
+        self.assertEqual(repodata_fp.stat().st_mtime_ns, osx_mtime)
+
+    def test_reindex_drops_removed_packages(self):
+        fp = make_package(self.channel, 'linux-64', 'q2-foo', '2021.8.0')
+        make_package(self.channel, 'linux-64', 'q2-bar', '2021.8.0')
+        self.index()
+
+        fp.unlink()
+        changed = self.index()
+
+        self.assertEqual(changed, ['linux-64'])
+        self.assertEqual(list(self.repodata('linux-64')['packages']), ['q2-bar-2021.8.0-py38_0.tar.bz2'])
+
+
+class MetadataCacheTests(test.SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmp_pathlib = pathlib.Path(tmpdir.name)
+        self.cache_fp = self.tmp_pathlib / 'cache.sqlite3'
+
+    def test_package_record(self):
+        fp = make_package(self.tmp_pathlib / 'tested', 'linux-64', 'q2-foo', '2021.8.0')
+        cache = channels.MetadataCache(self.cache_fp)
+
+        record = cache.package_record(fp)
+
+        self.assertEqual(record, channels.package_record(fp))
+        self.assertEqual(cache.get_about(record['sha256']), {'summary': 'the q2-foo package'})
+
+    def test_cache_survives_restart_and_copies(self):
+        fp = make_package(self.tmp_pathlib / 'tested', 'linux-64', 'q2-foo', '2021.8.0')
+        expected = channels.MetadataCache(self.cache_fp).package_record(fp)
+        copied_fp = self.tmp_pathlib / 'staged' / 'linux-64' / fp.name
+        copied_fp.parent.mkdir(parents=True)
+        copied_fp.write_bytes(fp.read_bytes())
+
+        # a fresh instance, as if the worker had been restarted
+        cache = channels.MetadataCache(self.cache_fp)
+        with mock.patch.object(channels, 'read_package_metadata') as read_package_metadata, \
+                mock.patch.object(channels, 'hash_package', wraps=channels.hash_package) as hash_package:
+            self.assertEqual(cache.package_record(fp), expected)
+            hash_package.assert_not_called()
+
+            self.assertEqual(cache.package_record(copied_fp), expected)
+            hash_package.assert_called_once()
+
+        read_package_metadata.assert_not_called()
+
+
+class ReindexCoordinatorTests(test.SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.channel = pathlib.Path(tmpdir.name) / 'tested'
+
+    def test_requests_queued_behind_a_run_are_coalesced(self):
+        started, release = threading.Event(), threading.Event()
+        runs = []
+
+        def slow_index():
+            runs.append('slow')
+            started.set()
+            release.wait(5)
+            return ['linux-64']
+
+        def index():
+            runs.append('fast')
+            return []
+
+        first = channels.ReindexCoordinator(self.channel)
+        results = {}
+        threading.Thread(target=lambda: results.setdefault('first', first.reindex(slow_index))).start()
+        started.wait(5)
+
+        # three more requests pile up while the first run is in flight
+        tickets = [channels.ReindexCoordinator(self.channel).request() for _ in range(3)]
+        threads = [
+            threading.Thread(target=lambda t=t: results.setdefault(t, channels.ReindexCoordinator(
+                self.channel).run(t, index, timeout=5)))
+            for t in tickets
+        ]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(runs, ['slow', 'fast'])
+        self.assertTrue(results['first'].ran)
+        self.assertEqual(results['first'].merged, 0)
+        ran = [results[t] for t in tickets if results[t].ran]
+        self.assertEqual(len(ran), 1)
+        self.assertEqual(ran[0].merged, 2)
+        self.assertEqual(channels.ReindexCoordinator(self.channel).completed(), 4)
+
+    def test_failed_run_is_not_marked_complete(self):
+        coordinator = channels.ReindexCoordinator(self.channel)
+
+        def broken_index():
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            coordinator.reindex(broken_index)
+
+        self.assertEqual(coordinator.completed(), 0)
+        self.assertTrue(coordinator.reindex(list).ran)
+        with self.assertRaises(channels.ReindexTimeoutException):
+            coordinator.wait(coordinator.request(), timeout=0)
+
+
+class PromotePackageTests(test.SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmp_pathlib = pathlib.Path(tmpdir.name)
+        self.src = make_package(self.tmp_pathlib / 'tested', 'linux-64', 'q2-foo', '2021.8.0')
+        self.dst = self.tmp_pathlib / 'staged' / 'core' / 'linux-64' / self.src.name
+
+    def test_promote_hardlink(self):
+        method = channels.promote_package(self.src, self.dst)
+
+        self.assertEqual(method, 'hardlink')
+        self.assertTrue(self.dst.samefile(self.src))
+        self.assertEqual(self.src.stat().st_nlink, 2)
+
+    def test_promote_falls_back_to_copy(self):
+        with mock.patch.object(channels.os, 'link', side_effect=OSError('EXDEV')), \
+                mock.patch.object(channels, 'reflink', side_effect=OSError('EOPNOTSUPP')):
+            method = channels.promote_package(self.src, self.dst)
+
+        self.assertEqual(method, 'copy')
+        self.assertFalse(self.dst.samefile(self.src))
+        self.assertEqual(self.dst.read_bytes(), self.src.read_bytes())
+        self.assertEqual([fp.name for fp in self.dst.parent.iterdir()], [self.src.name])
+
+
+class BlobStoreTests(test.SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmp_pathlib = pathlib.Path(tmpdir.name)
+        self.store = channels.BlobStore(self.tmp_pathlib / '.blobs')
+
+    def test_ingest_deduplicates_copies(self):
+        tested_fp = make_package(self.tmp_pathlib / 'tested', 'linux-64', 'q2-foo', '2021.8.0')
+        staged_fp = self.tmp_pathlib / 'staged' / 'core' / 'linux-64' / tested_fp.name
+        staged_fp.parent.mkdir(parents=True)
+        staged_fp.write_bytes(tested_fp.read_bytes())
+
+        blob = self.store.ingest(tested_fp)
+        self.assertEqual(self.store.ingest(staged_fp), blob)
+        self.assertEqual(self.store.ingest(staged_fp), blob)
+
+        self.assertTrue(staged_fp.samefile(tested_fp))
+        self.assertEqual(self.store.references(blob.name), 2)
+        # nginx serves the channels, but can't reach into the store
+        self.assertEqual(stat.S_IMODE(self.store.root.stat().st_mode), 0o700)
+        self.assertEqual(stat.S_IMODE(staged_fp.stat().st_mode), 0o444)
+
+    def test_ingest_promoted_package_without_hashing(self):
+        store = channels.BlobStore(self.tmp_pathlib / '.blobs', channels.MetadataCache(self.tmp_pathlib / 'cache'))
+        fp = make_package(self.tmp_pathlib / 'tested', 'linux-64', 'q2-foo', '2021.8.0')
+        blob = store.ingest(fp)
+        staged_fp = self.tmp_pathlib / 'staged' / 'core' / 'linux-64' / fp.name
+        channels.promote_package(fp, staged_fp)
+
+        with mock.patch.object(channels, 'hash_package') as hash_package:
+            self.assertEqual(store.ingest(staged_fp), blob)
+            self.assertEqual(store.cache.package_record(staged_fp)['sha256'], blob.name)
+
+        hash_package.assert_not_called()
+        self.assertEqual(store.references(blob.name), 2)
+
+    def test_materialize_and_collect_garbage(self):
+        fp = make_package(self.tmp_pathlib / 'tested', 'linux-64', 'q2-foo', '2021.8.0')
+        blob = self.store.ingest(fp)
+        passed_fp = self.tmp_pathlib / 'passed' / 'core' / 'linux-64' / fp.name
+
+        self.assertEqual(self.store.materialize(blob.name, passed_fp), 'hardlink')
+        fp.unlink()
+        self.assertEqual(self.store.collect_garbage(grace=0), (0, 0))
+
+        passed_fp.unlink()
+        size = blob.stat().st_size
+        self.assertEqual(self.store.collect_garbage(grace=60), (0, 0))
+        self.assertEqual(self.store.collect_garbage(grace=0), (1, size))
+        self.assertFalse(blob.exists())
+
+
+class ChannelCatalogTests(test.SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.channel = pathlib.Path(tmpdir.name) / 'tested'
+
+    def test_find_in_a_large_channel(self):
+        for subdir in ('linux-64', 'osx-64'):
+            (self.channel / subdir).mkdir(parents=True)
+            for i in range(15000):
+                (self.channel / subdir / ('q2-pkg%d-2021.8.0.dev%d-py38_0.tar.bz2' % (i % 50, i))).touch()
+            (self.channel / subdir / 'q2-foo-bar-2021.8.0-py38_0.tar.bz2').touch()
+            (self.channel / subdir / 'q2-foo-bar-2021.8.0-py38_0.conda').touch()
+            (self.channel / subdir / 'q2-foo-2021.8.0-py38_0.tar.bz2').touch()
+        (self.channel / 'linux-64' / 'repodata.json').touch()
+        (self.channel / 'linux-64' / '.q2-foo-2021.8.0-py38_0.tar.bz2.part').touch()
+
+        catalog = channels.ChannelCatalog(self.channel)
+
+        self.assertEqual(catalog.find('q2-foo', '2021.8.0'),
+                         ['linux-64/q2-foo-2021.8.0-py38_0.tar.bz2', 'osx-64/q2-foo-2021.8.0-py38_0.tar.bz2'])
+        self.assertEqual(catalog.get('q2-foo-bar', '2021.8.0', 'osx-64'),
+                         ['q2-foo-bar-2021.8.0-py38_0.conda', 'q2-foo-bar-2021.8.0-py38_0.tar.bz2'])
+        self.assertEqual(catalog.find('q2-pkg7', '2021.8.0.dev14957'),
+                         ['linux-64/q2-pkg7-2021.8.0.dev14957-py38_0.tar.bz2',
+                          'osx-64/q2-pkg7-2021.8.0.dev14957-py38_0.tar.bz2'])
+        self.assertEqual(catalog.find('q2-foo', '2021.4.0'), [])
+        self.assertEqual(len(catalog.entries), 30004)
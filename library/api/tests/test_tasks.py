@@ -0,0 +1,424 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import datetime
+import tempfile
+import time
+import types
+from unittest import mock
+import uuid
+
+from django import conf, test
+from django_celery_results.models import TaskResult
+from django.utils import timezone
+from kombu.serialization import dumps
+
+from library.api import channels, tasks, utils
+from library.api.models import PipelineConfig
+from library.api.tasks import db, git, packages
+from library.packages.models import (
+    Distro, DistroBuild, Epoch, Package, PackageBuild, ThroughDistroBuildPackageBuild, ThroughDistroPackage)
+
+
+class IntegrationTriggerTests(test.TestCase):
+    def setUp(self):
+        self.epoch = Epoch.objects.create(name='2021.8', include_in_ci=True)
+        self.package = Package.objects.create(name='q2-foo', repository='qiime2/q2-foo')
+        self.cfg = types.SimpleNamespace(gate=conf.settings.GATE_TESTED)
+
+    def build(self, run_id, **arches):
+        record = PackageBuild.objects.create(package=self.package, epoch=self.epoch, github_run_id=run_id,
+                                             version='2021.8.0.dev%s' % (run_id,), build_target='dev', **arches)
+        return tasks.PackageBuildCtx(pk=str(record.pk))
+
+    def test_ready_builds_share_one_debounced_run(self):
+        with mock.patch.object(db, 'signature') as signature:
+            ctx = db.verify_all_architectures_present(self.build('1', linux_64=True), self.cfg)
+            self.assertTrue(ctx.not_all_architectures_present)
+            signature.assert_not_called()
+
+            for run_id in ('1', '2', '3'):
+                ctx = db.verify_all_architectures_present(self.build(run_id, linux_64=True, osx_64=True), self.cfg)
+                self.assertFalse(ctx.not_all_architectures_present)
+
+        signature.assert_called_once_with('pipeline.integrate_epoch', args=(str(self.epoch.pk),))
+        eta = signature.return_value.apply_async.call_args.kwargs['eta']
+        self.epoch.refresh_from_db()
+        self.assertEqual(self.epoch.integration_scheduled_at, eta)
+        window = datetime.timedelta(seconds=conf.settings.INTEGRATION_DEBOUNCE_WINDOW)
+        self.assertAlmostEqual(eta, timezone.now() + window, delta=datetime.timedelta(seconds=5))
+
+    def test_integrate_epoch_releases_the_trigger(self):
+        Epoch.objects.schedule_integration(self.epoch.pk, 60)
+
+        with mock.patch.object(tasks, 'integration_chain') as integration_chain:
+            tasks.integrate_epoch(str(self.epoch.pk))
+
+        integration_chain.assert_called_once_with('2021.8')
+        self.epoch.refresh_from_db()
+        self.assertIsNone(self.epoch.integration_scheduled_at)
+        self.assertIsNotNone(Epoch.objects.schedule_integration(self.epoch.pk, 60))
+
+    def test_handle_prs_skips_epochs_with_a_pending_run(self):
+        Epoch.objects.create(name='2021.11', include_in_ci=True)
+        Epoch.objects.schedule_integration(self.epoch.pk, 60)
+
+        with mock.patch.object(tasks, 'integration_chain') as integration_chain, \
+                mock.patch.object(tasks, 'group'):
+            tasks.handle_prs()
+
+        integration_chain.assert_called_once_with('2021.11')
+
+    def test_lost_run_can_be_rescheduled(self):
+        Epoch.objects.filter(pk=self.epoch.pk).update(
+            integration_scheduled_at=timezone.now() - datetime.timedelta(seconds=120))
+
+        self.assertIsNotNone(Epoch.objects.schedule_integration(self.epoch.pk, 60))
+        self.assertIsNone(Epoch.objects.schedule_integration(self.epoch.pk, 60))
+
+
+class FindPackagesReadyForIntegrationTests(test.TestCase):
+    def setUp(self):
+        self.epoch = Epoch.objects.create(name='2021.8', include_in_ci=True)
+        self.distros = {}
+        self.packages = {}
+        for name in ('q2-foo', 'q2-bar', 'q2-baz'):
+            self.packages[name] = Package.objects.create(name=name, repository='qiime2/%s' % (name,))
+
+    def add_distro(self, name, package_names):
+        distro = Distro.objects.create(name=name)
+        for package_name in package_names:
+            ThroughDistroPackage.objects.create(distro=distro, package=self.packages[package_name])
+        self.distros[name] = distro
+
+    def build(self, package_name, version, ready=True):
+        return PackageBuild.objects.create(package=self.packages[package_name], epoch=self.epoch, github_run_id='1',
+                                           version=version, build_target='dev', linux_64=True, osx_64=ready)
+
+    def find(self):
+        ctx = tasks.HandlePRsCtx(epoch_name='2021.8', github_token='token')
+        return db.find_packages_ready_for_integration(ctx)
+
+    def test_ready_builds_grouped_by_distro(self):
+        self.add_distro('core', ['q2-foo', 'q2-bar'])
+        self.add_distro('tiny', ['q2-foo'])
+        foo_old, foo_new = self.build('q2-foo', '2021.8.0.dev1'), self.build('q2-foo', '2021.8.0.dev2')
+        bar = self.build('q2-bar', '2021.8.0.dev1')
+        self.build('q2-bar', '2021.8.0.dev2', ready=False)
+        self.build('q2-baz', '2021.8.0.dev1')
+
+        ctx = self.find()
+
+        self.assertEqual(ctx.package_versions, {'core': {'q2-foo': '2021.8.0.dev2', 'q2-bar': '2021.8.0.dev1'},
+                                                'tiny': {'q2-foo': '2021.8.0.dev2'}})
+        self.assertEqual(set(ctx.package_build_pks), {str(foo_old.pk), str(foo_new.pk), str(bar.pk)})
+        self.assertEqual(set(ctx.distro_build_pks), {'core', 'tiny'})
+        for distro_name, pk in ctx.distro_build_pks.items():
+            distro_build = DistroBuild.objects.get(pk=pk)
+            self.assertEqual(distro_build.distro, self.distros[distro_name])
+            self.assertEqual(distro_build.version, ctx.version)
+        self.assertEqual(set(DistroBuild.objects.get(pk=ctx.distro_build_pks['core']).package_builds.all()),
+                         {foo_old, foo_new, bar})
+
+        # everything ready has been claimed by a distro build now
+        self.assertEqual(self.find().package_versions, {})
+
+    def test_constant_number_of_queries(self):
+        for i in range(8):
+            self.add_distro('distro-%d' % (i,), ['q2-foo', 'q2-bar'])
+        self.build('q2-foo', '2021.8.0.dev1')
+        self.build('q2-bar', '2021.8.0.dev1')
+
+        # epoch, readiness, and two bulk inserts inside a savepoint
+        with self.assertNumQueries(6):
+            ctx = self.find()
+        self.assertEqual(len(ctx.distro_build_pks), 8)
+        self.assertEqual(ThroughDistroBuildPackageBuild.objects.count(), 16)
+
+
+@test.override_settings(RESULT_CLEANUP_BATCH=2, RESULT_CLEANUP_PAUSE=0)
+class CeleryBackendCleanupTests(test.TestCase):
+    def result(self, task_name, age):
+        record = TaskResult.objects.create(task_id=str(uuid.uuid4()), task_name=task_name, status='SUCCESS')
+        # `date_done` is auto_now, so backdate it afterwards
+        TaskResult.objects.filter(pk=record.pk).update(date_done=timezone.now() - datetime.timedelta(seconds=age))
+        return record
+
+    def test_expired_ephemeral_results_are_deleted_in_batches(self):
+        expires = conf.settings.CELERY_RESULT_EXPIRES
+        for _ in range(5):
+            self.result('packages.reindex_conda_channel', expires + 60)
+        kept = [
+            self.result('packages.reindex_conda_channel', 60),
+            self.result('pipeline.handle_new_builds', expires + 60),
+        ]
+
+        with self.assertLogs(db.logger, 'INFO') as logs:
+            self.assertEqual(db.celery_backend_cleanup(), 5)
+
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(set(TaskResult.objects.all()), set(kept))
+
+
+class PipelineConfigTests(test.TestCase):
+    def setUp(self):
+        self.cfg = tasks.DistroBuildCfg(
+            github_token='secret-token', run_id='1', artifact_name='core-linux', package_name='core',
+            version='2021.11.19.17.02.45', epoch_name='2021.11', owner='qiime2', repo='package-integration',
+            gate='staged', from_channel='/data/qiime2/2021.11/tested', package_versions={'q2-foo': '2021.11.0'},
+            pr_number=42)
+
+    def test_token_is_not_stored(self):
+        pk = PipelineConfig.objects.store(self.cfg)
+
+        self.assertNotIn('github_token', PipelineConfig.objects.get(pk=pk).data)
+        cfg = PipelineConfig.objects.load(pk)
+        self.assertEqual(cfg.github_token, '')
+        self.assertEqual(cfg.pr_url, self.cfg.pr_url)
+        self.assertEqual(cfg.package_versions, self.cfg.package_versions)
+
+    def test_loaded_once_per_chain(self):
+        ref = tasks.CfgRef(PipelineConfig.objects.store(self.cfg), 'secret-token')
+        ctx = tasks.DistroBuildCtx()
+
+        with self.assertNumQueries(1):
+            first = utils.resolve_cfg(ref, ctx, load=True)
+        # every later link, whatever its queue, finds it on the ctx
+        with self.assertNumQueries(0):
+            second = utils.resolve_cfg(ref, ctx)
+
+        self.assertEqual(first, self.cfg)
+        self.assertEqual(second, self.cfg)
+        self.assertEqual(ctx.cfgs[ref.pk].github_token, '')
+        self.assertIs(utils.resolve_cfg(self.cfg, ctx), self.cfg)
+
+    def test_only_the_first_link_reads_the_database(self):
+        ref = tasks.CfgRef(PipelineConfig.objects.store(self.cfg), 'secret-token')
+
+        with self.assertNumQueries(0), self.assertRaises(utils.UnresolvedCfgException):
+            utils.resolve_cfg(ref, tasks.DistroBuildCtx())
+
+    def test_chain_carries_only_the_reference(self):
+        with mock.patch('library.api.tasks.chain') as chain:
+            tasks.handle_new_distro_build(self.cfg)
+
+        body = [sig.args + tuple(sig.kwargs.values()) for sig in chain.call_args.args]
+        _, _, data = dumps(body, serializer='library-msgpack')
+        self.assertIn(b'secret-token', data)
+        self.assertNotIn(b'q2-foo', data)
+        self.assertEqual(PipelineConfig.objects.count(), 1)
+
+    def test_expired_configs_are_cleaned_up(self):
+        PipelineConfig.objects.store(self.cfg)
+        kept = PipelineConfig.objects.store(self.cfg)
+        PipelineConfig.objects.exclude(pk=kept).update(
+            created_at=timezone.now() - datetime.timedelta(seconds=conf.settings.PIPELINE_CONFIG_EXPIRES + 60))
+
+        db.celery_backend_cleanup()
+
+        self.assertEqual(list(PipelineConfig.objects.values_list('pk', flat=True)), [uuid.UUID(kept)])
+
+
+class ResultPolicyTests(test.TestCase):
+    def stored(self, signatures):
+        return [sig.task for sig in signatures if not sig.options.get('ignore_result', sig.type.ignore_result)]
+
+    def test_one_result_per_pipeline(self):
+        package_build = dict(
+            github_token='token', run_id='1', artifact_name='q2-foo-linux', package_name='q2-foo',
+            version='2021.11.0.dev1', repository='qiime2/q2-foo', build_target='dev', package_token='abc',
+            epoch_names=['2021.11'])
+        distro_build = tasks.DistroBuildCfg(
+            github_token='token', run_id='1', artifact_name='core-linux', package_name='core',
+            version='2021.11.19.17.02.45', epoch_name='2021.11', owner='qiime2', repo='package-integration',
+            gate='staged', from_channel='/data/qiime2/2021.11/tested')
+
+        with mock.patch.object(tasks, 'chain') as chain, mock.patch.object(tasks, 'group'):
+            tasks.handle_new_package_build(package_build)
+            self.assertEqual(self.stored(chain.call_args.args), ['git.update_conda_build_config'])
+
+            tasks.handle_new_distro_build(distro_build)
+            self.assertEqual(self.stored(chain.call_args.args), ['git.merge_integration_pr'])
+
+            tasks.handle_passed_distro_build(distro_build)
+            self.assertEqual(self.stored(chain.call_args.args), ['packages.reindex_conda_channel'])
+
+        self.assertEqual(self.stored(tasks.integration_chain('2021.11').tasks),
+                         ['db.update_distro_build_record_integration_pr_url'])
+
+    def test_failed_link_is_still_recorded(self):
+        cfg = tasks.PackageBuildCfg(
+            github_token='token', run_id='1', artifact_name='q2-foo-linux', package_name='q2-foo',
+            version='2021.11.0.dev1', repository='qiime2/q2-foo', build_target='dev', package_token='abc',
+            epoch_name='2021.11')
+        result = db.mark_uploaded_package.apply(args=(tasks.PackageBuildCtx(pk=str(uuid.uuid4())), cfg))
+
+        record = TaskResult.objects.get()
+        self.assertEqual(record.task_id, result.id)
+        self.assertEqual(record.status, 'FAILURE')
+        self.assertIn('DoesNotExist', record.traceback)
+
+
+class ReindexTests(test.SimpleTestCase):
+    @test.override_settings(REINDEX_LOCK_TIMEOUT=0.2)
+    def test_busy_channel_hands_the_worker_back(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            coordinator = channels.ReindexCoordinator(tmpdir)
+            # a run for this channel is in flight in some other worker
+            with coordinator.locked(coordinator.lock_fp):
+                start = time.monotonic()
+                with self.assertRaises(channels.ReindexTimeoutException):
+                    packages.reindex(tmpdir, 'test-tested', cache=None)
+
+        self.assertLess(time.monotonic() - start, 5)
+
+
+class BulkPackageBuildTests(test.TestCase):
+    def setUp(self):
+        self.epoch = Epoch.objects.create(name='2021.11', include_in_ci=True, is_dev=True)
+        self.packages = [Package.objects.create(name='', repository='') for _ in range(3)]
+
+    def cfgs(self, archs=('linux-64', 'osx-64')):
+        return [tasks.PackageBuildCfg(
+            github_token='token', run_id=str(i % 2), artifact_name=arch, package_name='q2-%d' % (i,),
+            version='2021.11.0.dev1', repository='qiime2/q2-%d' % (i % 2,), build_target='dev',
+            package_token=str(package.token), epoch_name='2021.11')
+            for i, package in enumerate(self.packages) for arch in archs]
+
+    def ctx(self, cfgs):
+        return tasks.BulkPackageBuildCtx(skipped=[False] * len(cfgs), fetched=[False] * len(cfgs))
+
+    def test_one_chain_per_epoch(self):
+        Epoch.objects.create(name='2021.8', include_in_ci=True, is_dev=True)
+        initial_data = [dict(github_token='token', run_id='1', artifact_name=arch, package_name='q2-foo',
+                             version='2021.11.0.dev1', repository='qiime2/q2-foo', build_target='dev',
+                             package_token='abc', epoch_names=['2021.11', '2021.8'])
+                        for arch in ('linux-64', 'osx-64')]
+
+        with mock.patch.object(tasks, 'chain') as chain, mock.patch.object(tasks, 'group') as group, \
+                self.assertNumQueries(1):
+            tasks.handle_new_package_builds(initial_data)
+
+        self.assertEqual(len(group.call_args.args), 2)
+        for call in chain.call_args_list:
+            names = [sig.task for sig in call.args]
+            self.assertEqual(names.count('packages.reindex_conda_channel'), 1)
+            self.assertEqual(len(call.args[0].args[1]), 2)
+        self.assertEqual(PipelineConfig.objects.count(), 4)
+
+    def test_records_marked_and_verified_together(self):
+        cfgs = self.cfgs()
+        # the last package's osx-64 build hasn't arrived yet
+        del cfgs[-1]
+
+        ctx = db.create_package_build_records(tasks.BulkPackageBuildCtx(), cfgs)
+        self.assertEqual(len(set(ctx.pks)), 3)
+        self.assertEqual(ctx.skipped, [False] * 5)
+        self.assertEqual(Package.objects.get(pk=self.packages[2].pk).name, 'q2-2')
+
+        # an update per architecture, plus the savepoint around them
+        with self.assertNumQueries(4):
+            ctx = db.mark_uploaded_packages(ctx, cfgs)
+
+        with mock.patch.object(db, 'signature') as signature:
+            ctx = db.verify_all_package_architectures_present(ctx, cfgs)
+
+        self.assertEqual(ctx.all_architectures_present, [True, True, True, True, False])
+        signature.assert_called_once_with('pipeline.integrate_epoch', args=(str(self.epoch.pk),))
+
+        with mock.patch.object(git.utils, 'get_integration_repo_manager') as get_manager:
+            git.update_conda_build_configs(ctx, cfgs)
+
+        get_manager.return_value.update_conda_build_config.assert_called_once_with(
+            'main', '2021.11', conf.settings.GATE_TESTED, {None: {'q2-0': '2021.11.0.dev1', 'q2-1': '2021.11.0.dev1'}})
+
+    def test_one_artifact_listing_per_run(self):
+        listing = {'artifacts': [{'name': arch, 'size_in_bytes': 1} for arch in ('linux-64', 'osx-64')]}
+
+        with mock.patch.object(packages.utils.GitHubArtifactManager, 'fetch_artifact_records',
+                               return_value=listing) as fetch_artifact_records:
+            packages.wait_for_artifacts(self.ctx(self.cfgs()), self.cfgs())
+
+        # six artifacts, from two workflow runs
+        self.assertEqual(fetch_artifact_records.call_count, 2)
+
+    def test_one_download_per_artifact(self):
+        listing = {'artifacts': [{'name': arch, 'size_in_bytes': 1} for arch in ('linux-64', 'osx-64')]}
+        downloads = []
+
+        def download_artifacts(mgr, records, resume=False):
+            fp = mgr.root_pathlib / records[0]['name']
+            fp.write_bytes(b'zip')
+            downloads.append((mgr.run_id, fp.name))
+            return [fp]
+
+        with mock.patch.object(packages.utils.GitHubArtifactManager, 'fetch_artifact_records', return_value=listing), \
+                mock.patch.object(packages.utils.GitHubArtifactManager, 'download_artifacts', download_artifacts), \
+                mock.patch.object(packages.utils, 'extract_conda_packages', return_value=[]) as extract, \
+                mock.patch.object(packages.utils, 'bootstrap_pkgs_dir'), \
+                mock.patch.object(packages, 'blob_store'):
+            packages.fetch_packages_from_github(self.ctx(self.cfgs()), self.cfgs())
+
+        # two packages share each of the first run's artifacts
+        self.assertEqual(sorted(downloads), [('0', 'linux-64'), ('0', 'osx-64'), ('1', 'linux-64'), ('1', 'osx-64')])
+        self.assertEqual(extract.call_count, 6)
+
+    def test_missing_artifact_is_left_out_once_out_of_retries(self):
+        cfgs = self.cfgs()
+        listings = {'0': {'artifacts': [{'name': arch, 'size_in_bytes': 1, 'expired': False}
+                                        for arch in ('linux-64', 'osx-64')]},
+                    # the second run's osx-64 build never uploads anything
+                    '1': {'artifacts': [{'name': 'linux-64', 'size_in_bytes': 1, 'expired': False}]}}
+
+        def fetch_artifact_records(mgr):
+            return listings[mgr.run_id]
+
+        with mock.patch.object(packages.utils.GitHubArtifactManager, 'fetch_artifact_records',
+                               fetch_artifact_records):
+            with self.assertRaises(packages.utils.GitHubNotReadyException):
+                packages.wait_for_artifacts(self.ctx(cfgs), cfgs)
+
+            with self.assertLogs(packages.logger, 'WARNING'):
+                result = packages.wait_for_artifacts.apply(args=(self.ctx(cfgs), cfgs),
+                                                           retries=packages.wait_for_artifacts.max_retries)
+
+        self.assertEqual(result.get().skipped, [False, False, False, True, False, False])
+
+    def test_bad_artifact_does_not_hold_up_the_rest(self):
+        cfgs = self.cfgs()
+        ctx = db.create_package_build_records(tasks.BulkPackageBuildCtx(), cfgs)
+        listing = {'artifacts': [{'name': arch, 'size_in_bytes': 1} for arch in ('linux-64', 'osx-64')]}
+        downloads = collections.Counter()
+
+        def download_artifacts(mgr, records, resume=False):
+            downloads[(mgr.run_id, mgr.artifact_name)] += 1
+            if (mgr.run_id, mgr.artifact_name) == ('1', 'osx-64'):
+                raise packages.utils.ArtifactDigestException('digest mismatch')
+            fp = mgr.root_pathlib / records[0]['name']
+            fp.write_bytes(b'zip')
+            return [fp]
+
+        with mock.patch.object(packages.utils.GitHubArtifactManager, 'fetch_artifact_records', return_value=listing), \
+                mock.patch.object(packages.utils.GitHubArtifactManager, 'download_artifacts', download_artifacts), \
+                mock.patch.object(packages.utils, 'extract_conda_packages', return_value=[]), \
+                mock.patch.object(packages.utils, 'bootstrap_pkgs_dir'), \
+                mock.patch.object(packages, 'blob_store'), \
+                self.assertLogs(packages.logger, 'WARNING'):
+            ctx = packages.fetch_packages_from_github.apply(args=(ctx, cfgs)).get()
+
+        # every retry only went after the one bad artifact
+        retries = packages.fetch_packages_from_github.max_retries
+        self.assertEqual(downloads, {('0', 'linux-64'): 1, ('0', 'osx-64'): 1, ('1', 'linux-64'): 1,
+                                     ('1', 'osx-64'): retries + 1})
+        self.assertEqual(ctx.skipped, [False, False, False, True, False, False])
+
+        db.mark_uploaded_packages(ctx, cfgs)
+        with mock.patch.object(db, 'signature'):
+            ctx = db.verify_all_package_architectures_present(ctx, cfgs)
+        self.assertEqual(ctx.all_architectures_present, [True, True, False, False, True, True])
@@ -0,0 +1,626 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import base64
+import collections
+import contextlib
+import hashlib
+import http.server
+import itertools
+import json
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import types
+import urllib.parse
+import unittest
+from unittest import mock
+import zipfile
+
+from django import test
+from django.db import OperationalError
+from fastcore.utils import HTTP404NotFoundError, HTTP422UnprocessableEntityError
+import yaml
+
+from library.api import utils
+
+
+_ARTIFACT = bytes(range(256)) * 4096
+_DIGEST = 'sha256:%s' % (hashlib.sha256(_ARTIFACT).hexdigest(),)
+
+
+class _GitHubStandIn(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.auth_headers.append(self.headers.get('authorization'))
+        host = 'http://%s:%d' % self.server.server_address
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.endswith('/artifacts'):
+            self.server.listings.append(url.query)
+            records = {'artifacts': [{
+                'name': 'linux-64',
+                'size_in_bytes': len(_ARTIFACT),
+                'archive_download_url': '%s/zip/linux-64' % (host,),
+                'digest': self.server.digest,
+            }] if self.server.uploaded else []}
+            self.send_body(json.dumps(records).encode('utf-8'), 'application/json')
+        elif self.path.startswith('/zip/'):
+            self.send_response(302)
+            self.send_header('location', '/blob/linux-64')
+            self.send_header('content-length', '0')
+            self.end_headers()
+        elif self.path.startswith('/blob/'):
+            self.server.ranges.append(self.headers.get('range'))
+            if (range_ := self.headers.get('range')):
+                start = int(range_[len('bytes='):-1])
+                content_range = 'bytes %d-%d/%d' % (start, len(_ARTIFACT) - 1, len(_ARTIFACT))
+                self.send_body(_ARTIFACT[start:], 'application/zip', 206, {'content-range': content_range})
+            else:
+                self.send_body(_ARTIFACT, 'application/zip')
+        else:
+            self.send_error(404)
+
+
+class GitHubArtifactManagerTests(test.SimpleTestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _GitHubStandIn)
+        self.server.connections = 0
+        self.server.auth_headers = []
+        self.server.ranges = []
+        self.server.listings = []
+        self.server.uploaded = True
+        self.server.digest = _DIGEST
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://%s:%d' % self.server.server_address
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmp_pathlib = pathlib.Path(tmpdir.name)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def manager(self, http_pool, run_id):
+        root = self.tmp_pathlib / run_id
+        root.mkdir()
+        mgr = utils.GitHubArtifactManager('token', 'qiime2/q2-foo', run_id, 'linux-64', root,
+                                          http_pool=http_pool, partial_pathlib=self.tmp_pathlib / 'partial')
+        mgr.base_url = self.base_url
+        return mgr
+
+    def sync(self, http_pool, run_id, resume=False):
+        return self.manager(http_pool, run_id).sync(resume)
+
+    def test_pooled_sync_reuses_connections(self):
+        pool = utils.HTTPConnectionPool()
+        self.addCleanup(pool.clear)
+
+        for run_id in ('1', '2', '3'):
+            filepaths = self.sync(pool, run_id)
+            self.assertEqual(len(filepaths), 1)
+            self.assertEqual(filepaths[0].read_bytes(), _ARTIFACT)
+
+        # 3 runs x (listing + redirect + blob), all over one socket
+        self.assertEqual(len(self.server.auth_headers), 9)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_probe(self):
+        mgr = self.manager(None, '1')
+
+        self.server.uploaded = False
+        with self.assertRaises(utils.GitHubNotReadyException):
+            mgr.probe()
+
+        self.server.uploaded = True
+        self.assertEqual([record['name'] for record in mgr.probe()], ['linux-64'])
+        # only the listing is fetched, and GitHub is asked to filter it
+        self.assertEqual(self.server.listings, ['per_page=100&name=linux-64'] * 2)
+        self.assertEqual(self.server.ranges, [])
+
+    def test_unpooled_sync(self):
+        filepaths = self.sync(None, '1')
+
+        self.assertEqual(filepaths[0].read_bytes(), _ARTIFACT)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_resumed_sync_only_fetches_missing_bytes(self):
+        pool = utils.HTTPConnectionPool()
+        self.addCleanup(pool.clear)
+        mgr = self.manager(pool, '1')
+        partial = mgr.partial_path({'name': 'linux-64'})
+        partial.parent.mkdir()
+        partial.write_bytes(_ARTIFACT[:1000])
+
+        filepaths = mgr.sync(resume=True)
+
+        self.assertEqual(filepaths[0].read_bytes(), _ARTIFACT)
+        self.assertEqual(self.server.ranges, ['bytes=1000-'])
+        self.assertFalse(partial.exists())
+
+    def test_concurrent_resumes_take_turns(self):
+        # one chain per epoch, all fetching the same artifact at once
+        mgrs = []
+        for root in ('2021.8', '2021.11'):
+            (self.tmp_pathlib / root).mkdir()
+            mgr = utils.GitHubArtifactManager('token', 'qiime2/q2-foo', '1', 'linux-64', self.tmp_pathlib / root,
+                                              partial_pathlib=self.tmp_pathlib / 'partial')
+            mgr.base_url = self.base_url
+            mgrs.append(mgr)
+        self.server.digest = None
+        partial = mgrs[0].partial_path({'name': 'linux-64'})
+
+        filepaths = []
+        waiting = threading.Thread(target=lambda: filepaths.extend(mgrs[1].sync(resume=True)))
+        with mgrs[0].partial_lock(partial):
+            waiting.start()
+            waiting.join(0.5)
+            self.assertTrue(waiting.is_alive())
+            self.assertFalse(partial.exists())
+            # the lock holder downloads and moves its file away undisturbed
+            download = self.tmp_pathlib / '2021.8' / 'linux-64'
+            mgrs[0]._resume_binary_file('%s/zip/linux-64' % (self.base_url,), download, partial, None)
+        waiting.join()
+        filepaths.append(download)
+
+        self.assertEqual([fp.read_bytes() for fp in filepaths], [_ARTIFACT, _ARTIFACT])
+
+    def test_resumed_sync_digest_mismatch(self):
+        self.server.digest = 'sha256:%s' % (hashlib.sha256(b'nope').hexdigest(),)
+        mgr = self.manager(None, '1')
+
+        with self.assertRaises(utils.ArtifactDigestException):
+            mgr.sync(resume=True)
+
+        # the bad download is discarded so the retry starts from scratch
+        self.assertFalse(mgr.partial_path({'name': 'linux-64'}).exists())
+
+
+class ExtractCondaPackagesTests(test.SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmp_pathlib = pathlib.Path(tmpdir.name)
+
+    def test_extract_only_matching_packages(self):
+        zip_fp = self.tmp_pathlib / 'linux-64'
+        with zipfile.ZipFile(zip_fp, 'w') as zip_fh:
+            zip_fh.writestr('linux-64/q2-foo-2021.8.0-py38_0.tar.bz2', b'tarball')
+            zip_fh.writestr('linux-64/q2-foo-2021.8.0-py38_0.conda', b'conda')
+            zip_fh.writestr('linux-64/q2-bar-2021.8.0-py38_0.tar.bz2', b'nope')
+            zip_fh.writestr('linux-64/repodata.json', b'{}')
+            zip_fh.writestr('noarch/', b'')
+
+        channel = self.tmp_pathlib / 'tested'
+        utils.bootstrap_pkgs_dir(channel)
+
+        extracted = utils.extract_conda_packages(zip_fp, 'q2-foo', channel)
+
+        self.assertEqual(sorted(fp.name for fp in extracted),
+                         ['q2-foo-2021.8.0-py38_0.conda', 'q2-foo-2021.8.0-py38_0.tar.bz2'])
+        self.assertEqual(sorted(fp.name for fp in (channel / 'linux-64').iterdir()),
+                         ['q2-foo-2021.8.0-py38_0.conda', 'q2-foo-2021.8.0-py38_0.tar.bz2'])
+        self.assertEqual((channel / 'linux-64' / 'q2-foo-2021.8.0-py38_0.tar.bz2').read_bytes(), b'tarball')
+
+
+class _GhApiStandIn:
+    """Just enough of the ghapi git data and contents endpoints, in memory."""
+
+    def __init__(self, files):
+        self.calls = collections.Counter()
+        self.shas = ('%040x' % (i,) for i in itertools.count(1))
+        self.blobs, self.trees, self.commits = {}, {}, {}
+        tree = {path: self.add_blob(content.encode('utf-8')) for path, content in files.items()}
+        self.refs = {'heads/main': self.add_commit('root', self.add_tree(tree), [])}
+
+        endpoints = {
+            'git': ['get_ref', 'create_ref', 'update_ref', 'get_commit', 'create_commit',
+                    'get_tree', 'create_tree', 'get_blob'],
+            'repos': ['get_content', 'get_branch', 'create_or_update_file_contents'],
+        }
+        for group, names in endpoints.items():
+            setattr(self, group, types.SimpleNamespace(**{name: self.counted(name) for name in names}))
+
+    def counted(self, name):
+        def endpoint(**kwargs):
+            self.calls[name] += 1
+            return getattr(self, '_' + name)(**kwargs)
+        return endpoint
+
+    def add_blob(self, content):
+        sha = next(self.shas)
+        self.blobs[sha] = content
+        return sha
+
+    def add_tree(self, entries):
+        sha = next(self.shas)
+        self.trees[sha] = entries
+        return sha
+
+    def add_commit(self, message, tree, parents):
+        sha = next(self.shas)
+        self.commits[sha] = {'sha': sha, 'message': message, 'tree': {'sha': tree}, 'parents': parents}
+        return sha
+
+    def read(self, ref, path):
+        tree = self.trees[self.commits[self.refs[ref]]['tree']['sha']]
+        return yaml.safe_load(self.blobs[tree[path]])
+
+    def _get_ref(self, owner, repo, ref):
+        if ref not in self.refs:
+            raise HTTP404NotFoundError('', {}, None)
+        return {'object': {'sha': self.refs[ref]}}
+
+    def _create_ref(self, owner, repo, ref, sha):
+        self.refs[ref[len('refs/'):]] = sha
+
+    def _update_ref(self, owner, repo, ref, sha, force):
+        if not force and self.commits[sha]['parents'] != [self.refs[ref]]:
+            raise HTTP422UnprocessableEntityError('', {}, None)
+        self.refs[ref] = sha
+
+    def _get_commit(self, owner, repo, commit_sha):
+        return self.commits[commit_sha]
+
+    def _create_commit(self, owner, repo, message, tree, parents):
+        return self.commits[self.add_commit(message, tree, parents)]
+
+    def _get_tree(self, owner, repo, tree_sha, recursive):
+        return {'truncated': False,
+                'tree': [{'path': path, 'type': 'blob', 'sha': sha} for path, sha in self.trees[tree_sha].items()]}
+
+    def _create_tree(self, owner, repo, base_tree, tree):
+        entries = dict(self.trees[base_tree])
+        entries.update({entry['path']: self.add_blob(entry['content'].encode('utf-8')) for entry in tree})
+        return {'sha': self.add_tree(entries)}
+
+    def _get_blob(self, owner, repo, file_sha):
+        return {'content': base64.b64encode(self.blobs[file_sha]).decode('utf-8')}
+
+
+class IntegrationGitRepoManagerTests(test.SimpleTestCase):
+    distros = ('core', 'tiny', 'plugins')
+
+    def setUp(self):
+        files = {}
+        for distro in self.distros:
+            files['2021.8/staged/%s/conda_build_config.yaml' % (distro,)] = 'q2_foo:\n- 2021.8.0.dev0\n'
+            files['2021.8/staged/%s/data.yaml' % (distro,)] = 'run:\n- q2-foo\nversion: 2021.8.0.dev0\n'
+        self.ghapi = _GhApiStandIn(files)
+
+        lock = mock.patch.object(utils.AdvisoryLockManager, 'hold', return_value=contextlib.nullcontext())
+        lock.start()
+        self.addCleanup(lock.stop)
+
+    def manager(self):
+        mgr = utils.IntegrationGitRepoManager('token', batch=True)
+        mgr.ghapi = self.ghapi
+        return mgr
+
+    def test_update_integration_is_one_commit(self):
+        package_versions = {distro: {'q2-foo': '2021.8.0.dev1', 'q2-bar': '2021.8.0.dev1'}
+                            for distro in self.distros}
+
+        self.manager().update_integration('integrate', '2021.8', 'staged', package_versions, '2021.8.0.dev1')
+
+        # one base tree read, a blob per recipe, then a single tree, commit and ref
+        self.assertEqual(self.ghapi.calls, {'get_ref': 2, 'get_commit': 1, 'get_tree': 1, 'get_blob': 6,
+                                            'create_tree': 1, 'create_commit': 1, 'create_ref': 1})
+        commit = self.ghapi.commits[self.ghapi.refs['heads/integrate']]
+        self.assertEqual(commit['parents'], [self.ghapi.refs['heads/main']])
+        self.assertTrue(commit['message'].startswith('updating 6 files\n\n'))
+        for distro in self.distros:
+            self.assertEqual(self.ghapi.read('heads/integrate', '2021.8/staged/%s/conda_build_config.yaml' % distro),
+                             {'q2_foo': ['2021.8.0.dev1'], 'q2_bar': ['2021.8.0.dev1']})
+            self.assertEqual(self.ghapi.read('heads/integrate', '2021.8/staged/%s/data.yaml' % distro),
+                             {'run': ['q2-bar', 'q2-foo'], 'version': '2021.8.0.dev1'})
+
+    def test_commit_lands_while_files_are_locked(self):
+        events = []
+
+        @contextlib.contextmanager
+        def hold(*scopes):
+            events.append(('lock', sorted(scope[-1] for scope in scopes)))
+            yield
+            events.append(('unlock', self.ghapi.calls.get('create_commit', 0)))
+
+        package_versions = {'core': {'q2-foo': '2021.8.0.dev1'}}
+        with mock.patch.object(utils.AdvisoryLockManager, 'hold', side_effect=hold):
+            self.manager().update_integration('integrate', '2021.8', 'staged', package_versions, '2021.8.0.dev1')
+
+        self.assertEqual(events[0], ('lock', ['2021.8/staged/core/conda_build_config.yaml',
+                                              '2021.8/staged/core/data.yaml']))
+        # the outermost block only lets go once the single commit exists
+        self.assertEqual(events[-1], ('unlock', 1))
+
+    def test_update_conda_build_config_on_main(self):
+        base_sha = self.ghapi.refs['heads/main']
+
+        self.manager().update_conda_build_config('main', '2021.8', 'staged', {'core': {'q2-foo': '2021.8.0.dev1'}})
+
+        self.assertEqual(self.ghapi.calls['update_ref'], 1)
+        self.assertEqual(self.ghapi.calls['create_commit'], 1)
+        self.assertEqual(self.ghapi.commits[self.ghapi.refs['heads/main']]['parents'], [base_sha])
+        self.assertEqual(self.ghapi.read('heads/main', '2021.8/staged/core/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev1']})
+        self.assertEqual(self.ghapi.read('heads/main', '2021.8/staged/tiny/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev0']})
+
+    def test_concurrent_commit_to_other_files_is_retried(self):
+        create_commit = self.ghapi.git.create_commit
+
+        def racing_create_commit(**kwargs):
+            # another distro's update lands on main while this one is in flight
+            self.ghapi.git.create_commit = create_commit
+            other = self.manager()
+            other.update_conda_build_config('main', '2021.8', 'staged', {'tiny': {'q2-foo': '2021.8.0.dev2'}})
+            return create_commit(**kwargs)
+        self.ghapi.git.create_commit = racing_create_commit
+
+        self.manager().update_conda_build_config('main', '2021.8', 'staged', {'core': {'q2-foo': '2021.8.0.dev1'}})
+
+        self.assertEqual(self.ghapi.calls['create_commit'], 3)
+        self.assertEqual(self.ghapi.read('heads/main', '2021.8/staged/core/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev1']})
+        self.assertEqual(self.ghapi.read('heads/main', '2021.8/staged/tiny/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev2']})
+
+    def race(self, endpoint, package_versions):
+        # someone commits to main (without our locks, like a hand-made PR)
+        # the first time this endpoint is hit
+        group = self.ghapi.repos if endpoint == 'create_or_update_file_contents' else self.ghapi.git
+        original = getattr(group, endpoint)
+
+        def racing(**kwargs):
+            setattr(group, endpoint, original)
+            self.manager().update_conda_build_config('main', '2021.8', 'staged', package_versions)
+            return original(**kwargs)
+        setattr(group, endpoint, racing)
+
+    def test_concurrent_commit_to_a_staged_file_is_redone(self):
+        self.race('create_commit', {'core': {'q2-bar': '2021.8.0.dev1'}})
+
+        self.manager().update_conda_build_config('main', '2021.8', 'staged', {'core': {'q2-foo': '2021.8.0.dev1'}})
+
+        self.assertEqual(self.ghapi.read('heads/main', '2021.8/staged/core/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev1'], 'q2_bar': ['2021.8.0.dev1']})
+
+    def test_branch_moved_before_commit_is_redone(self):
+        # lands between our read and our commit, so the ref update itself
+        # would go through
+        self.race('get_blob', {'core': {'q2-bar': '2021.8.0.dev1'}})
+
+        self.manager().update_conda_build_config('main', '2021.8', 'staged', {'core': {'q2-foo': '2021.8.0.dev1'}})
+
+        self.assertEqual(self.ghapi.read('heads/main', '2021.8/staged/core/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev1'], 'q2_bar': ['2021.8.0.dev1']})
+        self.assertEqual(self.ghapi.calls['create_commit'], 2)
+
+    def test_redone_edit_is_read_under_the_locks(self):
+        held, unlocked = [], []
+
+        @contextlib.contextmanager
+        def hold(*scopes):
+            held.append(scopes)
+            yield
+            held.pop()
+            unlocked.append(self.ghapi.calls['create_commit'])
+
+        get_blob = self.ghapi.git.get_blob
+        reads = []
+
+        def recording_get_blob(**kwargs):
+            reads.append(len(held))
+            return get_blob(**kwargs)
+        self.ghapi.git.get_blob = recording_get_blob
+        self.race('create_commit', {'core': {'q2-bar': '2021.8.0.dev1'}})
+
+        with mock.patch.object(utils.AdvisoryLockManager, 'hold', side_effect=hold):
+            self.manager().update_conda_build_config('main', '2021.8', 'staged',
+                                                     {'core': {'q2-foo': '2021.8.0.dev1'}})
+
+        # ours, the racer's, then ours again after the conflict
+        self.assertEqual(len(reads), 3)
+        self.assertTrue(all(reads))
+        # the racer lets go after its commit, we only do after our redone one
+        self.assertEqual(unlocked, [1, 3])
+
+    def test_redone_edit_is_checked_again(self):
+        self.race('create_commit', {'core': {'q2-foo': '2021.8.0.dev2'}})
+
+        with self.assertRaisesRegex(Exception, 'Package version confusion'):
+            self.manager().update_conda_build_config('main', '2021.8', 'staged',
+                                                     {'core': {'q2-foo': '2021.8.0.dev1'}})
+
+        self.assertEqual(self.ghapi.read('heads/main', '2021.8/staged/core/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev2']})
+
+
+class _CursorStandIn:
+    def __init__(self, busy=(), pgcode=utils.PG_LOCK_NOT_AVAILABLE):
+        self.busy = busy
+        self.pgcode = pgcode
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        if 'pg_advisory_lock' in sql and params[0] in self.busy:
+            # django wraps the driver's error, which carries the SQLSTATE
+            cause = Exception('canceling statement')
+            cause.pgcode = self.pgcode
+            raise OperationalError('canceling statement') from cause
+        self.statements.append((sql.split('(')[0], *params))
+        self.result = [[params[0] not in self.busy]] if params else []
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class AdvisoryLockManagerTests(test.SimpleTestCase):
+    def test_lock_keys(self):
+        key = utils.advisory_lock_key('2021.8', 'staged', 'core', '2021.8/staged/core/conda_build_config.yaml')
+
+        self.assertEqual(key, utils.advisory_lock_key('2021.8', 'staged', 'core',
+                                                      '2021.8/staged/core/conda_build_config.yaml'))
+        self.assertNotEqual(key, utils.advisory_lock_key('2021.8', 'staged', 'tiny',
+                                                         '2021.8/staged/tiny/conda_build_config.yaml'))
+        self.assertTrue(-2 ** 63 <= key < 2 ** 63)
+
+    def test_hold_locks_in_sorted_order(self):
+        scopes = [('2021.8', 'staged', distro) for distro in ('core', 'tiny', 'plugins')]
+        keys = sorted(utils.advisory_lock_key(*scope) for scope in scopes)
+        cursor = _CursorStandIn()
+
+        with mock.patch.object(utils, 'connection') as connection:
+            connection.cursor.return_value = cursor
+            locks = utils.AdvisoryLockManager(timeout=5)
+            with locks.hold(*scopes, scopes[0]):
+                pass
+
+        locked = [('SELECT pg_advisory_lock', key) for key in keys]
+        self.assertEqual([stmt for stmt in cursor.statements if stmt[0] == 'SELECT pg_advisory_lock'], locked)
+        self.assertEqual(cursor.statements[-3:], [('SELECT pg_advisory_unlock', key) for key in reversed(keys)])
+        # each wait is bounded by whatever is left of the timeout
+        self.assertEqual(cursor.statements[0][0], 'SELECT set_config')
+        self.assertLessEqual(int(cursor.statements[0][1][:-2]), 5000)
+        self.assertEqual(cursor.statements[1:3], [locked[0], ('RESET lock_timeout;',)])
+        self.assertIsNotNone(locks.wait_time)
+        self.assertIsNotNone(locks.hold_time)
+
+    def test_hold_times_out(self):
+        keys = sorted(utils.advisory_lock_key(distro) for distro in ('core', 'tiny'))
+        cursor = _CursorStandIn(busy=keys[1:])
+
+        with mock.patch.object(utils, 'connection') as connection:
+            connection.cursor.return_value = cursor
+            with self.assertRaises(utils.AdvisoryLockNotReadyException), self.assertLogs(utils.logger, 'WARNING'):
+                with utils.AdvisoryLockManager(timeout=5).hold(('core',), ('tiny',)):
+                    self.fail('locks should not have been granted')
+
+        # only the lock that was granted gets released
+        self.assertEqual([stmt for stmt in cursor.statements if stmt[0] == 'SELECT pg_advisory_unlock'],
+                         [('SELECT pg_advisory_unlock', keys[0])])
+
+    def test_other_errors_are_not_taken_for_a_busy_lock(self):
+        # e.g. query_canceled, which a lock timeout doesn't raise
+        cursor = _CursorStandIn(busy=[7], pgcode='57014')
+
+        with mock.patch.object(utils, 'connection') as connection:
+            connection.cursor.return_value = cursor
+            with self.assertRaises(OperationalError):
+                with utils.advisory_lock(7, timeout=5):
+                    self.fail('lock should not have been granted')
+
+        self.assertEqual(cursor.statements[-1], ('RESET lock_timeout;',))
+        self.assertNotIn('SELECT pg_advisory_unlock', [stmt[0] for stmt in cursor.statements])
+
+    def test_try_lock_without_timeout(self):
+        cursor = _CursorStandIn(busy=[7])
+
+        with mock.patch.object(utils, 'connection') as connection:
+            connection.cursor.return_value = cursor
+            with utils.advisory_lock(7) as lock:
+                self.assertFalse(lock)
+            with utils.advisory_lock(8) as lock:
+                self.assertTrue(lock)
+
+        self.assertEqual(cursor.statements, [('SELECT pg_try_advisory_lock', 7),
+                                             ('SELECT pg_try_advisory_lock', 8),
+                                             ('SELECT pg_advisory_unlock', 8)])
+
+
+@unittest.skipIf(shutil.which('git') is None, 'requires git')
+class LocalMirrorGitRepoManagerTests(test.SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmp_pathlib = pathlib.Path(tmpdir.name)
+
+        # the "GitHub" side is a plain bare repo seeded from a scratch checkout
+        work = self.tmp_pathlib / 'work'
+        (work / '2021.8' / 'staged' / 'core').mkdir(parents=True)
+        (work / '2021.8' / 'staged' / 'core' / 'conda_build_config.yaml').write_text('q2_foo:\n- 2021.8.0.dev0\n')
+        (work / '2021.8' / 'staged' / 'core' / 'data.yaml').write_text('run:\n- q2-foo\nversion: 2021.8.0.dev0\n')
+        self.remote = self.tmp_pathlib / 'remote.git'
+        for args in (['init', '--quiet', '-b', 'main', str(work)],
+                     ['-C', str(work), 'add', '.'],
+                     ['-C', str(work), '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                      'commit', '--quiet', '-m', 'seed'],
+                     ['clone', '--quiet', '--bare', str(work), str(self.remote)]):
+            subprocess.run(['git', *args], check=True, capture_output=True)
+
+        self.ghapi = _GhApiStandIn({})
+        lock = mock.patch.object(utils.AdvisoryLockManager, 'hold', return_value=contextlib.nullcontext())
+        lock.start()
+        self.addCleanup(lock.stop)
+
+    def manager(self):
+        mgr = utils.LocalMirrorGitRepoManager('token', mirror_path=self.tmp_pathlib / 'mirror.git',
+                                              remote_url=str(self.remote))
+        mgr.ghapi = self.ghapi
+        return mgr
+
+    def remote_yaml(self, ref, path):
+        result = subprocess.run(['git', '--git-dir', str(self.remote), 'show', '%s:%s' % (ref, path)],
+                                check=True, capture_output=True)
+        return yaml.safe_load(result.stdout)
+
+    def test_update_integration_without_api_calls(self):
+        package_versions = {'core': {'q2-foo': '2021.8.0.dev1', 'q2-bar': '2021.8.0.dev1'}}
+
+        self.manager().update_integration('integrate', '2021.8', 'staged', package_versions, '2021.8.0.dev1')
+
+        self.assertEqual(self.ghapi.calls, {})
+        self.assertEqual(self.remote_yaml('integrate', '2021.8/staged/core/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev1'], 'q2_bar': ['2021.8.0.dev1']})
+        self.assertEqual(self.remote_yaml('integrate', '2021.8/staged/core/data.yaml'),
+                         {'run': ['q2-bar', 'q2-foo'], 'version': '2021.8.0.dev1'})
+        log = subprocess.run(['git', '--git-dir', str(self.remote), 'log', '--format=%s', 'integrate'],
+                             check=True, capture_output=True).stdout.decode('utf-8').split()
+        self.assertEqual(log, ['updating', '2', 'files', 'seed'])
+
+    def test_rejected_push_redoes_the_edit(self):
+        mgr = self.manager()
+        mgr.construct_interface()
+        other = utils.LocalMirrorGitRepoManager('token', mirror_path=self.tmp_pathlib / 'other.git',
+                                                remote_url=str(self.remote))
+        other.update_conda_build_config('main', '2021.8', 'staged', {'core': {'q2-bar': '2021.8.0.dev1'}})
+
+        mgr.update_conda_build_config('main', '2021.8', 'staged', {'core': {'q2-foo': '2021.8.0.dev1'}})
+
+        self.assertEqual(self.remote_yaml('main', '2021.8/staged/core/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev1'], 'q2_bar': ['2021.8.0.dev1']})
+
+    def test_fetches_incrementally_into_existing_mirror(self):
+        self.manager().update_conda_build_config('main', '2021.8', 'staged', {'core': {'q2-foo': '2021.8.0.dev1'}})
+        self.manager().update_conda_build_config('main', '2021.8', 'staged', {'core': {'q2-foo': '2021.8.0.dev2'}})
+
+        self.assertEqual(self.remote_yaml('main', '2021.8/staged/core/conda_build_config.yaml'),
+                         {'q2_foo': ['2021.8.0.dev2']})
+        self.assertEqual(self.ghapi.calls, {})
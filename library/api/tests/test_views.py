@@ -0,0 +1,148 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import datetime
+import json
+import types
+from unittest import mock
+
+from django import test
+from django.urls import reverse
+from django.utils import timezone
+
+from library.api import forms, tasks
+from library.api.models import IntakeRequest
+from library.packages.models import Epoch, Package
+
+
+@test.override_settings(INTAKE_DEDUP_WINDOW=60)
+class PackageIntegrationIntakeTests(test.TestCase):
+    def setUp(self):
+        Epoch.objects.create(name='2021.11', include_in_ci=True, is_dev=True)
+        self.package = Package.objects.create(name='q2-foo', repository='qiime2/q2-foo')
+        patcher = mock.patch.object(tasks, 'handle_new_package_build')
+        self.handle_new_package_build = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pipelines = iter(['pipeline-1', 'pipeline-2'])
+        self.handle_new_package_build.side_effect = lambda config: types.SimpleNamespace(id=next(self.pipelines))
+
+    def post(self, **overrides):
+        data = dict(token=str(self.package.token), run_id='1', version='2021.11.0.dev1', package_name='q2-foo',
+                    repository='qiime2/q2-foo', artifact_name='q2-foo-linux-64')
+        data.update(overrides)
+        response = self.client.post(reverse('api:package-integrate'), data)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_duplicates_get_the_in_flight_pipeline(self):
+        self.assertEqual(self.post(), {'status': 'ok', 'pipeline_id': 'pipeline-1', 'duplicate': False})
+        with self.assertLogs('library.api.views', 'INFO'):
+            self.assertEqual(self.post(), {'status': 'ok', 'pipeline_id': 'pipeline-1', 'duplicate': True})
+            self.post()
+
+        self.assertEqual(self.handle_new_package_build.call_count, 1)
+        record = IntakeRequest.objects.get()
+        self.assertEqual((record.hits, record.misses), (2, 1))
+
+    def test_distinct_requests_each_launch(self):
+        self.post()
+        self.post(artifact_name='q2-foo-osx-64')
+
+        self.assertEqual(self.handle_new_package_build.call_count, 2)
+        self.assertEqual(IntakeRequest.objects.count(), 2)
+
+    def test_rerun_after_the_window_launches_again(self):
+        self.post()
+        IntakeRequest.objects.update(claimed_at=timezone.now() - datetime.timedelta(seconds=120))
+
+        self.assertEqual(self.post()['pipeline_id'], 'pipeline-2')
+        record = IntakeRequest.objects.get()
+        self.assertEqual((record.hits, record.misses), (0, 2))
+
+    def test_failed_launch_is_released(self):
+        self.handle_new_package_build.side_effect = RuntimeError('broker is down')
+        with self.assertRaises(RuntimeError):
+            self.post()
+
+        self.handle_new_package_build.side_effect = lambda config: types.SimpleNamespace(id='pipeline-1')
+        self.assertEqual(self.post()['duplicate'], False)
+
+
+@test.override_settings(INTAKE_DEDUP_WINDOW=60)
+class BulkPackageIntegrationTests(test.TestCase):
+    def setUp(self):
+        Epoch.objects.create(name='2021.11', include_in_ci=True, is_dev=True)
+        Epoch.objects.create(name='2021.8', include_in_ci=True, is_dev=False)
+        self.packages = [Package.objects.create(name='q2-%d' % (i,), repository='qiime2/q2-%d' % (i,))
+                         for i in range(10)]
+        patcher = mock.patch.object(tasks, 'handle_new_package_builds',
+                                    return_value=types.SimpleNamespace(id='pipeline-1'))
+        self.handle_new_package_builds = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def builds(self):
+        return [dict(token=str(package.token), run_id=str(i), version='2021.11.0.dev1', package_name=package.name,
+                     repository=package.repository, artifact_name=arch, build_target='' if i % 2 else 'release')
+                for i, package in enumerate(self.packages) for arch in ('linux-64', 'osx-64')]
+
+    def post(self, builds):
+        return self.client.post(reverse('api:package-integrate-bulk'), json.dumps(builds),
+                                content_type='application/json')
+
+    def test_validated_in_two_queries(self):
+        form = forms.BulkPackageIntegrationForm({'builds': json.dumps(self.builds())})
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+
+        with self.assertNumQueries(2):
+            configs = form.is_known()
+
+        self.assertEqual(len(configs), 20)
+        self.assertEqual([config['epoch_names'] for config in configs[:4]],
+                         [['2021.8'], ['2021.8'], ['2021.11'], ['2021.11']])
+
+    def test_one_pipeline_for_the_whole_request(self):
+        builds = self.builds()
+        builds[0]['token'] = '00000000-0000-0000-0000-000000000000'
+
+        response = self.post(builds)
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['builds']
+        self.assertEqual(results[0], {'pipeline_id': None, 'duplicate': False})
+        self.assertEqual(results[1:], [{'pipeline_id': 'pipeline-1', 'duplicate': False}] * 19)
+        [configs], _ = self.handle_new_package_builds.call_args
+        self.assertEqual(len(configs), 19)
+
+        # a rerun of the whole matrix launches nothing new
+        with self.assertLogs('library.api.views', 'INFO'):
+            results = self.post(builds).json()['builds']
+        self.assertEqual(results[1:], [{'pipeline_id': 'pipeline-1', 'duplicate': True}] * 19)
+        self.assertEqual(self.handle_new_package_builds.call_count, 1)
+
+    def test_invalid_builds(self):
+        builds = self.builds()
+        del builds[1]['run_id']
+
+        response = self.post(builds)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'], {'builds': ['1.run_id: This field is required.']})
+        self.assertEqual(self.post({'not': 'a list'}).status_code, 400)
+        self.assertEqual(self.post(self.builds() * 20).status_code, 400)
+        self.handle_new_package_builds.assert_not_called()
+
+    def test_undecodable_body(self):
+        for body in (b'[{"token": "\xff"}]', b'[{"token": '):
+            with self.subTest(body=body):
+                response = self.client.post(reverse('api:package-integrate-bulk'), body,
+                                            content_type='application/json')
+
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'status': 'error', 'errors': {'builds': ['Enter a valid JSON.']}})
+        self.handle_new_package_builds.assert_not_called()
@@ -17,6 +17,7 @@ app_name = 'api'
 urlpatterns = [
     path('packages/', include([
         path('integrate/', views.prepare_packages_for_integration, name='package-integrate'),
+        path('integrate/bulk/', views.prepare_bulk_packages_for_integration, name='package-integrate-bulk'),
         path('stage/', views.stage_metapackage, name='package-stage'),
         path('pass/', views.pass_metapackage, name='package-pass'),
     ])),
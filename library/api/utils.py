@@ -10,22 +10,38 @@ import base64
 import collections
 import contextlib
 import copy
+import dataclasses
+import fcntl
+import fnmatch
+import functools
+import hashlib
+import http.client
 import json
+import logging
 import os
 from packaging import version
 import pathlib
 import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
 import urllib.request
 import urllib.error
 import zipfile
 
+from celery import Task
 from django import conf
-from django.db import connection
-from fastcore.utils import HTTP404NotFoundError
+from django.db import OperationalError, connection
+from fastcore.utils import HTTP404NotFoundError, HTTP422UnprocessableEntityError
 from ghapi.all import GhApi
 import yaml
 
 
+logger = logging.getLogger(__name__)
+
+
 class GitHubNotReadyException(Exception):
     pass
 
@@ -34,14 +50,177 @@ class AdvisoryLockNotReadyException(Exception):
     pass
 
 
+class ArtifactDigestException(Exception):
+    pass
+
+
+class IntegrationRefConflictException(Exception):
+    pass
+
+
+class UnresolvedCfgException(Exception):
+    pass
+
+
+# artifact zips are capped at 100 MB, so stream them in bounded chunks rather
+# than buffering whole responses in memory
+HTTP_CHUNK_SIZE = 1024 * 1024
+HTTP_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class PooledHTTPResponse:
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+        # a connection can only be reused once its response body is drained
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HTTPConnectionPool:
+    """Keep-alive connections, pooled per (scheme, host).
+
+    Instances are safe to share between threads, and will discard any sockets
+    inherited across a fork (e.g. celery's prefork pool), so a single
+    module-level pool can be shared by everything running in a worker process.
+    """
+
+    def __init__(self, maxsize=4, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def connect(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        if scheme == 'http':
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise urllib.error.URLError('Unsupported URL scheme: %s' % (scheme,))
+
+    def acquire(self, key):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.idle.clear()
+                self.pid = os.getpid()
+            idle = self.idle[key]
+            if idle:
+                return idle.pop(), True
+        return self.connect(key), False
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle[key]
+            if self.pid == os.getpid() and len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+
+    def send(self, key, method, path, headers):
+        conn, reused = self.acquire(key)
+        try:
+            conn.request(method, path, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, OSError) as exc:
+            conn.close()
+            if not reused:
+                raise urllib.error.URLError(exc)
+        # the server closed an idle keep-alive connection out from under us,
+        # try exactly once more on a fresh socket
+        conn = self.connect(key)
+        try:
+            conn.request(method, path, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, OSError) as exc:
+            conn.close()
+            raise urllib.error.URLError(exc)
+
+    def request(self, url, headers=None, method='GET', max_redirects=5):
+        headers = dict(headers or {})
+        origin = urllib.parse.urlsplit(url).netloc
+
+        for _ in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            conn, response = self.send(key, method, path, headers)
+            resp = PooledHTTPResponse(self, key, conn, response, url)
+
+            if resp.status in HTTP_REDIRECT_CODES and resp.headers.get('location'):
+                with resp:
+                    resp.read()
+                url = urllib.parse.urljoin(url, resp.headers['location'])
+                # artifact downloads redirect to pre-signed blob storage urls,
+                # don't leak our credentials to a different host
+                if urllib.parse.urlsplit(url).netloc != origin:
+                    headers = {k: v for k, v in headers.items() if k.lower() != 'authorization'}
+                continue
+
+            if not 200 <= resp.status < 300:
+                with resp:
+                    resp.read()
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+
+            return resp
+
+        raise urllib.error.HTTPError(url, resp.status, 'Too many redirects', resp.headers, None)
+
+
+_HTTP_POOL = None
+
+
+def get_http_pool():
+    global _HTTP_POOL
+    if _HTTP_POOL is None:
+        _HTTP_POOL = HTTPConnectionPool()
+    return _HTTP_POOL
+
+
 class GitHubArtifactManager:
-    def __init__(self, github_token, repository, run_id, artifact_name, tmpdir):
+    def __init__(self, github_token, repository, run_id, artifact_name, tmpdir, http_pool=None,
+                 partial_pathlib=None):
         self.github_token = github_token
         self.github_repository = repository
         self.run_id = run_id
         self.artifact_name = artifact_name
         self.root_pathlib = tmpdir
         self.base_url = 'https://api.github.com'
+        # when `None`, every request opens (and tears down) its own connection
+        self.http_pool = http_pool
+        # interrupted downloads are kept here so that a retry can pick up where
+        # the last attempt left off --- this should outlive `tmpdir`
+        self.partial_pathlib = partial_pathlib if partial_pathlib is not None else tmpdir
 
         self.validate_config()
 
@@ -75,11 +254,17 @@ class GitHubArtifactManager:
                 request.add_header(k, v)
         return request
 
+    def open_url(self, url, headers=None):
+        if self.http_pool is None:
+            return urllib.request.urlopen(self.build_request(url, headers))
+
+        headers = {'authorization': 'Bearer %s' % (self.github_token, ), **(headers or {})}
+        return self.http_pool.request(url, headers)
+
     def fetch_json_data(self, url):
         headers = {'content-type': 'application/json'}
-        request = self.build_request(url, headers)
-        response = urllib.request.urlopen(request)
-        data = response.read()
+        with self.open_url(url, headers) as response:
+            data = response.read()
         decoded = data.decode('utf-8')
         return json.loads(decoded)
 
@@ -88,21 +273,107 @@ class GitHubArtifactManager:
             raise Exception('Attempting to overwrite file that already exists: %s' % (download_pathlib,))
 
         try:
-            request = self.build_request(url)
-            with urllib.request.urlopen(request) as resp, \
+            with self.open_url(url) as resp, \
                     download_pathlib.open('wb') as save_fh:
-                shutil.copyfileobj(resp, save_fh)
-        except Exception:
-            raise urllib.error.HTTPError
+                shutil.copyfileobj(resp, save_fh, HTTP_CHUNK_SIZE)
+        except urllib.error.URLError:
+            download_pathlib.unlink(missing_ok=True)
+            raise
+        except (http.client.HTTPException, OSError) as exc:
+            download_pathlib.unlink(missing_ok=True)
+            raise urllib.error.URLError(exc)
+
+    def resume_binary_file(self, url, download_pathlib, partial_pathlib, digest=None):
+        if download_pathlib.exists():
+            raise Exception('Attempting to overwrite file that already exists: %s' % (download_pathlib,))
+
+        # every epoch's chain fetches the same artifact at the same time, so
+        # only one of them may append to (and finally move away) the partial
+        # file --- the rest wait, then start over from their own fresh one
+        with self.partial_lock(partial_pathlib):
+            self._resume_binary_file(url, download_pathlib, partial_pathlib, digest)
+
+    @contextlib.contextmanager
+    def partial_lock(self, partial_pathlib):
+        partial_pathlib.parent.mkdir(parents=True, exist_ok=True)
+        # a sidecar, since the partial file itself is moved out from under us
+        with open(partial_pathlib.with_name(partial_pathlib.name + '.lock'), 'w') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            yield
 
-    def fetch_artifact(self, record):
+    def _resume_binary_file(self, url, download_pathlib, partial_pathlib, digest):
+        offset = partial_pathlib.stat().st_size if partial_pathlib.exists() else 0
+        headers = {'range': 'bytes=%d-' % (offset,)} if offset else None
+
+        try:
+            resp = self.open_url(url, headers)
+        except urllib.error.HTTPError as exc:
+            # 416: the partial file already holds every byte the server has
+            if exc.code != 416 or not offset:
+                raise
+            resp = None
+
+        if resp is not None:
+            with resp:
+                mode = 'ab'
+                if offset and resp.status != 206:
+                    # the server ignored our range, so it is sending everything
+                    mode = 'wb'
+                elif offset and not resp.headers.get('content-range', '').startswith('bytes %d-' % (offset,)):
+                    partial_pathlib.unlink()
+                    raise urllib.error.URLError('Unexpected content-range: %s' %
+                                                (resp.headers.get('content-range'),))
+
+                try:
+                    with partial_pathlib.open(mode) as save_fh:
+                        shutil.copyfileobj(resp, save_fh, HTTP_CHUNK_SIZE)
+                except (http.client.HTTPException, OSError) as exc:
+                    # keep whatever made it to disk, the next attempt resumes from there
+                    raise urllib.error.URLError(exc)
+
+        self.verify_digest(partial_pathlib, digest)
+        shutil.move(str(partial_pathlib), str(download_pathlib))
+
+    def verify_digest(self, fp_pathlib, digest):
+        if not digest:
+            return
+
+        algorithm, _, expected = digest.partition(':')
+        hasher = hashlib.new(algorithm)
+        with fp_pathlib.open('rb') as fh:
+            while chunk := fh.read(HTTP_CHUNK_SIZE):
+                hasher.update(chunk)
+
+        if hasher.hexdigest() != expected:
+            # start over from scratch next time, these bytes can't be trusted
+            fp_pathlib.unlink()
+            raise ArtifactDigestException('Digest mismatch for %s: expected %s, got %s:%s' %
+                                          (fp_pathlib.name, digest, algorithm, hasher.hexdigest()))
+
+    def partial_path(self, record):
+        fn = '%s-%s-%s.zip.part' % (self.github_repository.replace('/', '-'), self.run_id,
+                                    record.get('id', record['name']))
+        return self.partial_pathlib / fn
+
+    def fetch_artifact(self, record, resume=False):
         download_path = self.root_pathlib / record['name']
-        self.fetch_binary_file(record['archive_download_url'], download_path)
+        if resume:
+            # `digest` is only populated for artifacts uploaded with
+            # actions/upload-artifact v4 or newer
+            self.resume_binary_file(record['archive_download_url'], download_path,
+                                    self.partial_path(record), record.get('digest'))
+        else:
+            self.fetch_binary_file(record['archive_download_url'], download_path)
         return download_path
 
-    def fetch_artifact_records(self):
+    def fetch_artifact_records(self, name=None):
         url = '%s/repos/%s/actions/runs/%s/artifacts' \
             % (self.base_url, self.github_repository, self.run_id)
+        # the most github will list at once, so a run's whole matrix fits
+        params = {'per_page': 100}
+        if name is not None:
+            params['name'] = name
+        url += '?%s' % (urllib.parse.urlencode(params),)
         records = self.fetch_json_data(url)
         return records
 
@@ -121,25 +392,67 @@ class GitHubArtifactManager:
 
         return filtered_records
 
-    def download_artifacts(self, records):
-        return [self.fetch_artifact(record) for record in records]
+    def probe(self):
+        # only list this one artifact, so polling stays cheap until it shows up
+        records = self.fetch_artifact_records(name=self.artifact_name)
+        return self.filter_and_validate_artifact_records(records)
+
+    def download_artifacts(self, records, resume=False):
+        return [self.fetch_artifact(record, resume) for record in records]
 
     def validate_local_filepaths(self, filepaths):
         # TODO: implement this
         return filepaths
 
-    def sync(self):
+    def sync(self, resume=False):
         records = self.fetch_artifact_records()
         filtered_records = self.filter_and_validate_artifact_records(records)
-        local_filepaths = self.download_artifacts(filtered_records)
+        local_filepaths = self.download_artifacts(filtered_records, resume)
         validated_filepaths = self.validate_local_filepaths(local_filepaths)
         return validated_filepaths
 
 
-def unzip(fp_pathlib):
-    new_name = '%s_unzipped' % fp_pathlib.name
+CONDA_PACKAGE_EXTENSIONS = ('.tar.bz2', '.conda')
+
+
+def extract_conda_packages(fp_pathlib, package_name, channel):
+    """Copy `package_name`'s conda packages out of an artifact zip.
+
+    Only the matching members listed in the zip's central directory are read,
+    and each is streamed straight to `<channel>/<arch>/<fn>`, so nothing else
+    in the archive ever touches the disk. Members are written to a dotfile and
+    renamed into place so that a concurrent reindex never sees a partial file.
+    """
+    if isinstance(channel, str):
+        channel = pathlib.Path(channel)
+
+    filematcher = '*%s*' % (package_name,)
+    extracted = []
     with zipfile.ZipFile(fp_pathlib, 'r') as zip_fh:
-        zip_fh.extractall(str(fp_pathlib.parent / new_name))
+        for info in zip_fh.infolist():
+            member = pathlib.PurePosixPath(info.filename)
+            if info.is_dir() or not member.name.endswith(CONDA_PACKAGE_EXTENSIONS):
+                continue
+            if not fnmatch.fnmatchcase(member.name, filematcher):
+                continue
+
+            # conda-build lays packages out as `<arch>/<fn>`
+            arch = member.parent.name
+            if arch == '':
+                raise Exception('Package is missing an arch directory: %s' % (info.filename,))
+
+            to_path = channel / arch / member.name
+            to_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = to_path.with_name('.%s.part' % (member.name,))
+            try:
+                with zip_fh.open(info) as from_fh, tmp_path.open('wb') as to_fh:
+                    shutil.copyfileobj(from_fh, to_fh, HTTP_CHUNK_SIZE)
+                os.replace(tmp_path, to_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            extracted.append(to_path)
+
+    return extracted
 
 
 def bootstrap_pkgs_dir(fp):
@@ -149,22 +462,112 @@ def bootstrap_pkgs_dir(fp):
         (fp / arch).mkdir(parents=True, exist_ok=True)
 
 
+# SQLSTATE for a lock_timeout running out
+PG_LOCK_NOT_AVAILABLE = '55P03'
+
+
 @contextlib.contextmanager
-def advisory_lock(lock_id):
+def advisory_lock(lock_id, timeout=None):
+    """Yield whether the advisory lock `lock_id` was acquired.
+
+    Without a timeout the lock is only tried once. With one, the caller waits
+    in Postgres's lock queue, which grants advisory locks in arrival order,
+    for up to `timeout` seconds.
+    """
     lock_id = int(lock_id)
     cursor = connection.cursor()
+    acquired = False
+    start = time.monotonic()
+    locked_at = None
 
     try:
-        cursor.execute('SELECT pg_try_advisory_lock(%s);', (lock_id,))
-        acquired = cursor.fetchall()[0][0]
+        if timeout is None:
+            cursor.execute('SELECT pg_try_advisory_lock(%s);', (lock_id,))
+            acquired = cursor.fetchall()[0][0]
+        else:
+            # a lock_timeout of zero means wait forever, so never go below 1ms
+            cursor.execute("SELECT set_config('lock_timeout', %s, false);", ('%dms' % (max(timeout * 1000, 1),),))
+            try:
+                cursor.execute('SELECT pg_advisory_lock(%s);', (lock_id,))
+                acquired = True
+            except OperationalError as e:
+                # anything else (a lost connection, a cancelled statement)
+                # says nothing about who holds the lock
+                if getattr(e.__cause__, 'pgcode', None) != PG_LOCK_NOT_AVAILABLE:
+                    raise
+            finally:
+                # so the rest of this connection's queries don't inherit it
+                cursor.execute('RESET lock_timeout;')
+
+        if acquired:
+            locked_at = time.monotonic()
         yield acquired
     finally:
-        cursor.execute('SELECT pg_advisory_unlock(%s);', (lock_id,))
+        if acquired:
+            cursor.execute('SELECT pg_advisory_unlock(%s);', (lock_id,))
         cursor.close()
 
+        if locked_at is None:
+            logger.info('advisory lock %d: not acquired after %.3fs', lock_id, time.monotonic() - start)
+        else:
+            logger.info('advisory lock %d: waited %.3fs, held %.3fs',
+                        lock_id, locked_at - start, time.monotonic() - locked_at)
+
+
+def advisory_lock_key(*scope):
+    """Hash a lock scope, e.g. `(epoch, gate, distro, path)`, to a bigint key."""
+    digest = hashlib.blake2b('\0'.join(str(part) for part in scope).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class AdvisoryLockManager:
+    """Hold the advisory locks for a set of scopes, waiting up to `timeout` seconds.
+
+    Keys are always taken in sorted order, so callers locking overlapping
+    scopes can't deadlock each other. Raises `AdvisoryLockNotReadyException`
+    if the locks aren't all granted in time.
+    """
+
+    def __init__(self, timeout=None):
+        if timeout is None:
+            timeout = conf.settings.ADVISORY_LOCK_TIMEOUT
+        self.timeout = timeout
+        self.wait_time = None
+        self.hold_time = None
+
+    @contextlib.contextmanager
+    def hold(self, *scopes):
+        keys = sorted({advisory_lock_key(*scope) for scope in scopes})
+        start = time.monotonic()
+
+        with contextlib.ExitStack() as stack:
+            for key in keys:
+                # every lock shares what is left of the one timeout
+                remaining = max(self.timeout - (time.monotonic() - start), 0)
+                if not stack.enter_context(advisory_lock(key, timeout=remaining)):
+                    logger.warning('gave up on %d advisory lock(s) after %.3fs', len(keys), time.monotonic() - start)
+                    raise AdvisoryLockNotReadyException(key)
+
+            locked_at = time.monotonic()
+            self.wait_time = locked_at - start
+            try:
+                yield self
+            finally:
+                self.hold_time = time.monotonic() - locked_at
+                logger.info('held %d advisory lock(s) for %.3fs after waiting %.3fs',
+                            len(keys), self.hold_time, self.wait_time)
+
 
 class IntegrationGitRepoManager:
-    def __init__(self, github_token):
+    """Read and write recipe YAML in the integration repo.
+
+    By default every file is its own contents API commit. With `batch=True`
+    the recipes are read out of a single recursive tree listing of the main
+    branch, and the writes made inside a `batched` block land as one tree,
+    one commit and one ref update.
+    """
+
+    def __init__(self, github_token, batch=False):
         if github_token == '':
             raise Exception('Missing Github Token')
 
@@ -175,6 +578,12 @@ class IntegrationGitRepoManager:
         self.main_branch = conf.settings.INTEGRATION_REPO['branch']
         self.ghapi = None
 
+        self.batch = batch
+        self.batch_depth = 0
+        self.ref_update_attempts = 5
+        self.base = None
+        self.staged = {}
+
     def construct_interface(self):
         if self.ghapi is None:
             self.ghapi = GhApi(token=self.github_token)
@@ -199,37 +608,47 @@ class IntegrationGitRepoManager:
         if len(package_versions) < 1:
             raise Exception('Missing package versions')
 
-        with advisory_lock(42) as lock:
-            if lock:
-                # Wait until we get a lock before setting up ghapi
-                self.construct_interface()
-                for distro, package_versions in package_versions.items():
-                    path = self.path_builder(epoch=epoch,
-                                             gate=gate,
-                                             fn='conda_build_config.yaml',
-                                             distro=distro)
-                    msg = 'updating %s\n\n' % (path,)
-                    cbc, sha = self.fetch_yaml_from_github(path)
-                    for package_name, ver in package_versions.items():
-                        # cbc.yml _needs_ snake case names
-                        package_name = package_name.replace('-', '_')
-
-                        if package_name in cbc:
-                            last_versions = cbc[package_name]
-                            if len(last_versions) != 1:
-                                raise Exception('Incorrect number of versions')
-                            if compare_package_versions(ver, last_versions[0]):
-                                raise Exception('Package version confusion')
-                        # cbc.yml _needs_ stringified version identifiers,
-                        # also, cbc.yml expects an array for each package
-                        cbc[package_name] = [str(ver)]
-                        msg += '- %s ==%s\n' % (package_name, ver)
-                    self.add_branch_if_missing(branch)
-                    self.commit_to_github(cbc, sha, path, msg, branch)
-            else:
-                raise AdvisoryLockNotReadyException
+        paths = {distro: self.path_builder(epoch=epoch, gate=gate, fn='conda_build_config.yaml', distro=distro)
+                 for distro in package_versions}
+        # only updates to the same file wait on each other
+        with self.batched(branch, *[(epoch, gate, distro, path) for distro, path in paths.items()]):
+            # Wait until we get a lock before setting up ghapi
+            self.construct_interface()
+            for distro, versions in package_versions.items():
+                self.add_branch_if_missing(branch)
+                self.update_file(paths[distro], functools.partial(self.edit_conda_build_config, versions), branch)
+
+    def edit_conda_build_config(self, package_versions, path, cbc):
+        msg = 'updating %s\n\n' % (path,)
+        for package_name, ver in package_versions.items():
+            # cbc.yml _needs_ snake case names
+            package_name = package_name.replace('-', '_')
+
+            if package_name in cbc:
+                last_versions = cbc[package_name]
+                if len(last_versions) != 1:
+                    raise Exception('Incorrect number of versions')
+                if compare_package_versions(ver, last_versions[0]):
+                    raise Exception('Package version confusion')
+            # cbc.yml _needs_ stringified version identifiers,
+            # also, cbc.yml expects an array for each package
+            cbc[package_name] = [str(ver)]
+            msg += '- %s ==%s\n' % (package_name, ver)
+
+        return cbc, msg
+
+    def update_file(self, path, edit, branch):
+        # `edit(path, data)` returns the file's new contents and the commit
+        # message. In a batch it is kept around, to be redone over whatever
+        # the file holds by then should the batch need rebasing.
+        data, sha = self.fetch_yaml_from_github(path)
+        data, msg = edit(path, data)
+        self.commit_to_github(data, sha, path, msg, branch, edit)
 
     def fetch_yaml_from_github(self, path):
+        if self.batch:
+            return self.fetch_yaml_from_tree(path)
+
         try:
             payload = self.ghapi.repos.get_content(
                 owner=self.owner,
@@ -248,7 +667,60 @@ class IntegrationGitRepoManager:
 
         return results
 
+    def refresh(self):
+        self.base = None
+
+    def fetch_base_tree(self):
+        if self.base is None:
+            ref = self.ghapi.git.get_ref(
+                owner=self.owner,
+                repo=self.repo,
+                ref='heads/%s' % (self.main_branch,),
+            )
+            commit = self.ghapi.git.get_commit(
+                owner=self.owner,
+                repo=self.repo,
+                commit_sha=ref['object']['sha'],
+            )
+            blobs = self.tree_blobs(commit['tree']['sha'])
+            self.base = (ref['object']['sha'], commit['tree']['sha'], blobs)
+
+        return self.base
+
+    def tree_blobs(self, tree_sha):
+        tree = self.ghapi.git.get_tree(
+            owner=self.owner,
+            repo=self.repo,
+            tree_sha=tree_sha,
+            recursive=1,
+        )
+        if tree['truncated']:
+            raise Exception('Integration repo tree is too large to list')
+        return {entry['path']: entry['sha'] for entry in tree['tree'] if entry['type'] == 'blob'}
+
+    def fetch_yaml_from_tree(self, path):
+        _, _, blobs = self.fetch_base_tree()
+        if path not in blobs:
+            return (dict(), None)
+
+        content = self.read_blob(blobs[path])
+        parsed = yaml.load(content, Loader=yaml.FullLoader)
+
+        return (parsed, blobs[path])
+
+    def read_blob(self, sha):
+        payload = self.ghapi.git.get_blob(
+            owner=self.owner,
+            repo=self.repo,
+            file_sha=sha,
+        )
+        return base64.b64decode(payload['content'])
+
     def add_branch_if_missing(self, branch):
+        if self.batch:
+            # the branch ref is created (or moved) when the batch is flushed
+            return
+
         try:
             self.ghapi.repos.get_branch(
                 owner=self.owner,
@@ -268,8 +740,13 @@ class IntegrationGitRepoManager:
                 sha=payload['object']['sha'],
             )
 
-    def commit_to_github(self, yaml_content, sha, path, msg, branch):
+    def commit_to_github(self, yaml_content, sha, path, msg, branch, edit=None):
         updated = yaml.dump(yaml_content)
+
+        if self.batch:
+            self.staged[path] = (updated, msg, sha, edit)
+            return
+
         content = base64.b64encode(updated.encode('utf-8')).decode('utf-8')
 
         self.ghapi.repos.create_or_update_file_contents(
@@ -282,10 +759,135 @@ class IntegrationGitRepoManager:
             branch=branch
         )
 
+    @contextlib.contextmanager
+    def batched(self, branch, *lock_scopes):
+        # nested blocks share the outermost one's commit, which lands before
+        # the outermost block lets go of its locks --- along with any re-read
+        # and redo of its edits that a conflicting commit forces
+        locks = AdvisoryLockManager().hold(*lock_scopes) if lock_scopes else contextlib.nullcontext()
+        with locks:
+            self.batch_depth += 1
+            try:
+                yield self
+            finally:
+                self.batch_depth -= 1
+
+            if self.batch_depth == 0:
+                self.flush(branch)
+
+    def flush(self, branch):
+        if not self.batch or self.batch_depth > 0 or not self.staged:
+            return None
+
+        for attempt in range(self.ref_update_attempts):
+            paths = sorted(self.staged)
+            if len(paths) == 1:
+                msg = self.staged[paths[0]][1]
+            else:
+                msg = 'updating %d files\n\n' % (len(paths),)
+                msg += '\n'.join(self.staged[path][1] for path in paths)
+            files = {path: self.staged[path][0] for path in paths}
+            bases = {path: self.staged[path][2] for path in paths}
+            try:
+                commit_sha = self.commit_staged(branch, files, msg, bases)
+                break
+            except IntegrationRefConflictException:
+                # somebody else committed in the meantime, maybe to these
+                # very files: the locks `batched` holds until this commit
+                # lands only keep out our own tasks, not a hand-made PR. So
+                # redo the edits over the new head, still under those locks.
+                if attempt == self.ref_update_attempts - 1:
+                    raise
+                self.refresh()
+                self.rebase_staged()
+
+        self.staged = {}
+        if branch == self.main_branch:
+            self.base = None
+
+        return commit_sha
+
+    def rebase_staged(self):
+        # a file that still holds what its edit was made from keeps it, any
+        # other has its edit redone --- version checks and all --- on top
+        for path, (_, _, sha, edit) in list(self.staged.items()):
+            data, current_sha = self.fetch_yaml_from_github(path)
+            if current_sha == sha:
+                continue
+            if edit is None:
+                raise IntegrationRefConflictException(path)
+            data, msg = edit(path, data)
+            self.staged[path] = (yaml.dump(data), msg, current_sha, edit)
+
+    def commit_staged(self, branch, files, msg, bases):
+        """Commit `files` on top of `branch`, which must hold `bases` (blob shas, by path) for them."""
+        main_sha, main_tree_sha, _ = self.fetch_base_tree()
+        try:
+            ref = self.ghapi.git.get_ref(
+                owner=self.owner,
+                repo=self.repo,
+                ref='heads/%s' % (branch,),
+            )
+            parent_sha = ref['object']['sha']
+        except HTTP404NotFoundError:
+            parent_sha = None
+
+        if parent_sha in (None, main_sha):
+            base_tree_sha = main_tree_sha
+        else:
+            base_tree_sha = self.ghapi.git.get_commit(
+                owner=self.owner,
+                repo=self.repo,
+                commit_sha=parent_sha,
+            )['tree']['sha']
+            # the branch moved on since these files were read
+            blobs = self.tree_blobs(base_tree_sha)
+            if any(blobs.get(path) != sha for path, sha in bases.items()):
+                raise IntegrationRefConflictException(branch)
+
+        tree = self.ghapi.git.create_tree(
+            owner=self.owner,
+            repo=self.repo,
+            base_tree=base_tree_sha,
+            tree=[{'path': path, 'mode': '100644', 'type': 'blob', 'content': content}
+                  for path, content in files.items()],
+        )
+        commit = self.ghapi.git.create_commit(
+            owner=self.owner,
+            repo=self.repo,
+            message=msg,
+            tree=tree['sha'],
+            parents=[parent_sha or main_sha],
+        )
+
+        try:
+            if parent_sha is None:
+                self.ghapi.git.create_ref(
+                    owner=self.owner,
+                    repo=self.repo,
+                    ref='refs/heads/%s' % (branch,),
+                    sha=commit['sha'],
+                )
+            else:
+                # not forced, so a branch that moved underneath us fails loudly
+                self.ghapi.git.update_ref(
+                    owner=self.owner,
+                    repo=self.repo,
+                    ref='heads/%s' % (branch,),
+                    sha=commit['sha'],
+                    force=False,
+                )
+        except HTTP422UnprocessableEntityError as e:
+            raise IntegrationRefConflictException(branch) from e
+
+        return commit['sha']
+
     def update_distro_metapackage_recipe(self, epoch, gate, distro, packages, branch, version):
         path = self.path_builder(epoch=epoch, gate=gate, fn='data.yaml', distro=distro)
+        self.update_file(path, functools.partial(self.edit_distro_metapackage_recipe, packages, version), branch)
+
+    def edit_distro_metapackage_recipe(self, packages, version, path, data):
         msg = 'updating %s\n\n' % (path,)
-        data, sha = self.fetch_yaml_from_github(path)
         if 'run' not in data:
             raise Exception('Something went wrong fetching YAML from GH')
         run_reqs = copy.deepcopy(data['run'])
@@ -296,17 +898,22 @@ class IntegrationGitRepoManager:
                 msg += '- %s\n' % (package,)
         data['run'] = sorted(run_reqs)
         data['version'] = version
-        self.commit_to_github(data, sha, path, msg, branch)
+
+        return data, msg
 
     def update_integration(self, branch, epoch, gate, package_versions, version):
         self.construct_interface()
-        self.update_conda_build_config(branch, epoch, gate, package_versions)
-
-        for distro, pkg_vers in package_versions.items():
-            if distro is None:
-                raise Exception('Missing distro name')
-            packages = set(pkg_vers.keys())
-            self.update_distro_metapackage_recipe(epoch, gate, distro, packages, branch, version)
+        # every file in the commit stays locked until it lands
+        scopes = [(epoch, gate, distro, self.path_builder(epoch=epoch, gate=gate, fn=fn, distro=distro))
+                  for distro in package_versions for fn in ('conda_build_config.yaml', 'data.yaml')]
+        with self.batched(branch, *scopes):
+            self.update_conda_build_config(branch, epoch, gate, package_versions)
+
+            for distro, pkg_vers in package_versions.items():
+                if distro is None:
+                    raise Exception('Missing distro name')
+                packages = set(pkg_vers.keys())
+                self.update_distro_metapackage_recipe(epoch, gate, distro, packages, branch, version)
 
     def open_pr(self, branch, pr_msg):
         self.construct_interface()
@@ -345,6 +952,178 @@ class IntegrationGitRepoManager:
                 raise Exception('Something went wrong merging PR')
 
 
+class LocalMirrorGitRepoManager(IntegrationGitRepoManager):
+    """Work against a bare clone of the integration repo kept on local disk.
+
+    The clone is brought up to date with one incremental fetch per manager,
+    recipes are read straight out of its object database and a batch is
+    committed through a throwaway index and pushed in a single operation.
+    Pull requests are still opened and merged through the API.
+    """
+
+    def __init__(self, github_token, mirror_path=None, remote_url=None):
+        super().__init__(github_token, batch=True)
+
+        self.mirror_path = pathlib.Path(mirror_path or conf.settings.INTEGRATION_REPO_MIRROR_PATH)
+        if remote_url is None:
+            remote_url = 'https://github.com/%s/%s.git' % (self.owner, self.repo)
+        self.remote_url = remote_url
+        self.fetched = False
+
+    def git(self, *args, input=None, env=None):
+        # the token travels in the environment for this one command, so it
+        # never lands in the mirror's config or in the process list
+        auth = base64.b64encode(('x-access-token:%s' % (self.github_token,)).encode('utf-8')).decode('utf-8')
+        committer = self.owner
+        cmd_env = dict(
+            os.environ,
+            GIT_TERMINAL_PROMPT='0',
+            GIT_CONFIG_COUNT='1',
+            GIT_CONFIG_KEY_0='http.extraheader',
+            GIT_CONFIG_VALUE_0='AUTHORIZATION: basic %s' % (auth,),
+            GIT_AUTHOR_NAME=committer,
+            GIT_AUTHOR_EMAIL='%s@users.noreply.github.com' % (committer,),
+            GIT_COMMITTER_NAME=committer,
+            GIT_COMMITTER_EMAIL='%s@users.noreply.github.com' % (committer,),
+            **(env or {}),
+        )
+
+        result = subprocess.run(['git', '--git-dir', str(self.mirror_path), *args],
+                                input=input, env=cmd_env, capture_output=True)
+        if result.returncode != 0:
+            raise Exception('git %s failed: %s' % (args[0], result.stderr.decode('utf-8', 'replace').strip()))
+
+        return result.stdout.decode('utf-8').strip()
+
+    @contextlib.contextmanager
+    def mirror_lock(self):
+        self.mirror_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.mirror_path.with_name(self.mirror_path.name + '.lock'), 'w') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            yield
+
+    def construct_interface(self):
+        super().construct_interface()
+
+        if not self.fetched:
+            with self.mirror_lock():
+                if not (self.mirror_path / 'HEAD').exists():
+                    self.mirror_path.mkdir(parents=True, exist_ok=True)
+                    self.git('init', '--bare', '--quiet')
+                self.git('fetch', '--quiet', '--prune', self.remote_url, '+refs/heads/*:refs/remotes/origin/*')
+            self.fetched = True
+
+    def refresh(self):
+        super().refresh()
+        self.fetched = False
+        self.construct_interface()
+
+    def remote_head(self, branch):
+        return self.git('for-each-ref', '--format=%(objectname)', 'refs/remotes/origin/%s' % (branch,)) or None
+
+    def fetch_base_tree(self):
+        if self.base is None:
+            main_sha = self.remote_head(self.main_branch)
+            if main_sha is None:
+                raise Exception('Missing branch in mirror: %s' % (self.main_branch,))
+            tree_sha = self.git('rev-parse', '%s^{tree}' % (main_sha,))
+
+            self.base = (main_sha, tree_sha, self.tree_blobs(tree_sha))
+
+        return self.base
+
+    def tree_blobs(self, tree_sha):
+        blobs = {}
+        for line in self.git('ls-tree', '-r', '-z', tree_sha).split('\0'):
+            if not line:
+                continue
+            meta, path = line.split('\t', 1)
+            _, obj_type, sha = meta.split()
+            if obj_type == 'blob':
+                blobs[path] = sha
+        return blobs
+
+    def read_blob(self, sha):
+        return self.git('cat-file', 'blob', sha)
+
+    def commit_staged(self, branch, files, msg, bases):
+        main_sha, _, _ = self.fetch_base_tree()
+        parent_sha = self.remote_head(branch) or main_sha
+        if parent_sha != main_sha:
+            blobs = self.tree_blobs('%s^{tree}' % (parent_sha,))
+            if any(blobs.get(path) != sha for path, sha in bases.items()):
+                raise IntegrationRefConflictException(branch)
+
+        with self.mirror_lock(), tempfile.TemporaryDirectory() as tmpdir:
+            index_env = {'GIT_INDEX_FILE': os.path.join(tmpdir, 'index')}
+            self.git('read-tree', parent_sha, env=index_env)
+            index_info = ''
+            for path, content in files.items():
+                blob_sha = self.git('hash-object', '-w', '--stdin', input=content.encode('utf-8'))
+                index_info += '100644 %s\t%s\n' % (blob_sha, path)
+            self.git('update-index', '--index-info', input=index_info.encode('utf-8'), env=index_env)
+            tree_sha = self.git('write-tree', env=index_env)
+
+            commit_sha = self.git('commit-tree', tree_sha, '-p', parent_sha, '-m', msg)
+            # not forced, so a branch that moved underneath us fails loudly
+            try:
+                self.git('push', '--quiet', self.remote_url, '%s:refs/heads/%s' % (commit_sha, branch))
+            except Exception as e:
+                if '[rejected]' in str(e):
+                    raise IntegrationRefConflictException(branch) from e
+                raise
+            self.git('update-ref', 'refs/remotes/origin/%s' % (branch,), commit_sha)
+
+        return commit_sha
+
+
+def get_integration_repo_manager(github_token):
+    if conf.settings.INTEGRATION_REPO_BACKEND == 'mirror':
+        return LocalMirrorGitRepoManager(github_token)
+    return IntegrationGitRepoManager(github_token, batch=True)
+
+
+def resolve_cfg(cfg, ctx, load=False):
+    """Swap a `CfgRef` (or a list of them) for the cfg it points to.
+
+    The cfg comes off of `ctx.cfgs`, where the chain's first link left it.
+    Only that link --- which always runs in the `db` queue --- passes `load`,
+    to read it out of `PipelineConfig` instead.
+    """
+    if isinstance(cfg, list):
+        return [resolve_cfg(item, ctx, load) for item in cfg]
+
+    if type(cfg).__name__ != 'CfgRef':
+        return cfg
+
+    if cfg.pk not in ctx.cfgs:
+        if not load:
+            raise UnresolvedCfgException(cfg.pk)
+        from .models import PipelineConfig
+        ctx.cfgs[cfg.pk] = PipelineConfig.objects.load(cfg.pk)
+
+    return dataclasses.replace(ctx.cfgs[cfg.pk], github_token=cfg.github_token)
+
+
+def resolves_cfg(fn=None, *, load=False):
+    # for tasks shaped `(ctx, cfg, ...)`: lets a chain bind a `CfgRef`
+    if fn is None:
+        return functools.partial(resolves_cfg, load=load)
+
+    @functools.wraps(fn)
+    def wrapper(ctx, cfg, *args, **kwargs):
+        return fn(ctx, resolve_cfg(cfg, ctx, load), *args, **kwargs)
+    return wrapper
+
+
+class PipelineLinkTask(Task):
+    # a link in the middle of a chain hands its ctx straight to the next one,
+    # so nobody ever reads its result --- only write one down if the chain
+    # dies here, so that the failure (and its traceback) can still be found
+    ignore_result = True
+    store_errors_even_if_ignored = True
+
+
 def compare_package_versions(a, b):
     pkg_ver_a = version.Version(str(a))
     pkg_ver_b = version.Version(str(b))
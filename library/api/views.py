@@ -6,12 +6,18 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import logging
+
 from django import http, conf
 from django.core.exceptions import PermissionDenied
 from django.views.decorators import csrf
 
 from . import forms
 from . import tasks
+from .models import IntakeRequest, intake_key
+
+
+logger = logging.getLogger(__name__)
 
 
 @csrf.csrf_exempt
@@ -26,13 +32,82 @@ def prepare_packages_for_integration(request):
         payload = {'status': 'error', 'errors': form.errors}
         return http.JsonResponse(payload, status=400)
 
+    payload = {'status': 'ok'}
     if (config := form.is_known()):
-        tasks.handle_new_package_build(config)
+        [result] = launch_once([config], lambda configs: tasks.handle_new_package_build(configs[0]))
+        payload.update(result)
 
-    payload = {'status': 'ok'}
     return http.JsonResponse(payload, status=200)
 
 
+@csrf.csrf_exempt
+def prepare_bulk_packages_for_integration(request):
+    if request.method != 'POST':
+        payload = {'status': 'error', 'errors': {'http_method': 'invalid http method'}}
+        return http.JsonResponse(payload, status=405)
+
+    try:
+        body = request.body.decode('utf-8')
+    except UnicodeDecodeError:
+        payload = {'status': 'error', 'errors': {'builds': ['Enter a valid JSON.']}}
+        return http.JsonResponse(payload, status=400)
+
+    # malformed JSON is caught by the form's `JSONField`
+    form = forms.BulkPackageIntegrationForm({'builds': body})
+
+    if not form.is_valid():
+        payload = {'status': 'error', 'errors': form.errors}
+        return http.JsonResponse(payload, status=400)
+
+    configs = form.is_known()
+    # unknown tokens are skipped quietly, just like the single endpoint
+    results = iter(launch_once([config for config in configs if config is not None],
+                               tasks.handle_new_package_builds))
+
+    payload = {
+        'status': 'ok',
+        'builds': [next(results) if config is not None else {'pipeline_id': None, 'duplicate': False}
+                   for config in configs],
+    }
+    return http.JsonResponse(payload, status=200)
+
+
+def launch_once(configs, handle):
+    """Hand `handle` the configs not seen lately, and say which pipeline has each one.
+
+    Reruns and retries of a workflow post the same artifacts many times, so a
+    config already claimed within `INTAKE_DEDUP_WINDOW` is answered with the
+    pipeline launched for it instead.
+    """
+    results, claimed = [], []
+    for config in configs:
+        key = intake_key(config['package_token'], config['run_id'], config['artifact_name'], config['version'])
+        record, is_new = IntakeRequest.objects.claim(key, conf.settings.INTAKE_DEDUP_WINDOW)
+
+        if is_new:
+            claimed.append((config, record))
+            results.append(None)
+        else:
+            pipeline_id = record.pipeline_id or None
+            logger.info('duplicate integration request for %s (run %s), pipeline %s, %d hits',
+                        config['artifact_name'], config['run_id'], pipeline_id, record.hits)
+            results.append({'pipeline_id': pipeline_id, 'duplicate': True})
+
+    if claimed:
+        records = [record for _, record in claimed]
+        try:
+            pipeline_id = handle([config for config, _ in claimed]).id
+        except Exception:
+            IntakeRequest.objects.release(records)
+            raise
+        IntakeRequest.objects.launched(records, pipeline_id)
+
+        results = [result if result is not None else {'pipeline_id': pipeline_id, 'duplicate': False}
+                   for result in results]
+
+    return results
+
+
 @csrf.csrf_exempt
 def stage_metapackage(request):
     if request.method != 'POST':
@@ -6,14 +6,37 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import functools
+import pathlib
+
+from celery import Task
+from celery.app.backends import by_url
 from celery.decorators import task
 from celery.utils.log import get_task_logger
+from django import conf
 
 
 logger = get_task_logger(__name__)
 
 
-@task(name='index.debug')
+@functools.lru_cache(maxsize=None)
+def debug_result_backend(app, url):
+    if url.startswith('file://'):
+        # the filesystem backend won't create its own directory
+        pathlib.Path(url[len('file://'):]).mkdir(parents=True, exist_ok=True)
+    backend_cls, url = by_url(url, app.loader)
+    return backend_cls(app=app, url=url)
+
+
+class DebugTask(Task):
+    @property
+    def backend(self):
+        if not conf.settings.DEBUG_RESULT_BACKEND:
+            return self.app.backend
+        return debug_result_backend(self.app, conf.settings.DEBUG_RESULT_BACKEND)
+
+
+@task(name='index.debug', base=DebugTask)
 def debug(payload):
     logger.info('Debug: %r' % (payload, ))
     return payload
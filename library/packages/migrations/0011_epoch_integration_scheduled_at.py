@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2021-11-19 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0010_alter_distrobuild_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='epoch',
+            name='integration_scheduled_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Integration Scheduled At'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.9 on 2021-11-22 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0011_epoch_integration_scheduled_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='packagebuild',
+            index=models.Index(fields=['package', 'github_run_id', 'version', 'epoch', 'build_target'],
+                               name='packages_pb_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='packagebuild',
+            index=models.Index(condition=models.Q(('linux_64', True), ('osx_64', True)), fields=['epoch', 'package'],
+                               name='packages_pb_ready_idx'),
+        ),
+    ]
@@ -6,10 +6,12 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import datetime
 import uuid
 
 from django.db import models
 from django import conf
+from django.utils import timezone
 
 from library.utils.models import AuditModel
 
@@ -17,14 +19,17 @@ from library.utils.models import AuditModel
 # ### CUSTOM QUERYSETS
 
 class PackageBuildQuerySet(models.QuerySet):
-    def ready_for_integration(self, epoch_name, distro):
+    def ready_for_integration_by_distro(self, epoch_name):
+        # every distro in one query: a build belonging to several distros
+        # comes back once per distro
         return self.filter(
             epoch__name=epoch_name,
             linux_64=True,
             osx_64=True,
-            package__in=distro.packages.all(),
+            package__distros__isnull=False,
             distro_builds__isnull=True,
-        ).values('package__name', 'version', 'id')
+        ).values('package__name', 'version', 'id',
+                 distro_id=models.F('package__distros__id'), distro_name=models.F('package__distros__name'))
 
 
 class EpochQuerySet(models.QuerySet):
@@ -34,6 +39,33 @@ class EpochQuerySet(models.QuerySet):
             is_dev=build_target.lower() == 'dev',
         )
 
+    def by_build_targets(self, build_targets):
+        # every epoch `by_build_target` would find for any of these, at once
+        return self.filter(
+            include_in_ci=True,
+            is_dev__in={build_target.lower() == 'dev' for build_target in build_targets},
+        )
+
+    def _integration_claimable(self, window):
+        # a run that is overdue by a whole window went missing, so it may be
+        # claimed again
+        overdue = timezone.now() - datetime.timedelta(seconds=window)
+        return models.Q(integration_scheduled_at__isnull=True) | models.Q(integration_scheduled_at__lt=overdue)
+
+    def without_pending_integration(self, window):
+        return self.filter(self._integration_claimable(window))
+
+    def schedule_integration(self, epoch_id, window):
+        """Claim the next integration run for an epoch, `window` seconds out.
+
+        Returns when the run is due, or `None` if one is already pending, in
+        which case the caller's builds will be picked up by that run.
+        """
+        eta = timezone.now() + datetime.timedelta(seconds=window)
+        claimed = self.filter(self._integration_claimable(window), pk=epoch_id).update(
+            integration_scheduled_at=eta)
+        return eta if claimed else None
+
 
 # ### BASE MODELS
 
@@ -73,6 +105,15 @@ class PackageBuild(AuditModel):
 
     class Meta:
         verbose_name = 'Package Build'
+        indexes = [
+            # `get_or_create` in `db.create_package_build_record_and_update_package`
+            models.Index(fields=['package', 'github_run_id', 'version', 'epoch', 'build_target'],
+                         name='packages_pb_lookup_idx'),
+            # `ready_for_integration_by_distro`: only the handful of builds with both
+            # architectures uploaded are worth indexing
+            models.Index(fields=['epoch', 'package'], condition=models.Q(linux_64=True, osx_64=True),
+                         name='packages_pb_ready_idx'),
+        ]
 
 
 class Distro(AuditModel):
@@ -96,6 +137,7 @@ class Epoch(AuditModel):
     name = models.CharField(max_length=255, unique=True)
     is_dev = models.BooleanField(default=True, verbose_name='Is Dev?')
     include_in_ci = models.BooleanField(default=False, verbose_name='Include In CI?')
+    integration_scheduled_at = models.DateTimeField(null=True, blank=True, verbose_name='Integration Scheduled At')
     distros = models.ManyToManyField(
         Distro,
         through='ThroughEpochDistro',
@@ -0,0 +1,54 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2018-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from django import test
+from django.db import connection, models
+
+from library.packages.models import Distro, Epoch, Package, PackageBuild, ThroughDistroPackage
+
+
+class PackageBuildIndexTests(test.TestCase):
+    def indexes(self):
+        return {index.name: index for index in PackageBuild._meta.indexes}
+
+    def test_ready_index_only_covers_builds_with_both_architectures(self):
+        index = self.indexes()['packages_pb_ready_idx']
+
+        self.assertEqual(index.fields, ['epoch', 'package'])
+        self.assertEqual(index.condition, models.Q(linux_64=True, osx_64=True))
+
+    def test_lookup_index_matches_get_or_create(self):
+        index = self.indexes()['packages_pb_lookup_idx']
+
+        self.assertEqual(index.fields, ['package', 'github_run_id', 'version', 'epoch', 'build_target'])
+        self.assertIsNone(index.condition)
+
+    def test_indexes_are_migrated(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, PackageBuild._meta.db_table)
+
+        self.assertEqual(constraints['packages_pb_ready_idx']['columns'], ['epoch_id', 'package_id'])
+        self.assertEqual(constraints['packages_pb_lookup_idx']['columns'],
+                         ['package_id', 'github_run_id', 'version', 'epoch_id', 'build_target'])
+
+    def test_ready_for_integration_is_one_query(self):
+        epoch = Epoch.objects.create(name='2021.8', include_in_ci=True)
+        for i in range(3):
+            distro = Distro.objects.create(name='distro%d' % (i,))
+            for j in range(3):
+                package = Package.objects.create(name='q2-pkg%d-%d' % (i, j), repository='qiime2/q2-pkg')
+                ThroughDistroPackage.objects.create(distro=distro, package=package)
+                PackageBuild.objects.create(package=package, epoch=epoch, github_run_id=str(j),
+                                            version='2021.8.0.dev%d' % (j,), linux_64=True, osx_64=j != 0,
+                                            build_target='dev')
+
+        with self.assertNumQueries(1):
+            ready = list(PackageBuild.objects.ready_for_integration_by_distro('2021.8'))
+
+        self.assertEqual(sorted((r['distro_name'], r['package__name']) for r in ready),
+                         [('distro%d' % (i,), 'q2-pkg%d-%d' % (i, j)) for i in range(3) for j in (1, 2)])